@@ -0,0 +1,373 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from contextlib import closing
+from typing import List, Optional, Tuple
+
+from .answer_cache import _cosine, _vector, normalize_query
+from .manual_store import DB_DIR
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ANSWER_BANK_PATH = os.environ.get("ANSWER_BANK_PATH", os.path.join(DB_DIR, "answer_bank.sqlite"))
+# Curated top symptoms per persona; editable
+TOP_QUERIES_PATH = os.environ.get("TOP_QUERIES_PATH", os.path.join(BASE_DIR, "..", "top_queries.json"))
+# Most frequent recent questions (from the video job store) added to the curated list
+ANSWER_BANK_LEARNED = int(os.environ.get("ANSWER_BANK_LEARNED", "20"))
+ANSWER_BANK_MIN_COUNT = int(os.environ.get("ANSWER_BANK_MIN_COUNT", "3"))
+# Stricter than the answer cache: a precomputed answer is served without any LLM call
+ANSWER_BANK_SIMILARITY = float(os.environ.get("ANSWER_BANK_SIMILARITY", "0.9"))
+ANSWER_BANK_VIDEO = os.environ.get("ANSWER_BANK_VIDEO", "1") != "0"
+PERSONAS = ("Technical", "YouTuber", "Teacher")
+# Referenced pages pre-rendered per answer
+PRERENDER_PAGES = 3
+# How often lookups check whether build_answer_bank.py (another process) changed the bank
+ANSWER_BANK_CHECK_INTERVAL = 5.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS answers (
+    persona TEXT NOT NULL,
+    normalized TEXT NOT NULL,
+    query TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    video TEXT,
+    video_id TEXT NOT NULL,
+    sources TEXT NOT NULL,
+    built_at REAL NOT NULL,
+    PRIMARY KEY (persona, normalized)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+
+class AnswerBank:
+    """
+    Precomputed DiagnoseResponse payloads (and video assets) for the top questions per persona,
+    built offline by build_answer_bank.py and kept in SQLite.
+
+    Every entry records the content hash of the manual its answer cites. sync_corpus() is
+    called whenever the corpus is (re)loaded and hides entries whose manual changed or
+    disappeared, so a stale answer is never served; refresh_answer_bank() regenerates only those.
+    Lookups are in memory: the exact normalized question first, then the most similar phrasing.
+    Every write bumps a version row, and lookups reload the entries when another process
+    (build_answer_bank.py) bumped it, so a rebuild is served without a restart.
+
+    Banked narration files are touched whenever they are served or refreshed so tts does not
+    prune them; an entry whose audio is gone anyway is served without its video and rebuilt
+    by the next refresh.
+    """
+
+    def __init__(self, path: str = ANSWER_BANK_PATH, threshold: float = ANSWER_BANK_SIMILARITY):
+        self.path = path
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._entries = {}  # (persona, normalized) -> entry
+        self._hashes = None  # filename -> content hash of the loaded corpus
+        self._version = None
+        self._bank_version = None  # meta version row the entries were loaded at
+        self._checked_at = 0.0
+        self.stale = set()  # keys whose manual changed since they were built
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.reloads = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.executescript(_SCHEMA)
+        self._reload()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    @staticmethod
+    def _read_version(conn) -> int:
+        row = conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        return row[0] if row else 0
+
+    def _bump_version(self, conn):
+        """Bumps the version row inside the caller's transaction; the entries stay current if nobody else wrote."""
+        before = self._read_version(conn)
+        conn.execute(
+            "INSERT INTO meta (key, value) VALUES ('version', 1) "
+            "ON CONFLICT(key) DO UPDATE SET value = value + 1"
+        )
+        if before == self._bank_version:
+            self._bank_version = before + 1
+
+    def _reload(self):
+        with closing(self._connect()) as conn:
+            version = self._read_version(conn)
+            rows = conn.execute(
+                "SELECT persona, normalized, query, payload, video, video_id, sources, built_at FROM answers"
+            ).fetchall()
+        entries = {}
+        for persona, normalized, query, payload, video, video_id, sources, built_at in rows:
+            entries[(persona, normalized)] = {
+                "query": query, "vector": _vector(normalized), "payload": json.loads(payload),
+                "video": json.loads(video) if video else None, "video_id": video_id,
+                "sources": json.loads(sources), "built_at": built_at,
+            }
+        with self._lock:
+            self._entries = entries
+            self._bank_version = version
+            if self._hashes is not None:
+                self.stale = {key for key, entry in entries.items() if not self._is_current(entry)}
+
+    def _check_reload(self):
+        """Reloads the entries if another process changed the bank (checked every few seconds)."""
+        now = time.monotonic()
+        if now - self._checked_at < ANSWER_BANK_CHECK_INTERVAL:
+            return
+        self._checked_at = now
+        try:
+            with closing(self._connect()) as conn:
+                version = self._read_version(conn)
+            if version != self._bank_version:
+                self._reload()
+                self.reloads += 1
+                print(f"DEBUG: Answer bank reloaded ({len(self._entries)} entries, version {version})")
+        except Exception as e:
+            print(f"DEBUG: Answer bank reload failed: {e}")
+
+    def _sources(self, payload: dict) -> dict:
+        """What an answer depends on: the manual it cites, or the whole corpus if it cites none."""
+        source = payload.get("source_file")
+        if source and self._hashes and source in self._hashes:
+            return {source: self._hashes[source]}
+        return {"*": self._version}
+
+    def _is_current(self, entry: dict) -> bool:
+        return all(
+            (self._version if source == "*" else self._hashes.get(source)) == content_hash
+            for source, content_hash in entry["sources"].items()
+        )
+
+    def sync_corpus(self, hashes: dict, version: str) -> int:
+        """Takes the loaded corpus ({filename: content hash}, version); returns the number of stale entries."""
+        with self._lock:
+            self._hashes = dict(hashes)
+            self._version = version
+            self.stale = {key for key, entry in self._entries.items() if not self._is_current(entry)}
+            if self.stale:
+                print(f"DEBUG: {len(self.stale)} answer bank entries are stale after the corpus changed")
+            return len(self.stale)
+
+    def get(self, query: str, persona: str) -> Optional[Tuple[dict, Optional[dict], str]]:
+        """(payload, video, video_id) of a current precomputed answer for the question, or None."""
+        normalized = normalize_query(query)
+        self._check_reload()
+        with self._lock:
+            if self._hashes is None or not self._entries:
+                return None
+            key = (persona, normalized)
+            if key in self._entries and key not in self.stale:
+                self.hits += 1
+                return self._result(self._entries[key])
+
+            vec = _vector(normalized)
+            best_key, best_score = None, self.threshold
+            for other_key, entry in self._entries.items():
+                if other_key[0] != persona or other_key in self.stale:
+                    continue
+                score = _cosine(vec, entry["vector"])
+                if score >= best_score:
+                    best_key, best_score = other_key, score
+            if best_key:
+                self.near_hits += 1
+                return self._result(self._entries[best_key])
+            self.misses += 1
+            return None
+
+    def _result(self, entry: dict) -> tuple:
+        video = entry["video"] if _touch_audio(entry["video"]) else None
+        return json.loads(json.dumps(entry["payload"])), video, entry["video_id"]
+
+    def is_current(self, query: str, persona: str, video: bool = False) -> bool:
+        """True if the entry is up to date (and, with video, still has its narration file)."""
+        key = (persona, normalize_query(query))
+        self._check_reload()
+        with self._lock:
+            if key not in self._entries or key in self.stale or self._hashes is None:
+                return False
+            entry = self._entries[key]
+        return not video or _touch_audio(entry["video"])
+
+    def put(self, query: str, persona: str, payload: dict, video: Optional[dict] = None):
+        normalized = normalize_query(query)
+        with self._lock:
+            entry = {
+                "query": query, "vector": _vector(normalized), "payload": payload, "video": video,
+                "video_id": str(uuid.uuid4()), "sources": self._sources(payload), "built_at": time.time(),
+            }
+            with closing(self._connect()) as conn, conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (persona, normalized, query, json.dumps(payload, ensure_ascii=False),
+                     json.dumps(video, ensure_ascii=False) if video else None, entry["video_id"],
+                     json.dumps(entry["sources"], ensure_ascii=False), entry["built_at"]),
+                )
+                self._bump_version(conn)
+            self._entries[(persona, normalized)] = entry
+            self.stale.discard((persona, normalized))
+
+    def prune(self, keep: List[tuple]) -> int:
+        """Deletes entries for questions no longer in the target list and stale ones that were not rebuilt."""
+        wanted = {(persona, normalize_query(query)) for query, persona in keep}
+        with self._lock:
+            drop = [key for key in self._entries if key not in wanted or key in self.stale]
+            if drop:
+                with closing(self._connect()) as conn, conn:
+                    conn.executemany("DELETE FROM answers WHERE persona = ? AND normalized = ?", drop)
+                    self._bump_version(conn)
+            for key in drop:
+                del self._entries[key]
+                self.stale.discard(key)
+            return len(drop)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "stale": len(self.stale),
+            "hits": self.hits,
+            "near_hits": self.near_hits,
+            "misses": self.misses,
+            "reloads": self.reloads,
+        }
+
+
+def _touch_audio(video: Optional[dict]) -> bool:
+    """
+    Refreshes the mtime of a banked video's narration file so tts never prunes it.
+    False if there is no usable video or the file is gone.
+    """
+    from .tts import audio_path
+
+    if not video or not video.get("audio_url"):
+        return False
+    path = audio_path(video["audio_url"].rsplit("/", 1)[-1])
+    if path is None:
+        return False
+    try:
+        os.utime(path)
+    except OSError:
+        return False
+    return True
+
+
+_answer_bank: Optional[AnswerBank] = None
+_refreshing = False
+
+
+def get_answer_bank() -> AnswerBank:
+    global _answer_bank
+    if _answer_bank is None:
+        _answer_bank = AnswerBank()
+    return _answer_bank
+
+
+def get_banked_answer(query: str, persona: str) -> Optional[Tuple[dict, Optional[dict], str]]:
+    """AnswerBank.get on the shared bank; blocking (SQLite), so async callers run it via run_blocking."""
+    return get_answer_bank().get(query, persona)
+
+
+def top_queries() -> List[tuple]:
+    """(query, persona) pairs to precompute: the curated list for every persona plus learned ones."""
+    targets = []
+    try:
+        with open(TOP_QUERIES_PATH, encoding="utf-8") as f:
+            curated = json.load(f)
+        for persona in curated.get("personas", PERSONAS):
+            targets.extend((query, persona) for query in curated.get("queries", []))
+    except Exception as e:
+        print(f"DEBUG: Failed to read curated top queries from {TOP_QUERIES_PATH}: {e}")
+
+    if ANSWER_BANK_LEARNED:
+        from .job_store import get_job_store
+        for query, persona, _ in get_job_store().top_queries(ANSWER_BANK_LEARNED, ANSWER_BANK_MIN_COUNT):
+            if persona in PERSONAS:
+                targets.append((query, persona))
+
+    seen = set()
+    unique = []
+    for query, persona in targets:
+        key = (persona, normalize_query(query))
+        if key not in seen:
+            seen.add(key)
+            unique.append((query, persona))
+    return unique
+
+
+async def refresh_answer_bank(full: bool = False, video: bool = ANSWER_BANK_VIDEO) -> dict:
+    """
+    Builds missing and stale entries (all of them with full=True): diagnosis, pre-rendered
+    referenced pages and, with video, the narrated slides. Runs one question at a time so a
+    rebuild never competes with live traffic for Gemini capacity.
+    """
+    from .concurrency import run_blocking
+    from .image_utils import prerender_page, get_manual_path
+    from .rag import get_corpus_version, get_rag_diagnosis_async
+    from .video_jobs import generate_video_single_flight
+
+    bank = await run_blocking("store", get_answer_bank)
+    await run_blocking("setup", get_corpus_version)
+    targets = await run_blocking("setup", top_queries)
+    report = {"targets": len(targets), "built": 0, "skipped": 0, "failed": 0}
+    for query, persona in targets:
+        if not full and await run_blocking("store", bank.is_current, query, persona, video):
+            report["skipped"] += 1
+            continue
+        payload = await get_rag_diagnosis_async(query, persona=persona)
+        # Error and degraded payloads carry confidence 0 and are not worth serving
+        if payload.get("confidence", 0) <= 0:
+            print(f"DEBUG: Answer bank could not build '{query}' ({persona})", flush=True)
+            report["failed"] += 1
+            continue
+        if payload.get("source_file"):
+            pdf_path = get_manual_path(payload["source_file"])
+            for page_num in payload.get("referenced_pages", [])[:PRERENDER_PAGES]:
+                await run_blocking("render", prerender_page, pdf_path, page_num, 150, "webp")
+        assets = await generate_video_single_flight(query, persona) if video else None
+        # A video whose script or narration failed is not banked; the answer still is
+        if assets and not assets.get("audio_url"):
+            assets = None
+        await run_blocking("store", bank.put, query, persona, payload, assets)
+        report["built"] += 1
+        print(f"DEBUG: Answer bank built '{query}' ({persona})", flush=True)
+    report["pruned"] = await run_blocking("store", bank.prune, targets)
+    return report
+
+
+def schedule_answer_bank_refresh() -> bool:
+    """
+    After an ingest: rebuilds stale entries on the background lane, if the bank has been
+    populated and some entries went stale. Returns True if a refresh was queued.
+    """
+    from .task_queue import QueueFullError, task_queue
+
+    global _refreshing
+    bank = get_answer_bank()
+    if _refreshing or not bank.stale:
+        return False
+
+    async def run():
+        global _refreshing
+        try:
+            report = await refresh_answer_bank()
+            print(f"DEBUG: Answer bank refreshed: {report}", flush=True)
+        finally:
+            _refreshing = False
+
+    try:
+        task_queue.submit("background", run)
+    except QueueFullError as e:
+        print(f"DEBUG: Answer bank refresh skipped: {e}", flush=True)
+        return False
+    _refreshing = True
+    return True
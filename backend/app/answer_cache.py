@@ -0,0 +1,117 @@
+import os
+import copy
+import math
+import time
+import threading
+import unicodedata
+from collections import Counter, OrderedDict
+from typing import Optional
+
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", "512"))
+ANSWER_CACHE_TTL = int(os.environ.get("ANSWER_CACHE_TTL", "3600"))
+# Cosine similarity over character bigrams above which two phrasings share an answer
+ANSWER_CACHE_SIMILARITY = float(os.environ.get("ANSWER_CACHE_SIMILARITY", "0.85"))
+
+_IGNORED_CHARS = set("、。，．,.!！?？・「」『』()（）[]【】〜~ー-")
+
+
+def normalize_query(query: str) -> str:
+    """
+    Folds the ways users type the same question:
+    full/half width (NFKC), katakana to hiragana, case, whitespace and punctuation.
+    """
+    text = unicodedata.normalize("NFKC", query).lower()
+    chars = []
+    for ch in text:
+        if ch.isspace() or ch in _IGNORED_CHARS:
+            continue
+        code = ord(ch)
+        if 0x30A1 <= code <= 0x30F6:  # katakana -> hiragana
+            ch = chr(code - 0x60)
+        chars.append(ch)
+    return "".join(chars)
+
+
+def _vector(normalized: str) -> Counter:
+    if len(normalized) < 2:
+        return Counter([normalized])
+    return Counter(normalized[i:i + 2] for i in range(len(normalized) - 1))
+
+
+def _cosine(a: Counter, b: Counter) -> float:
+    dot = sum(v * b.get(k, 0) for k, v in a.items())
+    if not dot:
+        return 0.0
+    return dot / (math.sqrt(sum(v * v for v in a.values())) * math.sqrt(sum(v * v for v in b.values())))
+
+
+class AnswerCache:
+    """
+    LRU + TTL cache of diagnosis payloads in front of the LLM.
+    Lookups try the exact normalized query first, then the most similar cached phrasing
+    with the same persona and corpus version.
+    """
+
+    def __init__(self, max_size: int = ANSWER_CACHE_SIZE, ttl: int = ANSWER_CACHE_TTL,
+                 threshold: float = ANSWER_CACHE_SIMILARITY):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.threshold = threshold
+        self._entries = OrderedDict()  # (persona, version, normalized) -> (expires_at, vector, payload)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+
+    def get(self, query: str, persona: str, version: str, allow_stale: bool = False) -> Optional[dict]:
+        """allow_stale also returns expired entries not yet evicted (used while the LLM is unavailable)."""
+        normalized = normalize_query(query)
+        now = 0.0 if allow_stale else time.time()
+        with self._lock:
+            key = (persona, version, normalized)
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return copy.deepcopy(entry[2])
+
+            vec = _vector(normalized)
+            best_key, best_score = None, self.threshold
+            for other_key, (expires_at, other_vec, _) in self._entries.items():
+                if other_key[0] != persona or other_key[1] != version or expires_at <= now:
+                    continue
+                score = _cosine(vec, other_vec)
+                if score >= best_score:
+                    best_key, best_score = other_key, score
+            if best_key:
+                self._entries.move_to_end(best_key)
+                self.near_hits += 1
+                return copy.deepcopy(self._entries[best_key][2])
+
+            self.misses += 1
+            return None
+
+    def put(self, query: str, persona: str, version: str, payload: dict):
+        normalized = normalize_query(query)
+        with self._lock:
+            key = (persona, version, normalized)
+            self._entries[key] = (time.time() + self.ttl, _vector(normalized), copy.deepcopy(payload))
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def _evict(self):
+        now = time.time()
+        for key in [k for k, (expires_at, _, _) in self._entries.items() if expires_at <= now]:
+            del self._entries[key]
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "hits": self.hits, "near_hits": self.near_hits, "misses": self.misses}
+
+
+answer_cache = AnswerCache()
@@ -0,0 +1,32 @@
+import os
+import asyncio
+from typing import Callable
+
+# Max concurrent calls per upstream / resource. Requests beyond the limit wait their turn
+# instead of piling up threads or tripping upstream rate limits.
+LIMITS = {
+    "gemini": int(os.environ.get("GEMINI_CONCURRENCY", "8")),
+    "tts": int(os.environ.get("TTS_CONCURRENCY", "4")),
+    # CPU-bound PDF rasterization: more threads than cores only adds contention
+    "render": int(os.environ.get("RENDER_CONCURRENCY", str(os.cpu_count() or 2))),
+    # Cache / corpus setup before a Gemini call (usually instant, blocking on first load)
+    "setup": int(os.environ.get("SETUP_CONCURRENCY", "16")),
+    # SQLite job store / answer bank calls, which can wait on another process's write lock
+    "store": int(os.environ.get("STORE_CONCURRENCY", "8")),
+}
+
+_semaphores = {}
+
+
+def upstream(name: str) -> asyncio.Semaphore:
+    """Returns the semaphore bounding concurrent work against one upstream or resource."""
+    sem = _semaphores.get(name)
+    if sem is None:
+        sem = _semaphores[name] = asyncio.Semaphore(LIMITS.get(name, 4))
+    return sem
+
+
+async def run_blocking(name: str, fn: Callable, *args, **kwargs):
+    """Runs a blocking function in a worker thread under the named concurrency limit."""
+    async with upstream(name):
+        return await asyncio.to_thread(fn, *args, **kwargs)
@@ -0,0 +1,224 @@
+import os
+import time
+import datetime
+import threading
+from typing import Callable, Optional
+
+CACHE_MODEL = os.environ.get("GEMINI_CACHE_MODEL", "models/gemini-2.0-flash-001")
+CACHE_TTL_SECONDS = int(os.environ.get("GEMINI_CACHE_TTL", "3600"))
+# Refresh this long before the TTL runs out so requests never hit an expired cache
+REFRESH_MARGIN_SECONDS = int(os.environ.get("GEMINI_CACHE_REFRESH_MARGIN", "300"))
+# After a failed creation, requests use the uncached path for this long before trying again
+RETRY_AFTER_SECONDS = int(os.environ.get("GEMINI_CACHE_RETRY_AFTER", "120"))
+# CachedContent.create/update take no request timeout, so they are abandoned after this long
+# (defaults to the LLM client's deadline); a cache created after the deadline is deleted
+CACHE_CALL_DEADLINE = float(os.environ.get("GEMINI_CACHE_DEADLINE", os.environ.get("LLM_DEADLINE", "60")))
+SYSTEM_INSTRUCTION = "You are a helpful technical support assistant for Canon TS6330."
+
+
+class GeminiContextCache:
+    """
+    Manages one Gemini CachedContent holding the manual text.
+
+    - The first callers wait on a single creation instead of each creating a cache.
+    - A timer refreshes the TTL (or recreates the cache) before it expires.
+    - invalidate() drops the cache when the corpus changes; creations started for the old
+      corpus are discarded.
+    - Any failure returns None so callers take the uncached path, and creation is not
+      retried for RETRY_AFTER_SECONDS. A create or update call that exceeds the deadline
+      counts as a failure.
+
+    client is the google.generativeai module or any object with the same
+    caching.CachedContent.create / GenerativeModel.from_cached_content surface, so it can be
+    exercised against a local fake.
+    """
+
+    def __init__(self, client, contents_fn: Callable[[], str], model: str = CACHE_MODEL,
+                 ttl_seconds: int = CACHE_TTL_SECONDS, refresh_margin: int = REFRESH_MARGIN_SECONDS,
+                 retry_after: int = RETRY_AFTER_SECONDS, deadline: float = CACHE_CALL_DEADLINE,
+                 clock: Callable[[], float] = time.time):
+        self.client = client
+        self.contents_fn = contents_fn
+        self.model = model
+        self.ttl_seconds = ttl_seconds
+        self.refresh_margin = min(refresh_margin, ttl_seconds // 2)
+        self.retry_after = retry_after
+        self.deadline = deadline
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._cache = None
+        self._expiry = 0.0
+        self._generation = 0
+        self._creating: Optional[threading.Event] = None
+        self._retry_at = 0.0
+        self._timer: Optional[threading.Timer] = None
+        self.last_error: Optional[str] = None
+        self._model = None  # (cache, GenerativeModel bound to it)
+
+    def is_valid(self) -> bool:
+        return self._cache is not None and self.clock() < self._expiry
+
+    def get(self, wait_timeout: float = 30.0):
+        """Returns a live CachedContent, creating it if needed, or None to signal the uncached path."""
+        with self._lock:
+            if self.is_valid():
+                return self._cache
+            if self.clock() < self._retry_at:
+                return None
+            if self._creating is None:
+                self._creating = threading.Event()
+                owner = True
+            else:
+                owner = False
+            event = self._creating
+            generation = self._generation
+
+        if owner:
+            self._create(generation, event)
+        elif not event.wait(wait_timeout):
+            print("DEBUG: Timed out waiting for Gemini context cache creation")
+            return None
+
+        with self._lock:
+            return self._cache if self.is_valid() else None
+
+    def _create(self, generation: int, event: threading.Event):
+        try:
+            contents = self.contents_fn()
+            if not contents:
+                raise ValueError("manual context is empty")
+            cache = self._with_deadline(
+                "creation",
+                lambda: self.client.caching.CachedContent.create(
+                    model=self.model,
+                    display_name="manual_cache",
+                    system_instruction=SYSTEM_INSTRUCTION,
+                    contents=[contents],
+                    ttl=datetime.timedelta(seconds=self.ttl_seconds),
+                ),
+            )
+        except Exception as e:
+            print(f"Error creating cache: {e}")
+            with self._lock:
+                self.last_error = str(e)
+                self._retry_at = self.clock() + self.retry_after
+                if self._creating is event:
+                    self._creating = None
+            event.set()
+            return
+
+        stale = None
+        with self._lock:
+            if generation == self._generation:
+                stale = self._cache
+                self._cache = cache
+                self._expiry = self.clock() + self.ttl_seconds
+                self.last_error = None
+                self._schedule_refresh()
+                print(f"Cache created: {getattr(cache, 'name', cache)}")
+            else:
+                # The corpus changed while we were uploading it
+                stale = cache
+            if self._creating is event:
+                self._creating = None
+        event.set()
+        self._delete(stale)
+
+    def _with_deadline(self, what: str, fn: Callable):
+        """
+        Runs fn in a daemon thread and returns its result, raising TimeoutError after
+        self.deadline. A result that arrives after the deadline is deleted.
+        """
+        lock = threading.Lock()
+        done = threading.Event()
+        outcome = {}
+
+        def run():
+            try:
+                outcome["result"] = fn()
+            except Exception as e:
+                outcome["error"] = e
+            with lock:
+                done.set()
+                abandoned = outcome.get("abandoned", False)
+            if abandoned:
+                self._delete(outcome.get("result"))
+
+        threading.Thread(target=run, daemon=True).start()
+        done.wait(self.deadline)
+        with lock:
+            if not done.is_set():
+                outcome["abandoned"] = True
+                raise TimeoutError(f"context cache {what} exceeded {self.deadline:g}s")
+        if "error" in outcome:
+            raise outcome["error"]
+        return outcome["result"]
+
+    def _schedule_refresh(self):
+        if self._timer:
+            self._timer.cancel()
+        delay = max(self.ttl_seconds - self.refresh_margin, 1)
+        self._timer = threading.Timer(delay, self._refresh, args=(self._generation,))
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _refresh(self, generation: int):
+        """Extends the TTL of the live cache, recreating it if the update is rejected."""
+        with self._lock:
+            cache = self._cache
+            if cache is None or generation != self._generation:
+                return
+        try:
+            self._with_deadline("TTL update", lambda: cache.update(ttl=datetime.timedelta(seconds=self.ttl_seconds)))
+            with self._lock:
+                if generation == self._generation:
+                    self._expiry = self.clock() + self.ttl_seconds
+                    self._schedule_refresh()
+            print("DEBUG: Gemini context cache TTL refreshed")
+        except Exception as e:
+            print(f"DEBUG: Cache TTL refresh failed ({e}), recreating")
+            with self._lock:
+                if self._creating is not None or generation != self._generation:
+                    return
+                self._creating = event = threading.Event()
+            self._create(generation, event)
+
+    def invalidate(self):
+        """Drops the current cache, e.g. after the manuals changed."""
+        with self._lock:
+            self._generation += 1
+            stale = self._cache
+            self._cache = None
+            self._expiry = 0.0
+            self._retry_at = 0.0
+            self._creating = None
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+        self._delete(stale)
+
+    def _delete(self, cache):
+        if cache is None:
+            return
+        try:
+            cache.delete()
+        except Exception as e:
+            print(f"DEBUG: Failed to delete stale context cache: {e}")
+
+    def model_for(self, cache):
+        """GenerativeModel bound to cache, reused until the cache is replaced."""
+        with self._lock:
+            if self._model is not None and self._model[0] is cache:
+                return self._model[1]
+        model = self.client.GenerativeModel.from_cached_content(cached_content=cache)
+        with self._lock:
+            self._model = (cache, model)
+        return model
+
+    def status(self) -> dict:
+        return {
+            "is_valid": self.is_valid(),
+            "expires_in": max(0, int(self._expiry - self.clock())) if self._cache else 0,
+            "creating": self._creating is not None,
+            "last_error": self.last_error,
+        }
@@ -0,0 +1,70 @@
+import os
+import hashlib
+from collections import defaultdict
+from typing import Optional
+
+from .retrieval import normalize_text
+
+SIMHASH_BITS = 64
+# Pages whose fingerprints differ in at most this many bits are treated as the same page
+MAX_HAMMING = int(os.environ.get("DEDUP_MAX_HAMMING", "3"))
+# Very short pages (blank pages, section dividers) are never deduplicated
+MIN_PAGE_CHARS = 40
+
+_BANDS = 4
+_BAND_BITS = SIMHASH_BITS // _BANDS
+
+
+def simhash(text: str, ngram: int = 3) -> int:
+    """64-bit SimHash over character n-grams of the width-folded, whitespace-free text."""
+    text = "".join(normalize_text(text).split())
+    if len(text) < ngram:
+        return 0
+    weights = [0] * SIMHASH_BITS
+    for gram in {text[i:i + ngram] for i in range(len(text) - ngram + 1)}:
+        h = int.from_bytes(hashlib.blake2b(gram.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(SIMHASH_BITS):
+            weights[bit] += 1 if (h >> bit) & 1 else -1
+    fingerprint = 0
+    for bit, w in enumerate(weights):
+        if w > 0:
+            fingerprint |= 1 << bit
+    return fingerprint
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class PageDeduplicator:
+    """
+    Finds near-duplicate pages by SimHash distance.
+    Fingerprints are split into bands so a lookup only compares against pages that share
+    at least one band exactly (guaranteed for distances below the band count).
+    """
+
+    def __init__(self, max_distance: int = MAX_HAMMING):
+        self.max_distance = max_distance
+        self._bands = [defaultdict(list) for _ in range(_BANDS)]  # band key -> [(fingerprint, key, group)]
+
+    def _band_keys(self, fingerprint: int):
+        mask = (1 << _BAND_BITS) - 1
+        return [(fingerprint >> (i * _BAND_BITS)) & mask for i in range(_BANDS)]
+
+    def check_and_add(self, key, fingerprint: int, chars: int, group=None) -> Optional[tuple]:
+        """
+        Returns the key of an earlier near-duplicate page, or registers this page and returns None.
+        With group set (e.g. the source file), pages of the same group never count as duplicates.
+        """
+        if chars < MIN_PAGE_CHARS:
+            return None
+        band_keys = self._band_keys(fingerprint)
+        for band, band_key in zip(self._bands, band_keys):
+            for other_fp, other_key, other_group in band.get(band_key, ()):
+                if group is not None and other_group == group:
+                    continue
+                if hamming(fingerprint, other_fp) <= self.max_distance:
+                    return other_key
+        for band, band_key in zip(self._bands, band_keys):
+            band[band_key].append((fingerprint, key, group))
+        return None
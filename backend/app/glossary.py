@@ -0,0 +1,184 @@
+import os
+import re
+import json
+import time
+import threading
+import unicodedata
+from collections import Counter
+from typing import Iterable, Iterator, List, Tuple
+
+from .answer_cache import normalize_query
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Manual term -> plain-language phrases users type; editable, reloaded when the file changes
+SYNONYMS_PATH = os.environ.get("GLOSSARY_SYNONYMS_PATH", os.path.join(BASE_DIR, "..", "synonyms.json"))
+SYNONYMS_CHECK_INTERVAL = 5.0
+# Terms added to one query at most
+MAX_EXPANSIONS = int(os.environ.get("QUERY_MAX_EXPANSIONS", "8"))
+# Longest corpus term (in folded characters) looked up inside a query
+MAX_TERM_CHARS = 16
+
+# Katakana words, kanji compounds and latin words, matched on NFKC-folded lowercase text
+_TERM_RE = re.compile(r"[ァ-ヺー・]{2,}|[一-鿿々〆]{2,}|[a-z][a-z0-9\-]+")
+_VU_SOUNDS = (("ヴァ", "バ"), ("ヴィ", "ビ"), ("ヴェ", "ベ"), ("ヴォ", "ボ"), ("ヴ", "ブ"))
+
+
+def fold_term(text: str) -> str:
+    """
+    Spelling-insensitive key for a term: full/half width, case, katakana/hiragana,
+    long vowel marks (プリンター = プリンタ), middle dots, ヴ sounds, spaces and punctuation.
+    """
+    text = unicodedata.normalize("NFKC", text)
+    for vu, plain in _VU_SOUNDS:
+        text = text.replace(vu, plain)
+    return normalize_query(text)
+
+
+def _is_ascii_word(text: str, start: int, end: int) -> bool:
+    """True if text[start:end] is not glued to other latin letters or digits."""
+    before = text[start - 1] if start else " "
+    after = text[end] if end < len(text) else " "
+    return not (before.isascii() and before.isalnum()) and not (after.isascii() and after.isalnum())
+
+
+class Glossary:
+    """
+    Vocabulary of the manuals, built at ingest alongside the retrieval index, plus the
+    user-editable synonym table. expand() maps a colloquial query onto the manuals' own terms
+    (synonyms, then spelling variants of the query's words) with dictionary lookups only,
+    so it costs microseconds and no LLM call.
+    """
+
+    def __init__(self, synonyms_path: str = SYNONYMS_PATH):
+        self.synonyms_path = synonyms_path
+        self._lock = threading.Lock()
+        self._source_counts = {}  # source -> Counter(term)
+        self.term_counts = Counter()
+        self._by_key = {}  # folded term -> most frequent spelling in the manuals
+        self._synonyms = {}  # folded phrase -> [manual terms]
+        self._synonym_re = None
+        self._synonyms_mtime = None
+        self._checked_at = 0.0
+        self.expansions = 0
+        self.expanded_queries = 0
+        self._expand_seconds = 0.0
+
+    def tap(self, source: str, pages: Iterable[Tuple[int, str]]) -> Iterator[Tuple[int, str]]:
+        """
+        Passes (page_num, text) through unchanged while counting the terms of source, so the
+        glossary is built from the same page stream as the index. Replaces the source's
+        terms once the stream is exhausted.
+        """
+        counts = Counter()
+        for page_num, text in pages:
+            counts.update(_TERM_RE.findall(unicodedata.normalize("NFKC", text).lower()))
+            yield page_num, text
+        with self._lock:
+            self._source_counts[source] = counts
+            self._rebuild()
+
+    def remove_source(self, source: str):
+        with self._lock:
+            if self._source_counts.pop(source, None) is not None:
+                self._rebuild()
+
+    def _rebuild(self):
+        total = Counter()
+        for counts in self._source_counts.values():
+            total.update(counts)
+        by_key = {}
+        for term, _ in total.most_common():
+            key = fold_term(term)
+            if len(key) >= 2:
+                by_key.setdefault(key, term)
+        self.term_counts = total
+        self._by_key = by_key
+
+    def _load_synonyms(self):
+        """Reloads the synonym table if the file changed (checked every few seconds)."""
+        now = time.monotonic()
+        if now - self._checked_at < SYNONYMS_CHECK_INTERVAL:
+            return
+        self._checked_at = now
+        try:
+            mtime = os.path.getmtime(self.synonyms_path)
+        except OSError:
+            mtime = None
+        if mtime == self._synonyms_mtime:
+            return
+        synonyms = {}
+        if mtime is not None:
+            try:
+                with open(self.synonyms_path, encoding="utf-8") as f:
+                    table = json.load(f)
+                for term, phrases in table.items():
+                    if term.startswith("_"):
+                        continue
+                    for phrase in [term, *phrases]:
+                        key = fold_term(phrase)
+                        if key and term not in synonyms.setdefault(key, []):
+                            synonyms[key].append(term)
+                print(f"DEBUG: Loaded {len(synonyms)} synonym phrases from {self.synonyms_path}")
+            except Exception as e:
+                print(f"DEBUG: Failed to load synonyms from {self.synonyms_path}: {e}")
+                return
+        pattern = "|".join(re.escape(k) for k in sorted(synonyms, key=len, reverse=True))
+        with self._lock:
+            self._synonyms = synonyms
+            self._synonym_re = re.compile(pattern) if pattern else None
+            self._synonyms_mtime = mtime
+
+    def expand(self, query: str) -> List[str]:
+        """Manual terms related to the query that it does not already contain, best first."""
+        started = time.perf_counter()
+        self._load_synonyms()
+        normalized = unicodedata.normalize("NFKC", query).lower()
+        folded = fold_term(query)
+        with self._lock:
+            synonym_re, synonyms, by_key = self._synonym_re, self._synonyms, self._by_key
+
+        terms = []
+        if synonym_re:
+            for match in synonym_re.finditer(folded):
+                for term in synonyms[match.group()]:
+                    # Prefer the spelling the manuals actually use
+                    terms.append(by_key.get(fold_term(term), term))
+
+        # Corpus spellings of the query's own words, longest match first
+        i = 0
+        while i < len(folded):
+            for length in range(min(MAX_TERM_CHARS, len(folded) - i), 1, -1):
+                term = by_key.get(folded[i:i + length])
+                if term and (not term.isascii() or _is_ascii_word(folded, i, i + length)):
+                    terms.append(term)
+                    i += length
+                    break
+            else:
+                i += 1
+
+        expanded = []
+        for term in terms:
+            if term not in expanded and term.lower() not in normalized:
+                expanded.append(term)
+        expanded = expanded[:MAX_EXPANSIONS]
+
+        self.expanded_queries += 1
+        self.expansions += len(expanded)
+        self._expand_seconds += time.perf_counter() - started
+        return expanded
+
+    def expand_query(self, query: str) -> str:
+        """The query with its expansion terms appended, for retrieval."""
+        terms = self.expand(query)
+        return f"{query} {' '.join(terms)}" if terms else query
+
+    def stats(self) -> dict:
+        return {
+            "terms": len(self.term_counts),
+            "sources": len(self._source_counts),
+            "synonym_phrases": len(self._synonyms),
+            "expanded_queries": self.expanded_queries,
+            "avg_expansions": round(self.expansions / self.expanded_queries, 2) if self.expanded_queries else 0.0,
+            "avg_expand_us": round(self._expand_seconds / self.expanded_queries * 1e6, 1) if self.expanded_queries else 0.0,
+            "top_terms": self.term_counts.most_common(20),
+        }
@@ -1,35 +1,188 @@
-
 import os
 import fitz  # PyMuPDF
-import base64
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 from io import BytesIO
+from typing import List, Optional
+from urllib.parse import quote
 from PIL import Image
 
-def extract_page_as_base64(pdf_path: str, page_num: int, dpi: int = 150) -> str:
+from .manual_store import get_manual_store
+from .page_cache import get_page_cache
+from .regions import tile_dpi
+
+IMAGE_FORMATS = ("png", "webp")
+POOL_SIZE = int(os.environ.get("PDF_POOL_SIZE", "8"))
+
+class DocumentPool:
     """
-    Extracts a specific page from a PDF and returns it as a base64 encoded PNG.
-    page_num is 1-indexed.
+    Bounded LRU pool of open fitz.Document handles keyed by (path, mtime).
+    Re-opening a large manual re-parses its xref on every render; a pooled handle only
+    pays for rasterization. PyMuPDF documents are not safe for concurrent use, so each
+    handle is locked while borrowed. Handles evicted while borrowed are closed on release.
     """
-    try:
-        if not os.path.exists(pdf_path):
-            return ""
-            
-        doc = fitz.open(pdf_path)
+
+    def __init__(self, max_docs: int = POOL_SIZE):
+        self.max_docs = max_docs
+        self._entries = OrderedDict()  # (path, mtime_ns) -> entry dict
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def open(self, pdf_path: str):
+        key = (os.path.abspath(pdf_path), os.stat(pdf_path).st_mtime_ns)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = {"doc": None, "lock": threading.Lock(), "users": 0, "evicted": False}
+                self._entries[key] = entry
+                self._evict()
+            self._entries.move_to_end(key)
+            entry["users"] += 1
+
+        try:
+            with entry["lock"]:
+                if entry["doc"] is None:
+                    entry["doc"] = fitz.open(pdf_path)
+                yield entry["doc"]
+        finally:
+            with self._lock:
+                entry["users"] -= 1
+                close = entry["evicted"] and entry["users"] == 0
+            if close:
+                self._close(entry)
+
+    def _evict(self):
+        while len(self._entries) > self.max_docs:
+            _, entry = self._entries.popitem(last=False)
+            self._retire(entry)
+
+    def _retire(self, entry: dict):
+        entry["evicted"] = True
+        if entry["users"] == 0:
+            self._close(entry)
+
+    def _close(self, entry: dict):
+        with entry["lock"]:
+            if entry["doc"] is not None:
+                entry["doc"].close()
+                entry["doc"] = None
+
+    def invalidate(self, pdf_path: Optional[str] = None):
+        """Closes pooled handles for one manual, or for all manuals (e.g. after an upload or ingest)."""
+        path = os.path.abspath(pdf_path) if pdf_path else None
+        with self._lock:
+            for key in [k for k in self._entries if path is None or k[0] == path]:
+                self._retire(self._entries.pop(key))
+
+document_pool = DocumentPool()
+
+def render_page_image(pdf_path: str, page_num: int, dpi: int = 150, fmt: str = "png",
+                      clip: Optional[list] = None) -> bytes:
+    """
+    Rasterizes one page (1-indexed) and encodes it as PNG or WebP.
+    clip is an [x0, y0, x1, y1, ...] box in PDF points; only that area is rasterized.
+    Returns b"" if the file or page does not exist.
+    """
+    if not os.path.exists(pdf_path):
+        return b""
+
+    with document_pool.open(pdf_path) as doc:
         # fitz is 0-indexed
         if page_num < 1 or page_num > len(doc):
-            return ""
-            
+            return b""
+
         page = doc.load_page(page_num - 1)
-        pix = page.get_pixmap(matrix=fitz.Matrix(dpi/72, dpi/72))
-        
-        # Convert pixmap to image and then to base64
-        img_data = pix.tobytes("png")
-        base64_str = base64.b64encode(img_data).decode('utf-8')
-        doc.close()
-        return base64_str
+        pix = page.get_pixmap(matrix=fitz.Matrix(dpi/72, dpi/72), clip=fitz.Rect(clip[:4]) if clip else None)
+        if fmt == "png":
+            return pix.tobytes("png")
+
+        # WebP via Pillow: typically much smaller than PNG for scanned manual pages
+        img = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+        buf = BytesIO()
+        img.save(buf, format="WEBP", quality=80, method=4)
+        return buf.getvalue()
+
+def get_page_regions(pdf_path: str, page_num: int) -> List[list]:
+    """
+    Diagram regions ([x0, y0, x1, y1, kind], largest first) of a page, as detected at ingest
+    and read from the manual store. Empty for pages that are not stored.
+    """
+    content_hash = get_page_cache().manual_hash(pdf_path)
+    return get_manual_store().get_regions(content_hash, page_num) or []
+
+def visual_tile(pdf_path: str, page_num: int, dpi: int = 150) -> tuple:
+    """
+    Picks what to show for a referenced page: (region index, dpi) of its largest diagram,
+    rendered at a resolution matched to the crop, or (None, dpi) for the full page.
+    """
+    try:
+        regions = get_page_regions(pdf_path, page_num)
+    except Exception as e:
+        print(f"DEBUG: Region lookup failed for page {page_num}: {e}")
+        regions = []
+    if not regions:
+        return None, dpi
+    return 0, tile_dpi(regions[0])
+
+def get_page_image(pdf_path: str, page_num: int, dpi: int = 150, fmt: str = "png",
+                   region: Optional[int] = None) -> bytes:
+    """
+    Returns the encoded page image, served from the render cache when available.
+    With region set, only that detected diagram region is rendered.
+    """
+    if fmt not in IMAGE_FORMATS:
+        raise ValueError(f"Unsupported image format: {fmt}")
+    if not os.path.exists(pdf_path):
+        return b""
+    clip = None
+    if region is not None:
+        regions = get_page_regions(pdf_path, page_num)
+        if not 0 <= region < len(regions):
+            return b""
+        clip = regions[region]
+    return get_page_cache().get_or_render(
+        pdf_path, page_num, dpi, fmt, lambda: render_page_image(pdf_path, page_num, dpi, fmt, clip), region
+    )
+
+def prewarm_page_cache(manuals_dir: str, top_n: int, dpi: int = 150, fmt: str = "png") -> int:
+    """
+    Renders the most frequently referenced pages of the current manuals into the cache,
+    as the same tiles diagnosis responses link to. Returns the number of pages warmed.
+    """
+    cache = get_page_cache()
+    warmed = 0
+    for source, page_num in cache.top_references(top_n):
+        if prerender_page(os.path.join(manuals_dir, source), page_num, dpi, fmt):
+            warmed += 1
+    cache.flush_references()
+    return warmed
+
+def prerender_page(pdf_path: str, page_num: int, dpi: int = 150, fmt: str = "png") -> bool:
+    """Renders the tile a diagnosis response links to for this page into the cache."""
+    try:
+        if not os.path.exists(pdf_path):
+            return False
+        region, tile = visual_tile(pdf_path, page_num, dpi)
+        return bool(get_page_image(pdf_path, page_num, tile, fmt, region))
     except Exception as e:
-        print(f"Error extracting PDF page: {e}")
-        return ""
+        print(f"DEBUG: Failed to pre-render {os.path.basename(pdf_path)} page {page_num}: {e}")
+        return False
+
+def page_image_url(manual_name: str, page_num: int, dpi: int = 150, fmt: str = "webp",
+                   region: Optional[int] = None) -> str:
+    """
+    URL of a rendered page (or one of its diagram regions) on the /api/pages endpoint.
+    The v parameter pins the manual's content hash, so browsers and CDNs can cache it forever.
+    """
+    version = get_page_cache().manual_hash(get_manual_path(manual_name))[:16]
+    crop = "" if region is None else f"&region={region}"
+    return f"/api/pages/{quote(manual_name)}/{page_num}.{fmt}?dpi={dpi}{crop}&v={version}"
+
+def visual_page_url(manual_name: str, page_num: int, fmt: str = "webp") -> str:
+    """URL of the tile chosen by visual_tile: the page's main diagram, or the whole page."""
+    region, dpi = visual_tile(get_manual_path(manual_name), page_num)
+    return page_image_url(manual_name, page_num, dpi, fmt, region)
 
 def get_manual_path(manual_name: str) -> str:
     """Helper to get absolute path of a manual."""
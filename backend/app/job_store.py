@@ -0,0 +1,238 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import threading
+from contextlib import closing
+from typing import Optional
+
+from .manual_store import DB_DIR
+
+JOB_STORE_PATH = os.environ.get("VIDEO_JOB_STORE_PATH", os.path.join(DB_DIR, "video_jobs.sqlite"))
+VIDEO_JOB_TTL = int(os.environ.get("VIDEO_JOB_TTL", str(24 * 3600)))
+VIDEO_JOB_MAX = int(os.environ.get("VIDEO_JOB_MAX", "1000"))
+# A job still running after this long was lost (e.g. its worker restarted) and is reported as failed
+VIDEO_JOB_TIMEOUT = int(os.environ.get("VIDEO_JOB_TIMEOUT", "600"))
+# How often a request waiting on another worker's job re-reads its status
+VIDEO_JOB_POLL_INTERVAL = float(os.environ.get("VIDEO_JOB_POLL_INTERVAL", "0.5"))
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+_HOST = socket.gethostname()
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS video_jobs (
+    request_id TEXT PRIMARY KEY,
+    cache_key TEXT NOT NULL,
+    query TEXT NOT NULL,
+    persona TEXT NOT NULL,
+    status TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    owner TEXT
+);
+CREATE INDEX IF NOT EXISTS video_jobs_key ON video_jobs (cache_key, status, updated_at);
+CREATE INDEX IF NOT EXISTS video_jobs_created ON video_jobs (created_at);
+"""
+
+
+def video_cache_key(query: str, persona: str) -> str:
+    return f"{query}_{persona}"
+
+
+def process_owner() -> str:
+    """host:pid of this process, recorded on the jobs it runs."""
+    return f"{_HOST}:{os.getpid()}"
+
+
+def _owner_alive(owner: str) -> bool:
+    """True if owner is another live process on this host; jobs of earlier incarnations are dead."""
+    host, _, pid = owner.rpartition(":")
+    if host != _HOST or not pid.isdigit() or int(pid) == os.getpid():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class VideoJobStore:
+    """
+    SQLite store of background video jobs keyed by request_id.
+    Finished jobs double as the video cache (latest done job per query/persona). Rows expire
+    after VIDEO_JOB_TTL and the table is trimmed to VIDEO_JOB_MAX rows, so it stays bounded,
+    survives restarts and is shared by every uvicorn worker.
+    Active jobs record the process running them (owner), so jobs left behind by a process that
+    died can be failed at startup instead of being waited on until VIDEO_JOB_TIMEOUT.
+    """
+
+    def __init__(self, path: str = JOB_STORE_PATH, ttl: int = VIDEO_JOB_TTL, max_jobs: int = VIDEO_JOB_MAX,
+                 timeout: int = VIDEO_JOB_TIMEOUT):
+        self.path = path
+        self.ttl = ttl
+        self.max_jobs = max_jobs
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.executescript(_SCHEMA)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def create(self, request_id: str, query: str, persona: str, status: str = QUEUED,
+               result: Optional[dict] = None, owned: bool = False):
+        """owned: the job runs in this process (local task queue) rather than in app.worker."""
+        now = time.time()
+        with self._lock, closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO video_jobs (request_id, cache_key, query, persona, status, result, "
+                "created_at, updated_at, owner) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (request_id, video_cache_key(query, persona), query, persona, status,
+                 json.dumps(result, ensure_ascii=False) if result is not None else None, now, now,
+                 process_owner() if owned else None),
+            )
+            self._evict(conn, now)
+
+    def _update(self, request_id: str, status: str, result: Optional[dict] = None, error: Optional[str] = None):
+        with self._lock, closing(self._connect()) as conn, conn:
+            conn.execute(
+                "UPDATE video_jobs SET status = ?, result = ?, error = ?, updated_at = ? WHERE request_id = ?",
+                (status, json.dumps(result, ensure_ascii=False) if result is not None else None, error,
+                 time.time(), request_id),
+            )
+
+    def mark_running(self, request_id: str):
+        self._update(request_id, RUNNING)
+
+    def complete(self, request_id: str, result: dict):
+        self._update(request_id, DONE, result=result)
+
+    def fail(self, request_id: str, error: str):
+        self._update(request_id, FAILED, error=error)
+
+    def get(self, request_id: str) -> Optional[dict]:
+        """Returns {"request_id", "status", "error", "result", ...} or None if unknown or expired."""
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT request_id, query, persona, status, result, error, created_at, updated_at "
+                "FROM video_jobs WHERE request_id = ? AND created_at > ?",
+                (request_id, time.time() - self.ttl),
+            ).fetchone()
+        if not row:
+            return None
+        job = dict(zip(("request_id", "query", "persona", "status", "result", "error", "created_at", "updated_at"), row))
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        if job["status"] in (QUEUED, RUNNING) and time.time() - job["updated_at"] > self.timeout:
+            job["status"], job["error"] = FAILED, "timed out"
+        return job
+
+    def find_done(self, query: str, persona: str) -> Optional[dict]:
+        """Result of the most recent finished job for this query and persona, if not expired."""
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT result FROM video_jobs WHERE cache_key = ? AND status = ? AND created_at > ? "
+                "ORDER BY updated_at DESC LIMIT 1",
+                (video_cache_key(query, persona), DONE, time.time() - self.ttl),
+            ).fetchone()
+        return json.loads(row[0]) if row and row[0] else None
+
+    def find_active(self, query: str, persona: str) -> Optional[str]:
+        """request_id of a queued or running job for this query and persona that has not timed out."""
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT request_id FROM video_jobs WHERE cache_key = ? AND status IN (?, ?) AND updated_at > ? "
+                "ORDER BY created_at LIMIT 1",
+                (video_cache_key(query, persona), QUEUED, RUNNING, time.time() - self.timeout),
+            ).fetchone()
+        return row[0] if row else None
+
+    def claim_next(self) -> Optional[dict]:
+        """Atomically moves the oldest queued job to running and returns it (for app.worker)."""
+        with self._lock, closing(self._connect()) as conn:
+            conn.isolation_level = None
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT request_id, query, persona FROM video_jobs WHERE status = ? AND created_at > ? "
+                    "ORDER BY created_at LIMIT 1",
+                    (QUEUED, time.time() - self.ttl),
+                ).fetchone()
+                if row:
+                    conn.execute(
+                        "UPDATE video_jobs SET status = ?, updated_at = ?, owner = ? WHERE request_id = ?",
+                        (RUNNING, time.time(), process_owner(), row[0]),
+                    )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return dict(zip(("request_id", "query", "persona"), row)) if row else None
+
+    def fail_orphans(self) -> int:
+        """
+        Startup check: marks queued and running jobs whose owning process is gone as failed
+        (jobs under this process's own pid belong to an earlier incarnation). Queued jobs without
+        an owner wait for app.worker. Returns the number of jobs failed.
+        """
+        with self._lock, closing(self._connect()) as conn, conn:
+            rows = conn.execute(
+                "SELECT request_id, owner FROM video_jobs WHERE status IN (?, ?)", (QUEUED, RUNNING)
+            ).fetchall()
+            orphans = [request_id for request_id, owner in rows if owner is not None and not _owner_alive(owner)]
+            conn.executemany(
+                "UPDATE video_jobs SET status = ?, error = ?, updated_at = ? WHERE request_id = ?",
+                [(FAILED, "worker restarted", time.time(), request_id) for request_id in orphans],
+            )
+        if orphans:
+            print(f"DEBUG: Failed {len(orphans)} video jobs left behind by a stopped process", flush=True)
+        return len(orphans)
+
+    def count(self, status: str) -> int:
+        with closing(self._connect()) as conn:
+            return conn.execute(
+                "SELECT COUNT(*) FROM video_jobs WHERE status = ? AND updated_at > ?",
+                (status, time.time() - self.timeout),
+            ).fetchone()[0]
+
+    def top_queries(self, limit: int, min_count: int = 1) -> list:
+        """Most frequent (query, persona, count) among unexpired jobs, i.e. recent /api/diagnose traffic."""
+        with closing(self._connect()) as conn:
+            return conn.execute(
+                "SELECT query, persona, COUNT(*) AS n FROM video_jobs WHERE created_at > ? "
+                "GROUP BY query, persona HAVING n >= ? ORDER BY n DESC LIMIT ?",
+                (time.time() - self.ttl, min_count, limit),
+            ).fetchall()
+
+    def _evict(self, conn, now: float):
+        conn.execute("DELETE FROM video_jobs WHERE created_at <= ?", (now - self.ttl,))
+        conn.execute(
+            "DELETE FROM video_jobs WHERE request_id IN "
+            "(SELECT request_id FROM video_jobs ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_jobs,),
+        )
+
+    def stats(self) -> dict:
+        with closing(self._connect()) as conn:
+            rows = conn.execute("SELECT status, COUNT(*) FROM video_jobs GROUP BY status").fetchall()
+        return dict(rows)
+
+
+_job_store: Optional[VideoJobStore] = None
+
+
+def get_job_store() -> VideoJobStore:
+    global _job_store
+    if _job_store is None:
+        _job_store = VideoJobStore()
+        # Local jobs run inside the process that queued them: a restart orphans them for good
+        _job_store.fail_orphans()
+    return _job_store
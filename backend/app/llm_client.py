@@ -0,0 +1,417 @@
+import os
+import time
+import asyncio
+import threading
+from collections import deque
+from typing import Optional
+
+import google.generativeai as genai
+from tenacity import (
+    AsyncRetrying,
+    Retrying,
+    retry_if_exception,
+    stop_after_attempt,
+    stop_after_delay,
+    wait_random_exponential,
+)
+
+from .concurrency import upstream
+
+GEMINI_MODEL = os.environ.get("GEMINI_MODEL", "gemini-flash-latest")
+# Point the SDK at another endpoint, e.g. a local fake server in tests
+GEMINI_API_ENDPOINT = os.environ.get("GEMINI_API_ENDPOINT")
+GEMINI_TRANSPORT = os.environ.get("GEMINI_TRANSPORT")
+
+# Deadline for a whole call, retries included, and for a single attempt
+LLM_DEADLINE = float(os.environ.get("LLM_DEADLINE", "60"))
+LLM_ATTEMPT_TIMEOUT = float(os.environ.get("LLM_ATTEMPT_TIMEOUT", "30"))
+LLM_MAX_ATTEMPTS = int(os.environ.get("LLM_MAX_ATTEMPTS", "3"))
+LLM_BACKOFF = float(os.environ.get("LLM_BACKOFF", "0.5"))
+LLM_BACKOFF_MAX = float(os.environ.get("LLM_BACKOFF_MAX", "8"))
+# Hedging is off by default: a duplicate request doubles the Gemini cost of every slow call.
+# Set e.g. LLM_HEDGE_PERCENTILE=0.95 to re-send an attempt still running past the p95 latency
+# (measured once LLM_HEDGE_MIN_SAMPLES calls have succeeded); the first answer wins.
+LLM_HEDGE_PERCENTILE = float(os.environ.get("LLM_HEDGE_PERCENTILE", "0"))
+LLM_HEDGE_MIN_SAMPLES = int(os.environ.get("LLM_HEDGE_MIN_SAMPLES", "20"))
+# Consecutive upstream failures that open the circuit, and how long it stays open
+LLM_BREAKER_FAILURES = int(os.environ.get("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_COOLDOWN = float(os.environ.get("LLM_BREAKER_COOLDOWN", "30"))
+
+# HTTP statuses worth retrying: rate limiting and server-side failures
+_RETRYABLE_CODES = {408, 429, 500, 502, 503, 504}
+_LATENCY_SAMPLES = 200
+
+
+class UpstreamUnavailable(Exception):
+    """Gemini could not answer within the deadline and retry budget."""
+
+
+class CircuitOpenError(UpstreamUnavailable):
+    """Raised without calling Gemini while the circuit breaker is open."""
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """Timeouts, connection errors, 429 and 5xx (google.api_core errors carry the HTTP status as .code)."""
+    if isinstance(exc, (asyncio.TimeoutError, TimeoutError, ConnectionError)):
+        return True
+    code = getattr(exc, "code", None)
+    return isinstance(code, int) and code in _RETRYABLE_CODES
+
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive upstream failures; while open, calls fail fast.
+    After `cooldown` seconds one probe call is let through (half-open): success closes the
+    circuit, an upstream failure opens it again, and any other outcome (a 4xx, cancellation)
+    frees the probe slot for the next call.
+    """
+
+    def __init__(self, threshold: int = LLM_BREAKER_FAILURES, cooldown: float = LLM_BREAKER_COOLDOWN,
+                 clock=time.monotonic):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self._lock = threading.Lock()
+        self.state = "closed"
+        self.failures = 0
+        self.opened = 0
+        self._open_until = 0.0
+        self._probing = False
+
+    def check(self) -> bool:
+        """
+        Raises CircuitOpenError unless a call may go through now. Returns True if the call is
+        the half-open probe; the caller must then pass it to finish() when the call ends.
+        """
+        with self._lock:
+            if self.state == "closed":
+                return False
+            if self.state == "open" and self.clock() >= self._open_until:
+                self.state = "half_open"
+                self._probing = False
+            if self.state == "half_open" and not self._probing:
+                self._probing = True
+                return True
+            raise CircuitOpenError(f"Gemini circuit open ({self.failures} consecutive failures)")
+
+    def finish(self, probe: bool):
+        """Ends a call let through by check(); a probe that settled nothing frees the slot."""
+        if probe:
+            with self._lock:
+                self._probing = False
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.threshold:
+                if self.state != "open":
+                    self.opened += 1
+                    print(f"DEBUG: Gemini circuit opened after {self.failures} failures", flush=True)
+                self.state = "open"
+                self._open_until = self.clock() + self.cooldown
+                self._probing = False
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "opened": self.opened,
+                "retry_in": max(0.0, round(self._open_until - self.clock(), 1)) if self.state == "open" else 0.0,
+            }
+
+
+async def _next_chunk(chunks, deadline_at: float):
+    """Next chunk of a streamed response within the call deadline, or None at the end."""
+    try:
+        return await asyncio.wait_for(chunks.__anext__(), deadline_at - time.monotonic())
+    except StopAsyncIteration:
+        return None
+
+
+class LatencyTracker:
+    """Rolling window of successful attempt latencies, used to decide when to hedge."""
+
+    def __init__(self, percentile: float = LLM_HEDGE_PERCENTILE, min_samples: int = LLM_HEDGE_MIN_SAMPLES):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=_LATENCY_SAMPLES)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def quantile(self, q: float) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        return samples[min(int(len(samples) * q), len(samples) - 1)]
+
+    def hedge_delay(self) -> Optional[float]:
+        """Seconds to wait before hedging, or None while disabled or without enough samples."""
+        if not self.percentile or len(self._samples) < self.min_samples:
+            return None
+        return self.quantile(self.percentile)
+
+
+class LLMClient:
+    """
+    Shared Gemini client: configures the SDK once, reuses model objects, and wraps every call
+    with a deadline, jittered exponential retries on timeouts/429/5xx, optional hedging and a
+    circuit breaker. Exhausted retries and an open circuit raise UpstreamUnavailable, so callers
+    can answer from a cache or a degraded response instead.
+
+    client is the google.generativeai module or any object with the same configure /
+    GenerativeModel surface, so it can be exercised against a local fake.
+    """
+
+    def __init__(self, client=genai, max_attempts: int = LLM_MAX_ATTEMPTS, deadline: float = LLM_DEADLINE,
+                 attempt_timeout: float = LLM_ATTEMPT_TIMEOUT, backoff: float = LLM_BACKOFF,
+                 backoff_max: float = LLM_BACKOFF_MAX, breaker: Optional[CircuitBreaker] = None,
+                 latency: Optional[LatencyTracker] = None):
+        self.client = client
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.attempt_timeout = attempt_timeout
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.breaker = breaker or CircuitBreaker()
+        self.latency = latency or LatencyTracker()
+        self._lock = threading.Lock()
+        self._configured_key = None
+        self._models = {}
+        self.calls = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.failures = 0
+        self.rejected = 0
+
+    def configure(self) -> bool:
+        """Configures the SDK with GOOGLE_API_KEY (once per key); False if no key is set."""
+        api_key = os.environ.get("GOOGLE_API_KEY")
+        if not api_key:
+            return False
+        with self._lock:
+            if api_key != self._configured_key:
+                options = {}
+                if GEMINI_API_ENDPOINT:
+                    options["client_options"] = {"api_endpoint": GEMINI_API_ENDPOINT}
+                if GEMINI_TRANSPORT:
+                    options["transport"] = GEMINI_TRANSPORT
+                self.client.configure(api_key=api_key, **options)
+                self._configured_key = api_key
+                self._models.clear()
+        return True
+
+    def model(self, name: str = GEMINI_MODEL):
+        """Long-lived GenerativeModel for name (not tied to a context cache)."""
+        self.configure()
+        with self._lock:
+            model = self._models.get(name)
+            if model is None:
+                model = self._models[name] = self.client.GenerativeModel(name)
+            return model
+
+    def _retrying(self, cls, deadline: float):
+        return cls(
+            retry=retry_if_exception(is_retryable),
+            stop=stop_after_attempt(self.max_attempts) | stop_after_delay(deadline),
+            wait=wait_random_exponential(multiplier=self.backoff, max=self.backoff_max),
+            before_sleep=self._before_retry,
+            reraise=True,
+        )
+
+    def _before_retry(self, retry_state):
+        self.retries += 1
+        print(f"DEBUG: Gemini attempt {retry_state.attempt_number} failed "
+              f"({retry_state.outcome.exception()!r}), retrying", flush=True)
+
+    def _attempt_timeout(self, deadline_at: float, attempt_timeout: Optional[float]) -> float:
+        remaining = deadline_at - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError("Gemini call deadline exceeded")
+        return min(attempt_timeout or self.attempt_timeout, remaining)
+
+    def _failed(self, e: Exception):
+        if isinstance(e, CircuitOpenError):
+            self.rejected += 1
+            raise e
+        self.failures += 1
+        if is_retryable(e):
+            raise UpstreamUnavailable(f"Gemini unavailable: {e!r}") from e
+        raise e
+
+    def _record(self, e: Optional[BaseException], started: float = 0.0):
+        if e is None:
+            self.latency.record(time.monotonic() - started)
+            self.breaker.record_success()
+        elif is_retryable(e):
+            self.breaker.record_failure()
+
+    def generate(self, model, prompt, deadline: Optional[float] = None, attempt_timeout: Optional[float] = None,
+                 **kwargs):
+        """Blocking generate_content with deadline, retries and circuit breaker."""
+        deadline = deadline or self.deadline
+        deadline_at = time.monotonic() + deadline
+        self.calls += 1
+        try:
+            for attempt in self._retrying(Retrying, deadline):
+                with attempt:
+                    probe = self.breaker.check()
+                    try:
+                        timeout = self._attempt_timeout(deadline_at, attempt_timeout)
+                        started = time.monotonic()
+                        try:
+                            response = model.generate_content(
+                                prompt, request_options={"timeout": timeout, "retry": None}, **kwargs
+                            )
+                        except Exception as e:
+                            self._record(e)
+                            raise
+                        self._record(None, started)
+                        return response
+                    finally:
+                        self.breaker.finish(probe)
+        except Exception as e:
+            self._failed(e)
+
+    async def _attempt_async(self, model, prompt, timeout: float, kwargs: dict):
+        async with upstream("gemini"):
+            started = time.monotonic()
+            try:
+                response = await asyncio.wait_for(
+                    model.generate_content_async(prompt, request_options={"timeout": timeout, "retry": None}, **kwargs),
+                    timeout,
+                )
+            except Exception as e:
+                self._record(e)
+                raise
+        self._record(None, started)
+        return response
+
+    async def _hedged(self, model, prompt, timeout: float, kwargs: dict):
+        """
+        Starts a second identical request if the first is still running after the hedge delay
+        and there is spare Gemini capacity; the first successful response wins.
+        """
+        first = asyncio.ensure_future(self._attempt_async(model, prompt, timeout, kwargs))
+        delay = self.latency.hedge_delay()
+        if delay is None or delay >= timeout:
+            return await first
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done or upstream("gemini").locked():
+            return await first
+
+        self.hedges += 1
+        second = asyncio.ensure_future(self._attempt_async(model, prompt, timeout - delay, kwargs))
+        pending = {first, second}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def generate_async(self, model, prompt, deadline: Optional[float] = None,
+                             attempt_timeout: Optional[float] = None, hedge: bool = True, **kwargs):
+        """
+        generate_content_async with deadline, retries, hedging and circuit breaker.
+        Each attempt holds a slot of the 'gemini' concurrency limit; backoff sleeps do not.
+        """
+        deadline = deadline or self.deadline
+        deadline_at = time.monotonic() + deadline
+        self.calls += 1
+        try:
+            async for attempt in self._retrying(AsyncRetrying, deadline):
+                with attempt:
+                    probe = self.breaker.check()
+                    try:
+                        timeout = self._attempt_timeout(deadline_at, attempt_timeout)
+                        if hedge:
+                            return await self._hedged(model, prompt, timeout, kwargs)
+                        return await self._attempt_async(model, prompt, timeout, kwargs)
+                    finally:
+                        self.breaker.finish(probe)
+        except Exception as e:
+            self._failed(e)
+
+    async def stream_async(self, model, prompt, deadline: Optional[float] = None, **kwargs):
+        """
+        Streaming generate_content_async as an async iterator of chunks. Retries cover the
+        request up to the first chunk (the SDK returns once it has arrived); the 'gemini' slot,
+        the deadline and the breaker outcome cover the whole stream.
+        """
+        deadline = deadline or self.deadline
+        deadline_at = time.monotonic() + deadline
+        slot = upstream("gemini")
+        self.calls += 1
+        try:
+            async for attempt in self._retrying(AsyncRetrying, deadline):
+                with attempt:
+                    probe = self.breaker.check()
+                    try:
+                        timeout = self._attempt_timeout(deadline_at, None)
+                        await slot.acquire()
+                        try:
+                            response = await asyncio.wait_for(
+                                model.generate_content_async(
+                                    prompt, stream=True, request_options={"timeout": timeout, "retry": None}, **kwargs
+                                ),
+                                timeout,
+                            )
+                            chunks = response.__aiter__()
+                            chunk = await _next_chunk(chunks, deadline_at)
+                        except BaseException as e:
+                            slot.release()
+                            self._record(e)
+                            raise
+                    except BaseException:
+                        self.breaker.finish(probe)
+                        raise
+        except Exception as e:
+            self._failed(e)
+
+        try:
+            while chunk is not None:
+                yield chunk
+                chunk = await _next_chunk(chunks, deadline_at)
+            self.breaker.record_success()
+        except Exception as e:
+            self._record(e)
+            self._failed(e)
+        finally:
+            slot.release()
+            self.breaker.finish(probe)
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "retries": self.retries,
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "latency_p50_ms": round((self.latency.quantile(0.5) or 0.0) * 1000, 1),
+            "latency_p95_ms": round((self.latency.quantile(0.95) or 0.0) * 1000, 1),
+            "breaker": self.breaker.stats(),
+        }
+
+
+llm_client = LLMClient()
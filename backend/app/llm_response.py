@@ -0,0 +1,212 @@
+import os
+import re
+import json
+import threading
+from typing import Optional, Tuple
+
+from .schemas import DiagnoseResponse
+
+# Ask Gemini for schema-constrained JSON instead of free text (set 0 if a model rejects it)
+STRUCTURED_OUTPUT = os.environ.get("GEMINI_STRUCTURED_OUTPUT", "1") != "0"
+
+# Filled in by the server, never by the model
+_SERVER_FIELDS = {"visual_page_base64", "visual_page_url", "video_status", "request_id"}
+# Gemini needs explicit properties for objects; DiagnoseResponse only types next_actions as dict
+_FIELD_OVERRIDES = {
+    "next_actions": {
+        "type": "object",
+        "properties": {"primary": {"type": "string"}, "secondary": {"type": "array", "items": {"type": "string"}}},
+    },
+}
+
+_FENCE_RE = re.compile(r"```(?:json|JSON)?\s*(.*?)(?:```|$)", re.DOTALL)
+_TRAILING_COMMA_RE = re.compile(r",\s*([}\]])")
+_DIGITS_RE = re.compile(r"\d+")
+
+
+def _to_gemini_schema(node: dict) -> dict:
+    """Converts one pydantic JSON-schema node to the OpenAPI subset Gemini accepts."""
+    nullable = False
+    if "anyOf" in node:
+        options = [o for o in node["anyOf"] if o.get("type") != "null"]
+        nullable = len(options) < len(node["anyOf"])
+        node = options[0] if options else {"type": "string"}
+    schema = {"type": node.get("type", "string")}
+    if schema["type"] == "array":
+        schema["items"] = _to_gemini_schema(node.get("items", {"type": "string"}))
+    if nullable:
+        schema["nullable"] = True
+    return schema
+
+
+def diagnosis_response_schema() -> dict:
+    """response_schema for the diagnosis answer, derived from DiagnoseResponse."""
+    source = DiagnoseResponse.model_json_schema()
+    properties = {}
+    for name, node in source["properties"].items():
+        if name in _SERVER_FIELDS:
+            continue
+        properties[name] = _FIELD_OVERRIDES.get(name) or _to_gemini_schema(node)
+    required = [name for name in source.get("required", []) if name in properties]
+    return {"type": "object", "properties": properties, "required": required}
+
+
+def diagnosis_generation_config() -> Optional[dict]:
+    if not STRUCTURED_OUTPUT:
+        return None
+    return {"response_mime_type": "application/json", "response_schema": diagnosis_response_schema()}
+
+
+class ParseStats:
+    """Counts how model answers were parsed: cleanly, after repair, or not at all."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {"ok": 0, "repaired": 0, "failed": 0}
+
+    def record(self, outcome: str):
+        with self._lock:
+            self.counts[outcome] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = sum(self.counts.values())
+            return {
+                **self.counts,
+                "repair_rate": round(self.counts["repaired"] / total, 3) if total else 0.0,
+                "failure_rate": round(self.counts["failed"] / total, 3) if total else 0.0,
+            }
+
+
+parse_stats = ParseStats()
+
+
+def _closers(text: str) -> Optional[str]:
+    """Brackets needed to close text, or None if it ends inside a string."""
+    stack = []
+    in_string = escaped = False
+    for ch in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+        elif ch in "}]" and stack:
+            stack.pop()
+    return None if in_string else "".join(reversed(stack))
+
+
+def _close_truncated(text: str) -> Optional[dict]:
+    """
+    Recovers an object from output cut off mid-stream: drops the incomplete trailing
+    member (back to the previous comma) until closing the open brackets yields valid JSON.
+    """
+    for _ in range(64):
+        body = text.rstrip().rstrip(",")
+        closers = _closers(body)
+        if closers is not None:
+            try:
+                data = json.loads(body + closers)
+                if isinstance(data, dict):
+                    return data
+            except ValueError:
+                pass
+        cut = text.rfind(",")
+        if cut <= 0:
+            return None
+        text = text[:cut]
+    return None
+
+
+def parse_json_response(text: str) -> Tuple[Optional[dict], str]:
+    """
+    Parses a JSON object from model output without another model call.
+    Handles code fences, prose around the object, trailing commas and truncated output.
+    Returns (data, outcome) with outcome "ok", "repaired" or "failed" (data None).
+    """
+    try:
+        data = json.loads(text)
+        if isinstance(data, dict):
+            return data, "ok"
+    except ValueError:
+        pass
+
+    candidate = text
+    fenced = _FENCE_RE.search(candidate)
+    if fenced:
+        candidate = fenced.group(1)
+    start = candidate.find("{")
+    if start < 0:
+        return None, "failed"
+    candidate = candidate[start:]
+
+    decoder = json.JSONDecoder()
+    for attempt in (candidate, _TRAILING_COMMA_RE.sub(r"\1", candidate)):
+        try:
+            data, _ = decoder.raw_decode(attempt)
+            if isinstance(data, dict):
+                return data, "repaired"
+        except ValueError:
+            pass
+
+    data = _close_truncated(_TRAILING_COMMA_RE.sub(r"\1", candidate))
+    if data is not None:
+        return data, "repaired"
+    return None, "failed"
+
+
+def normalize_step(s) -> str:
+    if isinstance(s, str):
+        return s
+    elif isinstance(s, dict) and "description" in s:
+        return s["description"]
+    elif isinstance(s, dict) and "step" in s:
+        return s["step"]
+    return str(s)
+
+
+def _page_number(p) -> Optional[int]:
+    if isinstance(p, bool):
+        return None
+    if isinstance(p, (int, float)):
+        return int(p)
+    digits = _DIGITS_RE.findall(str(p))
+    return int(digits[0]) if digits else None
+
+
+def normalize_diagnosis(data: dict) -> dict:
+    """Coerces a parsed answer into the shape DiagnoseResponse expects, filling missing fields."""
+    data["probable_causes"] = [str(c) for c in data.get("probable_causes") or []]
+    data["steps"] = [normalize_step(s) for s in data.get("steps") or []]
+    data["cautions"] = [str(c) for c in data.get("cautions") or []]
+    pages = (_page_number(p) for p in data.get("referenced_pages") or [])
+    data["referenced_pages"] = [p for p in pages if p is not None]
+    if not isinstance(data.get("next_actions"), dict):
+        data["next_actions"] = {}
+    try:
+        data["confidence"] = float(data.get("confidence", 0.0))
+    except (TypeError, ValueError):
+        data["confidence"] = 0.0
+    data["disclaimer"] = str(data.get("disclaimer") or "")
+    return data
+
+
+def parse_diagnosis(text: str) -> dict:
+    """Parses and normalizes a diagnosis answer; raises ValueError if nothing usable was found."""
+    data, outcome = parse_json_response(text)
+    if data is not None and not (data.get("probable_causes") or data.get("steps")):
+        # Repaired down to an answer with nothing to show
+        data, outcome = None, "failed"
+    parse_stats.record(outcome)
+    if data is None:
+        print(f"DEBUG: Unparseable diagnosis response: {text[:200]!r}")
+        raise ValueError("Could not parse the model response as JSON")
+    if outcome == "repaired":
+        print("DEBUG: Diagnosis response JSON was repaired")
+    return normalize_diagnosis(data)
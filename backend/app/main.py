@@ -1,9 +1,14 @@
+import re
 import shutil
 import os
+import asyncio
 from dotenv import load_dotenv
 
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException, BackgroundTasks
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, BackgroundTasks, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
 from typing import Optional, List
 import json
 
@@ -14,6 +19,12 @@ else:
     print("DEBUG: .env file not found, skipping load_dotenv. Using system env vars.", flush=True)
 
 from .schemas import DiagnoseResponse
+from .concurrency import run_blocking
+from .job_store import DONE, get_job_store
+from .task_queue import TASK_QUEUE_BACKEND, QueueFullError, task_queue
+from .video_jobs import (
+    await_job, generate_video_single_flight, is_generating, register_video, schedule_video, store_call,
+)
 
 from fastapi.staticfiles import StaticFiles
 
@@ -41,38 +52,8 @@ app.add_middleware(
 def read_root():
     return {"message": "Advisor Intelligence Backend is running"}
 
-# In-memory cache for video results (PoC)
-_video_cache = {}
-
-def process_video_background(query: str, persona: str):
-    """
-    Background task to generate video assets.
-    """
-    print(f"DEBUG: Starting background video generation for query='{query}', persona='{persona}'", flush=True)
-    try:
-        from .rag import get_video_script
-        from .video_gen import generate_audio, create_slides
-        
-        cache_key = f"{query}_{persona}"
-        script = get_video_script(query, persona=persona)
-        if script:
-            audio_b64 = generate_audio(script)
-            slides = create_slides(script)
-            
-            _video_cache[cache_key] = {
-                "script": script,
-                "audio_base64": audio_b64,
-                "slides": slides
-            }
-            print(f"DEBUG: Background video generation completed for {cache_key}", flush=True)
-        else:
-             print(f"DEBUG: Background script generation failed for {cache_key}", flush=True)
-    except Exception as e:
-         print(f"DEBUG: Background video generation error: {e}", flush=True)
-
 @app.post("/api/diagnose", response_model=DiagnoseResponse)
-def diagnose(
-    background_tasks: BackgroundTasks,
+async def diagnose(
     query: str = Form(...),
     device: Optional[str] = Form("TS6330"),
     persona: Optional[str] = Form("Technical"),
@@ -84,22 +65,41 @@ def diagnose(
     """
     try:
         # Use RAG Logic
-        from .rag import get_rag_diagnosis
-        import uuid
+        from .rag import get_rag_diagnosis_async, get_corpus_version
+        from .answer_bank import get_banked_answer
+        from .answer_cache import answer_cache
         
-        # If image is present, we might want to do something, but for now RAG depends on text
-        print(f"DEBUG: Calling get_rag_diagnosis with query='{query}', persona='{persona}'", flush=True)
-        result = get_rag_diagnosis(query, persona=persona)
-        print(f"DEBUG: get_rag_diagnosis returned type: {type(result)}", flush=True)
+        corpus_version = await run_blocking("setup", get_corpus_version)
+        # Top symptoms are served from the precomputed answer bank, video included;
+        # repeated questions (in any phrasing) are answered from the cache without an LLM call
+        banked = await run_blocking("store", get_banked_answer, query, persona)
+        result = banked[0] if banked else answer_cache.get(query, persona, corpus_version)
+        if banked:
+            print(f"DEBUG: Answer bank hit for query='{query}', persona='{persona}'", flush=True)
+        elif result is not None:
+            print(f"DEBUG: Answer cache hit for query='{query}', persona='{persona}'", flush=True)
+        else:
+            # If image is present, we might want to do something, but for now RAG depends on text
+            print(f"DEBUG: Calling get_rag_diagnosis with query='{query}', persona='{persona}'", flush=True)
+            result = await task_queue.run("interactive", get_rag_diagnosis_async, query, persona=persona)
+            print(f"DEBUG: get_rag_diagnosis returned type: {type(result)}", flush=True)
+            # Error payloads carry confidence 0 and must not be replayed
+            if result.get("confidence", 0) > 0:
+                answer_cache.put(query, persona, corpus_version, result)
         
-        # Add background task for video
-        background_tasks.add_task(process_video_background, query, persona)
+        # Queue the video on the background lane, pollable at /api/video/{request_id}
+        if banked and banked[1]:
+            request_id, video_status = await register_video(banked[2], query, persona, banked[1])
+        else:
+            request_id, video_status = await schedule_video(query, persona)
         
         # Enrich result
-        result["video_status"] = "processing"
-        result["request_id"] = str(uuid.uuid4())
+        result["video_status"] = video_status
+        result["request_id"] = request_id
         
         return DiagnoseResponse(**result)
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=f"Server busy: {e}", headers={"Retry-After": "2"})
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -108,16 +108,191 @@ def diagnose(
         # FOr debugging, raise detailed error
         raise HTTPException(status_code=500, detail=f"Internal Error: {str(e)}")
 
-@app.post("/api/ingest")
-def ingest_manual():
+def _sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+async def _replay_answer(result: dict):
+    """Replays a cached answer through the same events as a live stream."""
+    for cause in result.get("probable_causes", []):
+        yield "cause", cause
+    for step in result.get("steps", []):
+        yield "step", step
+    yield "pages", {"referenced_pages": result.get("referenced_pages", []), "source_file": result.get("source_file")}
+    yield "result", result
+
+@app.post("/api/diagnose/stream")
+async def diagnose_stream(
+    query: str = Form(...),
+    device: Optional[str] = Form("TS6330"),
+    persona: Optional[str] = Form("Technical"),
+    image: Optional[UploadFile] = File(None)
+):
+    """
+    Server-sent-events variant of /api/diagnose for fast first paint.
+    Events: "cause" and "step" (one per item, as tokens arrive), "pages", "visual" with the
+    page image URL, then "done" with the validated DiagnoseResponse, or "error".
+    """
+    from .rag import stream_rag_diagnosis, get_corpus_version
+    from .answer_bank import get_banked_answer
+    from .answer_cache import answer_cache
+
+    # Back-pressure has to be applied before the 200 response starts streaming
+    if task_queue.is_full("interactive"):
+        raise HTTPException(status_code=503, detail="Server busy", headers={"Retry-After": "2"})
+
+    async def events():
+        corpus_version = await run_blocking("setup", get_corpus_version)
+        banked = await run_blocking("store", get_banked_answer, query, persona)
+        cached = banked[0] if banked else answer_cache.get(query, persona, corpus_version)
+
+        result = None
+        try:
+            if cached is not None:
+                async for event, data in _replay_answer(cached):
+                    if event == "result":
+                        result = data
+                    else:
+                        yield _sse(event, data)
+            else:
+                async with task_queue.slot("interactive"):
+                    async for event, data in stream_rag_diagnosis(query, persona=persona):
+                        if event == "result":
+                            result = data
+                        else:
+                            yield _sse(event, data)
+        except QueueFullError as e:
+            yield _sse("error", {"detail": f"Server busy: {e}"})
+            return
+
+        if result.get("visual_page_url"):
+            yield _sse("visual", {"visual_page_url": result["visual_page_url"]})
+        if cached is None and result.get("confidence", 0) > 0:
+            answer_cache.put(query, persona, corpus_version, result)
+
+        if banked and banked[1]:
+            request_id, video_status = await register_video(banked[2], query, persona, banked[1])
+        else:
+            request_id, video_status = await schedule_video(query, persona)
+        result["video_status"] = video_status
+        result["request_id"] = request_id
+        try:
+            payload = DiagnoseResponse(**result)
+        except ValidationError as e:
+            print(f"Diagnose Stream Validation Error: {e}", flush=True)
+            yield _sse("error", {"detail": f"Invalid diagnosis payload: {e}"})
+            return
+        yield _sse("done", jsonable_encoder(payload))
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+_RANGE_RE = re.compile(r"bytes=(\d*)-(\d*)$")
+
+def _ranged_response(request: Request, data: bytes, media_type: str, headers: dict) -> Response:
+    """Serves data whole, or the single byte range the request asks for (206 / 416)."""
+    range_header = request.headers.get("range")
+    if range_header:
+        match = _RANGE_RE.match(range_header.strip())
+        if not match or match.groups() == ("", ""):
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{len(data)}"})
+        start, end = match.groups()
+        if start == "":
+            # Suffix range: last N bytes
+            start, end = max(len(data) - int(end), 0), len(data) - 1
+        else:
+            start, end = int(start), min(int(end) if end else len(data) - 1, len(data) - 1)
+        if start > end or start >= len(data):
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{len(data)}"})
+        headers = {**headers, "Content-Range": f"bytes {start}-{end}/{len(data)}"}
+        return Response(content=data[start:end + 1], status_code=206, media_type=media_type, headers=headers)
+
+    return Response(content=data, media_type=media_type, headers=headers)
+
+@app.get("/api/pages/{manual}/{page}.{fmt}")
+async def get_page_image_endpoint(request: Request, manual: str, page: int, fmt: str, dpi: int = 150,
+                                  region: Optional[int] = None, v: Optional[str] = None):
+    """
+    Rendered manual page (PNG or WebP) with ETag revalidation and byte-range support.
+    region selects a cropped tile of one detected diagram instead of the full page.
+    dpi is snapped to the nearest render level so the cache holds a bounded set of variants.
+    URLs from diagnosis responses carry v=<manual hash>, which makes them immutable.
+    """
+    from .image_utils import IMAGE_FORMATS, get_manual_path, get_page_image
+    from .page_cache import get_page_cache
+    from .regions import MAX_REGIONS_PER_PAGE, snap_dpi
+
+    if fmt not in IMAGE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported format: {fmt}")
+    if not 36 <= dpi <= 300:
+        raise HTTPException(status_code=400, detail="dpi must be between 36 and 300")
+    if region is not None and not 0 <= region < MAX_REGIONS_PER_PAGE:
+        raise HTTPException(status_code=400, detail="Unknown region")
+    dpi = snap_dpi(dpi)
+    pdf_path = get_manual_path(os.path.basename(manual))
+    if not os.path.exists(pdf_path):
+        raise HTTPException(status_code=404, detail="Manual not found")
+
+    manual_hash = await run_blocking("render", get_page_cache().manual_hash, pdf_path)
+    crop = "" if region is None else f"-r{region}"
+    etag = f'"{manual_hash[:16]}-{page}-{dpi}{crop}-{fmt}"'
+    headers = {
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        # Versioned URLs never change content; unversioned ones are revalidated via ETag
+        "Cache-Control": "public, max-age=31536000, immutable" if v == manual_hash[:16] else "public, max-age=3600",
+    }
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+
+    data = await run_blocking("render", get_page_image, pdf_path, page, dpi, fmt, region)
+    if not data:
+        raise HTTPException(status_code=404, detail="Page not found")
+
+    return _ranged_response(request, data, f"image/{fmt}", headers)
+
+@app.get("/api/audio/{name}")
+async def get_audio(request: Request, name: str):
+    """
+    Narration audio of a generated video. Files are named by content hash, so they never change;
+    Range requests let players start and seek without downloading the whole file.
+    """
+    from .tts import AUDIO_MEDIA_TYPES, audio_path
+
+    path = audio_path(os.path.basename(name))
+    if not path:
+        raise HTTPException(status_code=404, detail="Audio not found")
+    etag = f'"{name.split(".")[0]}"'
+    headers = {"ETag": etag, "Accept-Ranges": "bytes", "Cache-Control": "public, max-age=31536000, immutable"}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    data = await asyncio.to_thread(_read_file, path)
+    return _ranged_response(request, data, AUDIO_MEDIA_TYPES[name.rsplit(".", 1)[1]], headers)
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+async def _ingest_and_refresh() -> str:
+    """Re-ingests the manuals, then rebuilds answer bank entries that cite a changed manual."""
     from .rag import ingest_manuals
-    msg = ingest_manuals()
+    from .answer_bank import schedule_answer_bank_refresh
+    msg = await asyncio.to_thread(ingest_manuals)
+    if schedule_answer_bank_refresh():
+        print("DEBUG: Answer bank refresh queued after ingest", flush=True)
+    return msg
+
+@app.post("/api/ingest")
+async def ingest_manual():
+    msg = await _ingest_and_refresh()
     return {"status": "completed", "message": msg}
 
 @app.get("/api/status")
 def get_system_status():
     from .rag import get_loaded_status
-    return get_loaded_status()
+    return {**get_loaded_status(), "task_queue": task_queue.stats(), "video_jobs": get_job_store().stats()}
 
 @app.post("/api/feedback")
 def feedback(result: str = Form(...), comment: Optional[str] = Form(None)):
@@ -125,7 +300,8 @@ def feedback(result: str = Form(...), comment: Optional[str] = Form(None)):
 
 @app.post("/api/upload")
 async def upload_manual(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
-    from .rag import ingest_manuals, MANUALS_DIR
+    from .rag import MANUALS_DIR
+    from .image_utils import document_pool
     
     try:
         if not os.path.exists(MANUALS_DIR):
@@ -137,10 +313,14 @@ async def upload_manual(background_tasks: BackgroundTasks, file: UploadFile = Fi
         
         print(f"DEBUG: Uploading file to {file_path}")
         
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        def save():
+            with open(file_path, "wb") as buffer:
+                shutil.copyfileobj(file.file, buffer)
+
+        await asyncio.to_thread(save)
+        document_pool.invalidate(file_path)
             
-        background_tasks.add_task(ingest_manuals)
+        background_tasks.add_task(_ingest_and_refresh)
         
         return {"status": "uploaded", "filename": filename, "message": "Ingestion started in background"}
 
@@ -153,38 +333,63 @@ async def generate_video(query: str = Form(...), persona: Optional[str] = Form("
     """
     Generates an 'Audio Overview' video (slides + audio).
     """
-    from .rag import get_video_script
-    from .video_gen import generate_audio, create_slides
-    
-    # Check cache first
-    cache_key = f"{query}_{persona}"
-    if cache_key in _video_cache:
-        print(f"DEBUG: Returning cached video for {cache_key}", flush=True)
-        return _video_cache[cache_key]
-
-    # 1. Generate Script (Dialogue)
-    script = get_video_script(query, persona=persona)
-    if not script:
-        raise HTTPException(status_code=500, detail="Failed to generate script.")
+    import uuid
+    from .answer_bank import get_banked_answer
 
-    # 2. Generate Audio (TTS)
-    audio_b64 = generate_audio(script)
+    banked = await run_blocking("store", get_banked_answer, query, persona)
+    if banked and banked[1]:
+        print(f"DEBUG: Returning precomputed video for {query}_{persona}", flush=True)
+        return {**banked[1], "request_id": banked[2]}
 
-    # 3. Create Slides (Placeholder or Real)
-    slides = create_slides(script)
-    
-    # Cache it
-    _video_cache[cache_key] = {
-        "script": script,
-        "audio_base64": audio_b64,
-        "slides": slides
-    }
+    # Check finished jobs first (background jobs from /api/diagnose included)
+    cached = await store_call("find_done", query, persona)
+    if cached:
+        print(f"DEBUG: Returning cached video for {query}_{persona}", flush=True)
+        return cached
 
-    return {
-        "script": script,
-        "audio_base64": audio_b64,
-        "slides": slides
-    }
+    # Usually the background job of the preceding /api/diagnose call is still running: wait for it
+    active = await store_call("find_active", query, persona)
+    if active and not is_generating(query, persona):
+        print(f"DEBUG: Waiting for video job {active}", flush=True)
+        video = await await_job(active)
+        if video:
+            return {**video, "request_id": active}
+
+    if TASK_QUEUE_BACKEND == "sqlite":
+        # Generation belongs to the worker process: queue a job and wait for it
+        request_id, video_status = await schedule_video(query, persona)
+        if video_status == "unavailable":
+            raise HTTPException(status_code=503, detail="Video queue is full", headers={"Retry-After": "10"})
+        video = await await_job(request_id)
+        if not video:
+            raise HTTPException(status_code=500, detail="Failed to generate script.")
+        return {**video, "request_id": request_id}
+
+    try:
+        if is_generating(query, persona):
+            video = await generate_video_single_flight(query, persona)
+        else:
+            video = await task_queue.run("background", generate_video_single_flight, query, persona)
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=f"Server busy: {e}", headers={"Retry-After": "10"})
+    if not video:
+        raise HTTPException(status_code=500, detail="Failed to generate script.")
+
+    # Recorded as a finished job so later requests (and other workers) reuse it
+    request_id = str(uuid.uuid4())
+    await store_call("create", request_id, query, persona, status=DONE, result=video)
+    return {**video, "request_id": request_id}
+
+@app.get("/api/video/{request_id}")
+def get_video_job(request_id: str):
+    """
+    Status of the background video job started by /api/diagnose:
+    queued, running, done (with script, audio_url and slides) or failed (with error).
+    """
+    job = get_job_store().get(request_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Video job not found")
+    return {"request_id": request_id, "status": job["status"], "error": job["error"], **(job["result"] or {})}
 
 @app.post("/api/generate_script")
 async def generate_script(query: str = Form(...)):
@@ -192,9 +397,9 @@ async def generate_script(query: str = Form(...)):
     Generates text-only diagnosis (Conversational Script).
     Failsafe mode when video generation errors.
     """
-    from .rag import get_video_script
+    from .rag import get_video_script_async
     
-    script = get_video_script(query)
+    script = await get_video_script_async(query)
     if not script:
         raise HTTPException(status_code=500, detail="Failed to generate script.")
         
@@ -0,0 +1,167 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from contextlib import closing
+from typing import Iterator, List, Optional
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_DIR = os.path.join(BASE_DIR, "..", "db")
+STORE_PATH = os.environ.get("MANUAL_STORE_PATH", os.path.join(DB_DIR, "manual_store.sqlite"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS manuals (
+    content_hash TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    page_count INTEGER NOT NULL,
+    parsed_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pages (
+    content_hash TEXT NOT NULL,
+    page INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    metadata TEXT NOT NULL,
+    PRIMARY KEY (content_hash, page)
+);
+"""
+
+
+def file_sha256(path: str, block_size: int = 1 << 20) -> str:
+    """Streams the file through SHA-256 so large manuals are never fully loaded in memory."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class ManualStore:
+    """
+    SQLite store of parsed manual pages keyed by the PDF's content hash.
+    Pages survive process restarts, so a manual is only run through PDF extraction once.
+    """
+
+    def __init__(self, path: str = STORE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.executescript(_SCHEMA)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def has_manual(self, content_hash: str) -> bool:
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT 1 FROM manuals WHERE content_hash = ?", (content_hash,)).fetchone()
+        return row is not None
+
+    def writer(self, content_hash: str) -> "ManualWriter":
+        """Returns a writer that streams pages into the store one at a time."""
+        return ManualWriter(self, content_hash)
+
+    def iter_pages(self, content_hash: str, pages: Optional[set] = None) -> Iterator[tuple]:
+        """Yields (page, text) in page order straight from a cursor, optionally only for the given pages."""
+        with closing(self._connect()) as conn:
+            cursor = conn.execute(
+                "SELECT page, text FROM pages WHERE content_hash = ? ORDER BY page", (content_hash,)
+            )
+            for page, text in cursor:
+                if pages is None or page in pages:
+                    yield page, text
+
+    def get_fingerprints(self, content_hash: str) -> List[tuple]:
+        """Returns (page, simhash, chars) for every page without loading page text into Python."""
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT page, json_extract(metadata, '$.simhash'), length(text) FROM pages "
+                "WHERE content_hash = ? ORDER BY page",
+                (content_hash,),
+            ).fetchall()
+        return rows
+
+    def get_regions(self, content_hash: str, page: int) -> Optional[List[list]]:
+        """Diagram regions detected at ingest for one page, or None if the page is not stored."""
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT json_extract(metadata, '$.regions') FROM pages WHERE content_hash = ? AND page = ?",
+                (content_hash, page),
+            ).fetchone()
+        if not row or row[0] is None:
+            return None
+        return json.loads(row[0])
+
+    def delete_manual(self, content_hash: str):
+        with self._lock, closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM pages WHERE content_hash = ?", (content_hash,))
+            conn.execute("DELETE FROM manuals WHERE content_hash = ?", (content_hash,))
+
+    def list_manuals(self) -> List[dict]:
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT content_hash, filename, size, page_count, parsed_at FROM manuals ORDER BY filename"
+            ).fetchall()
+        keys = ("content_hash", "filename", "size", "page_count", "parsed_at")
+        return [dict(zip(keys, row)) for row in rows]
+
+
+class ManualWriter:
+    """
+    Streams parsed pages into the store in small batches.
+    The manual only becomes visible (has_manual/iter_pages) once commit() writes its manuals row,
+    so a parse that fails halfway never leaves a partial manual behind.
+    """
+
+    BATCH_SIZE = 64
+
+    def __init__(self, store: ManualStore, content_hash: str):
+        self.store = store
+        self.content_hash = content_hash
+        self.page_count = 0
+        self._batch = []
+        with store._lock, closing(store._connect()) as conn, conn:
+            conn.execute("DELETE FROM pages WHERE content_hash = ?", (content_hash,))
+
+    def add(self, page: dict):
+        self._batch.append((self.content_hash, page["page"], page["text"], json.dumps(page.get("metadata", {}))))
+        self.page_count += 1
+        if len(self._batch) >= self.BATCH_SIZE:
+            self._flush()
+
+    def _flush(self):
+        if not self._batch:
+            return
+        with self.store._lock, closing(self.store._connect()) as conn, conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO pages (content_hash, page, text, metadata) VALUES (?, ?, ?, ?)", self._batch
+            )
+        self._batch = []
+
+    def commit(self, filename: str, size: int):
+        self._flush()
+        with self.store._lock, closing(self.store._connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO manuals (content_hash, filename, size, page_count, parsed_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (self.content_hash, filename, size, self.page_count, time.time()),
+            )
+
+    def abort(self):
+        self._batch = []
+        self.store.delete_manual(self.content_hash)
+
+
+_store: Optional[ManualStore] = None
+
+
+def get_manual_store() -> ManualStore:
+    """Returns the process-wide store, creating the database on first use."""
+    global _store
+    if _store is None:
+        _store = ManualStore()
+    return _store
@@ -0,0 +1,221 @@
+import os
+import json
+import threading
+from collections import Counter, OrderedDict
+from typing import Callable, Iterable, Optional
+
+from .manual_store import DB_DIR, file_sha256
+
+PAGE_CACHE_DIR = os.environ.get("PAGE_CACHE_DIR", os.path.join(DB_DIR, "page_cache"))
+PAGE_CACHE_MEMORY_MB = int(os.environ.get("PAGE_CACHE_MEMORY_MB", "64"))
+# Least recently used renders are deleted once the disk tier grows past this
+PAGE_CACHE_DISK_MB = int(os.environ.get("PAGE_CACHE_DISK_MB", "256"))
+# Pages rendered ahead of time after each ingest, chosen by how often answers referenced them
+PREWARM_TOP_N = int(os.environ.get("PAGE_CACHE_PREWARM_TOP_N", "30"))
+
+_REFERENCES_FILE = "references.json"
+_FLUSH_EVERY = 20
+# Eviction trims the disk tier to this share of its limit, so it does not run on every write
+_DISK_LOW_WATER = 0.9
+
+
+class PageRenderCache:
+    """
+    Two-tier cache of rendered manual pages keyed by (manual hash, page, dpi, format, region).
+    region is the index of a detected diagram region for cropped tiles, or None for the full page.
+    Keying on the content hash instead of the filename means a re-uploaded manual can never
+    serve stale images. The memory tier is an LRU bounded in bytes; the disk tier survives
+    restarts and is bounded too, by file mtime (refreshed on every disk hit). Also counts how often pages are referenced, to pick pages to pre-warm.
+    """
+
+    def __init__(self, cache_dir: str = PAGE_CACHE_DIR, memory_bytes: int = PAGE_CACHE_MEMORY_MB * 1024 * 1024,
+                 disk_bytes: int = PAGE_CACHE_DISK_MB * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self._memory = OrderedDict()  # key -> bytes
+        self._memory_size = 0
+        self._hashes = {}  # path -> ((size, mtime), content hash)
+        self._lock = threading.Lock()
+        self._references = Counter()
+        self._unflushed = 0
+        self._evict_lock = threading.Lock()
+        self.hits = {"memory": 0, "disk": 0, "render": 0}
+        self.disk_evictions = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self._disk_size = sum(size for _, size, _ in self._disk_files())
+        self._load_references()
+
+    def manual_hash(self, pdf_path: str) -> str:
+        """Content hash of a manual, only re-hashed when its size or mtime changes."""
+        st = os.stat(pdf_path)
+        stat = (st.st_size, st.st_mtime)
+        cached = self._hashes.get(pdf_path)
+        if cached and cached[0] == stat:
+            return cached[1]
+        content_hash = file_sha256(pdf_path)
+        self._hashes[pdf_path] = (stat, content_hash)
+        return content_hash
+
+    def _disk_path(self, key: tuple) -> str:
+        content_hash, page, dpi, fmt, region = key
+        suffix = "" if region is None else f"_r{region}"
+        return os.path.join(self.cache_dir, content_hash[:2], f"{content_hash}_{page}_{dpi}{suffix}.{fmt}")
+
+    def get_or_render(self, pdf_path: str, page: int, dpi: int, fmt: str,
+                      render: Callable[[], bytes], region: Optional[int] = None) -> bytes:
+        key = (self.manual_hash(pdf_path), page, dpi, fmt, region)
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self.hits["memory"] += 1
+                return data
+
+        path = self._disk_path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            self.hits["disk"] += 1
+            self._touch(path)
+        except FileNotFoundError:
+            data = render()
+            self.hits["render"] += 1
+            if data:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp = f"{path}.{threading.get_ident()}.tmp"
+                with open(tmp, "wb") as f:
+                    f.write(data)
+                os.replace(tmp, path)
+                with self._lock:
+                    self._disk_size += len(data)
+                    full = self._disk_size > self.disk_bytes
+                if full:
+                    self._evict_disk()
+
+        if data:
+            self._remember(key, data)
+        return data
+
+    @staticmethod
+    def _touch(path: str):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def _disk_files(self) -> list:
+        """(mtime, size, path) of every render in the disk tier."""
+        files = []
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if name == _REFERENCES_FILE or name.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+        return files
+
+    def _evict_disk(self):
+        """Deletes the least recently used renders until the disk tier is back under its low-water mark."""
+        if not self._evict_lock.acquire(blocking=False):
+            return  # another thread is already evicting
+        try:
+            files = sorted(self._disk_files())
+            total = sum(size for _, size, _ in files)
+            target = self.disk_bytes * _DISK_LOW_WATER
+            evicted = 0
+            for _, size, path in files:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                evicted += 1
+            with self._lock:
+                self._disk_size = total
+                self.disk_evictions += evicted
+            print(f"DEBUG: Page cache evicted {evicted} renders from disk ({total // 1024} KiB left)")
+        finally:
+            self._evict_lock.release()
+
+    def _remember(self, key: tuple, data: bytes):
+        with self._lock:
+            if key in self._memory:
+                return
+            self._memory[key] = data
+            self._memory_size += len(data)
+            while self._memory_size > self.memory_bytes and self._memory:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_size -= len(evicted)
+
+    def record_reference(self, source: str, page: int):
+        with self._lock:
+            self._references[f"{source}|{page}"] += 1
+            self._unflushed += 1
+            flush = self._unflushed >= _FLUSH_EVERY
+        if flush:
+            self.flush_references()
+
+    def top_references(self, n: int) -> list:
+        """Returns the n most referenced (source, page) pairs."""
+        with self._lock:
+            top = self._references.most_common(n)
+        return [(key.rsplit("|", 1)[0], int(key.rsplit("|", 1)[1])) for key, _ in top]
+
+    def _load_references(self):
+        try:
+            with open(os.path.join(self.cache_dir, _REFERENCES_FILE), encoding="utf-8") as f:
+                self._references.update(json.load(f))
+        except (FileNotFoundError, ValueError):
+            pass
+
+    def flush_references(self):
+        with self._lock:
+            snapshot = dict(self._references)
+            self._unflushed = 0
+        path = os.path.join(self.cache_dir, _REFERENCES_FILE)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    def prune(self, valid_hashes: Iterable[str]):
+        """Deletes disk renders of manuals that are no longer loaded."""
+        valid = set(valid_hashes)
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if "_" in name and name.split("_", 1)[0] not in valid:
+                    try:
+                        os.remove(os.path.join(root, name))
+                    except FileNotFoundError:
+                        pass  # evicted or pruned concurrently
+        disk_size = sum(size for _, size, _ in self._disk_files())
+        with self._lock:
+            self._disk_size = disk_size
+            for key in [k for k in self._memory if k[0] not in valid]:
+                self._memory_size -= len(self._memory.pop(key))
+
+    def stats(self) -> dict:
+        return {
+            "memory_entries": len(self._memory),
+            "memory_bytes": self._memory_size,
+            "disk_bytes": self._disk_size,
+            "disk_evictions": self.disk_evictions,
+            "hits": dict(self.hits),
+        }
+
+
+_page_cache: Optional[PageRenderCache] = None
+
+
+def get_page_cache() -> PageRenderCache:
+    global _page_cache
+    if _page_cache is None:
+        _page_cache = PageRenderCache()
+    return _page_cache
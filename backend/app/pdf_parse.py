@@ -0,0 +1,129 @@
+import os
+import sys
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import islice
+from typing import Iterator, List
+
+from pypdf import PdfReader
+
+from .dedup import simhash
+from .regions import detect_page_range
+
+# 0 = one worker per core, 1 = parse serially in-process
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", "0")) or os.cpu_count() or 1
+# Large PDFs are split into page ranges of this size so one manual can use several cores
+PAGES_PER_TASK = int(os.environ.get("INGEST_PAGES_PER_TASK", "32"))
+
+
+def count_pages(path: str) -> int:
+    return len(PdfReader(path).pages)
+
+
+def parse_page_range(path: str, start: int, end: int) -> List[dict]:
+    """
+    Extracts pages [start, end) (0-indexed) of a PDF as store-ready page dicts (1-indexed 'page').
+    Runs inside worker processes, so it only depends on pypdf, PyMuPDF and the fingerprinting helper.
+    Diagram regions are detected here too, so ingest pays for them once, in parallel.
+    """
+    reader = PdfReader(path)
+    source = os.path.basename(path)
+    try:
+        regions = detect_page_range(path, start, end)
+    except Exception as e:
+        print(f"DEBUG: Region detection failed for {source}: {e}")
+        regions = {}
+    pages = []
+    for i in range(start, min(end, len(reader.pages))):
+        text = reader.pages[i].extract_text() or ""
+        metadata = {"source": source, "simhash": format(simhash(text), "016x"), "regions": regions.get(i + 1, [])}
+        pages.append({"page": i + 1, "text": text, "metadata": metadata})
+    return pages
+
+
+def _plan(paths: List[str], pages_per_task: int) -> tuple:
+    """Splits the PDFs into page-range tasks. Returns (tasks, paths that could not be opened)."""
+    tasks, unreadable = [], []
+    for path in paths:
+        try:
+            n = count_pages(path)
+        except Exception as e:
+            print(f"DEBUG: Failed to open {path}: {e}")
+            unreadable.append(path)
+            continue
+        tasks.extend((path, start, start + pages_per_task) for start in range(0, max(n, 1), pages_per_task))
+    return tasks, unreadable
+
+
+def _in_worker_process() -> bool:
+    """True inside a multiprocessing child, including a spawned child still re-importing __main__."""
+    # While a spawned child bootstraps, it runs the parent's main module as a separate __mp_main__
+    mp_main = sys.modules.get("__mp_main__")
+    if multiprocessing.parent_process() is not None:
+        return True
+    return mp_main is not None and mp_main is not sys.modules.get("__main__")
+
+
+def _parse_serially(tasks: List[tuple]) -> Iterator[tuple]:
+    for path, start, end in tasks:
+        try:
+            pages = parse_page_range(path, start, end)
+        except Exception as e:
+            print(f"DEBUG: Failed to parse {path}: {e}")
+            yield path, None
+            continue
+        for page in pages:
+            yield path, page
+
+
+def iter_parsed_pages(paths: List[str], workers: int = INGEST_WORKERS,
+                      pages_per_task: int = PAGES_PER_TASK) -> Iterator[tuple]:
+    """
+    Parses PDFs across a process pool and yields (path, page_dict) one page at a time,
+    in file and page order regardless of which worker finishes first.
+    At most 2 x workers page ranges are in flight, so memory stays bounded by the window,
+    not by the corpus. A file that cannot be opened, or a range that fails, yields (path, None);
+    callers should discard that file.
+    If the pool cannot run (e.g. a caller without a __main__ guard, whose spawned children
+    re-run it), the remaining ranges are parsed serially in this process.
+    """
+    tasks, unreadable = _plan(paths, pages_per_task)
+    for path in unreadable:
+        yield path, None
+
+    # Never nest pools: inside a spawned child (or a worker) parse in-process
+    if workers <= 1 or len(tasks) <= 1 or _in_worker_process():
+        yield from _parse_serially(tasks)
+        return
+
+    done = 0  # tasks fully yielded
+    try:
+        # spawn: forking a threaded server process can deadlock in the child
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks)), mp_context=ctx) as pool:
+            pending = deque()
+            remaining = iter(tasks)
+            for path, start, end in islice(remaining, workers * 2):
+                pending.append((path, start, pool.submit(parse_page_range, path, start, end)))
+            while pending:
+                path, start, future = pending.popleft()
+                next_task = next(remaining, None)
+                if next_task:
+                    pending.append((next_task[0], next_task[1], pool.submit(parse_page_range, *next_task)))
+                try:
+                    pages = future.result()
+                except BrokenProcessPool:
+                    raise
+                except Exception as e:
+                    print(f"DEBUG: Failed to parse {path} from page {start + 1}: {e}")
+                    yield path, None
+                    done += 1
+                    continue
+                for page in pages:
+                    yield path, page
+                done += 1
+    except BrokenProcessPool as e:
+        print(f"DEBUG: Parser pool broke ({e}), parsing the remaining {len(tasks) - done} page ranges serially")
+        yield from _parse_serially(tasks[done:])
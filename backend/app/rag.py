@@ -1,129 +1,344 @@
 import os
+import re
 import json
 import time
+import hashlib
+import threading
+from contextlib import aclosing
 from typing import List, Optional
 import google.generativeai as genai
-from langchain_community.document_loaders import PyPDFLoader, DirectoryLoader
-from .image_utils import extract_page_as_base64, get_manual_path
-# from google.generativeai.caching import CachedContent
+from .concurrency import run_blocking
+from .image_utils import document_pool, get_manual_path, prewarm_page_cache, visual_page_url
+from .answer_bank import get_answer_bank
+from .answer_cache import answer_cache
+from .context_cache import GeminiContextCache
+from .dedup import PageDeduplicator
+from .glossary import Glossary
+from .llm_client import UpstreamUnavailable, llm_client
+from .llm_response import diagnosis_generation_config, normalize_step, parse_diagnosis, parse_stats
+from .manual_store import ManualStore, file_sha256, get_manual_store
+from .page_cache import PREWARM_TOP_N, get_page_cache
+from .pdf_parse import INGEST_WORKERS, iter_parsed_pages
+from .retrieval import ManualIndex, format_chunks, load_local_embedder, TOP_K
+from .token_budget import CONTEXT_CANDIDATES, TOKEN_BUDGETS, budget_for, estimate_tokens, pack_chunks, pack_pages, token_usage
 
 # Setup paths
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 MANUALS_DIR = os.path.join(BASE_DIR, "..", "manuals")
 
 # Global variables
-_full_context_cache = None
-_gemini_cache: Optional[any] = None
-_cache_expiry = 0
-
-def get_full_context():
-    """Reads all PDF manuals and returns full text with page numbers."""
-    global _full_context_cache
-    if _full_context_cache is not None:
-        return _full_context_cache
-        
-    try:
-        if not os.path.exists(MANUALS_DIR):
-            print(f"DEBUG: Manuals directory not found at {MANUALS_DIR}")
-            return ""
+_manual_index: Optional[ManualIndex] = None
+_glossary = Glossary()
+_corpus = {}  # filename -> {"hash", "stat", "fingerprints", "kept", "chars"}
+_corpus_loaded = False
+_context_length = 0
+_corpus_version = ""
+_dedup_report = {"duplicate_files": {}, "duplicate_pages": []}
+_unparseable = {}  # filename -> stat of a file that failed to parse; retried once it changes
+_ingest_lock = threading.Lock()
+_context_cache = GeminiContextCache(genai, contents_fn=lambda: get_full_context())
 
-        print("Loading PDF manuals locally...")
-        manual_files = [f for f in os.listdir(MANUALS_DIR) if f.lower().endswith('.pdf')]
-        
-        # Deduplicate by basename (ignore case/extension) or size to skip redundant versions
-        seen_sizes = set()
-        unique_manuals = []
-        for f in manual_files:
+def _format_page(source: str, page_num: int, text: str) -> str:
+    # Format: "[[Source: x.pdf | Page: 1]]\nContent..."
+    content = text.replace('\n', ' ')
+    return f"[[Source: {source} | Page: {page_num}]]\n{content}\n"
+
+def _stream_pages(store: ManualStore, content_hash: str, pages: set, stats: dict):
+    """Yields (page_num, text) for the kept pages of one manual, counting formatted context size."""
+    for page_num, text in store.iter_pages(content_hash, pages):
+        stats["chars"] += len(text) + len(f"[[Source:  | Page: {page_num}]]\n\n\n") + len(stats["source"])
+        yield page_num, text.replace('\n', ' ')
+
+def _load_fingerprints(store: ManualStore, content_hash: str) -> List[tuple]:
+    """Returns (page_num, simhash, chars) per page of a stored manual."""
+    # Stored as hex strings: SQLite's JSON functions would round 64-bit integers to floats
+    return [(page_num, int(fp, 16), chars) for page_num, fp, chars in store.get_fingerprints(content_hash)]
+
+def _scan_manuals() -> dict:
+    """Returns {filename: (size, mtime)} for the PDFs in MANUALS_DIR."""
+    files = {}
+    for f in sorted(os.listdir(MANUALS_DIR)):
+        if f.lower().endswith('.pdf'):
+            st = os.stat(os.path.join(MANUALS_DIR, f))
+            files[f] = (st.st_size, st.st_mtime)
+    return files
+
+def _parse_into_store(store: ManualStore, to_parse: dict) -> List[str]:
+    """
+    Streams pages from the parser pool straight into the manual store, one page at a time.
+    Returns the paths that were stored completely.
+    """
+    writers = {}
+    failed = set()
+    for f_path, page in iter_parsed_pages(list(to_parse)):
+        if f_path in failed:
+            continue
+        if page is None:
+            failed.add(f_path)
+            if f_path in writers:
+                writers.pop(f_path).abort()
+            continue
+        if f_path not in writers:
+            writers[f_path] = store.writer(to_parse[f_path][1])
+        writers[f_path].add(page)
+
+    for f_path, writer in writers.items():
+        f, _, stat, _ = to_parse[f_path]
+        writer.commit(f, stat[0])
+    return list(writers)
+
+def _deduplicate(corpus: dict) -> tuple:
+    """
+    Decides which files and pages make it into the context, in filename order.
+    Files with identical content hashes are loaded once; pages that are near-duplicates
+    (SimHash) of a page in an earlier file, e.g. unchanged pages across manual revisions, are
+    dropped. Similar pages within one manual (repeated steps for different models) are kept.
+    Returns ({filename: [page_num]}, report).
+    """
+    kept = {}
+    report = {"duplicate_files": {}, "duplicate_pages": []}
+    owners = {}
+    pages_dedup = PageDeduplicator()
+    for f in sorted(corpus):
+        entry = corpus[f]
+        if entry["hash"] in owners:
+            report["duplicate_files"][f] = owners[entry["hash"]]
+            print(f"DEBUG: Skipping redundant manual '{f}' (same content as '{owners[entry['hash']]}')")
+            continue
+        owners[entry["hash"]] = f
+        pages = []
+        for page_num, fingerprint, chars in entry["fingerprints"]:
+            original = pages_dedup.check_and_add((f, page_num), fingerprint, chars, group=f)
+            if original:
+                report["duplicate_pages"].append(
+                    {"source": f, "page": page_num, "duplicate_of": {"source": original[0], "page": original[1]}}
+                )
+                continue
+            pages.append(page_num)
+        kept[f] = pages
+    return kept, report
+
+def _sync_corpus() -> dict:
+    """
+    Brings the corpus and retrieval index in line with MANUALS_DIR.
+    Only added or changed files are hashed and parsed. Pages are streamed from the parser into
+    the manual store and from the store into the index and query glossary one at a time, so
+    ingestion never holds a whole manual's pages at once. The index itself keeps every chunk's
+    text in memory, so resident size still grows with the corpus. Readers keep seeing the
+    previous corpus until each source is swapped.
+    Returns the names of added, changed and removed manuals.
+    """
+    global _corpus, _corpus_loaded, _context_length, _corpus_version, _manual_index, _dedup_report
+    with _ingest_lock:
+        files = _scan_manuals() if os.path.exists(MANUALS_DIR) else {}
+        if not files:
+            print(f"DEBUG: No manuals found in {MANUALS_DIR}")
+
+        store = get_manual_store()
+        corpus = {f: entry for f, entry in _corpus.items() if f in files}
+        diff = {"added": [], "changed": [], "removed": [f for f in _corpus if f not in files]}
+        to_load = {}  # f_path -> (filename, content_hash, stat, previous entry)
+        for f, stat in files.items():
+            entry = corpus.get(f)
+            if (entry and entry["stat"] == stat) or _unparseable.get(f) == stat:
+                continue
             f_path = os.path.join(MANUALS_DIR, f)
-            f_size = os.path.getsize(f_path)
-            if f_size not in seen_sizes:
-                seen_sizes.add(f_size)
-                unique_manuals.append(f_path)
-            else:
-                print(f"DEBUG: Skipping redundant manual '{f}' (size mismatch or identical to already loaded)")
-
-        all_pages = []
-        for f_path in unique_manuals:
             try:
-                print(f"DEBUG: Parsing {os.path.basename(f_path)}...")
-                loader = PyPDFLoader(f_path)
-                all_pages.extend(loader.load())
+                content_hash = file_sha256(f_path)
             except Exception as e:
-                print(f"DEBUG: Failed to parse {f_path}: {e}")
-
-        if not all_pages:
-            print("DEBUG: No documents were found/loaded from manuals directory")
-            return ""
-            
-        # Format: "Page 1: Content..."
-        formatted_pages = []
-        for doc in all_pages:
-            page_num = doc.metadata.get('page', 0) + 1 
-            source = os.path.basename(doc.metadata.get('source', 'Manual'))
-            content = doc.page_content.replace('\n', ' ')
-            formatted_pages.append(f"[[Source: {source} | Page: {page_num}]]\n{content}\n")
-            
-        _full_context_cache = "\n".join(formatted_pages)
-        print(f"Loaded full context: {len(_full_context_cache)} chars from {len(all_pages)} pages")
-        return _full_context_cache
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        print(f"Error loading full context: {e}")
+                print(f"DEBUG: Failed to read {f_path}: {e}")
+                continue
+            if entry and entry["hash"] == content_hash:
+                # Touched but identical content: nothing to re-parse
+                corpus[f] = dict(entry, stat=stat)
+                continue
+            to_load[f_path] = (f, content_hash, stat, entry)
+
+        to_parse = {p: v for p, v in to_load.items() if not store.has_manual(v[1])}
+        if to_parse:
+            # Byte-identical files share one content hash, so each is parsed and stored once
+            first_by_hash = {}
+            for f_path, v in to_parse.items():
+                first_by_hash.setdefault(v[1], f_path)
+            unique = {f_path: to_parse[f_path] for f_path in first_by_hash.values()}
+            print(f"DEBUG: Parsing {len(unique)} manual(s) with up to {INGEST_WORKERS} worker(s)...")
+            parsed = {to_parse[f_path][1] for f_path in _parse_into_store(store, unique)}
+            to_load = {p: v for p, v in to_load.items() if p not in to_parse or v[1] in parsed}
+            for f, content_hash, stat, _ in to_parse.values():
+                if content_hash not in parsed:
+                    print(f"DEBUG: Skipping unparseable manual '{f}' until it changes")
+                    _unparseable[f] = stat
+
+        for f_path, (f, content_hash, stat, entry) in to_load.items():
+            if f_path not in to_parse:
+                print(f"DEBUG: Loaded {f} from manual store")
+            diff["changed" if entry else "added"].append(f)
+            corpus[f] = {
+                "hash": content_hash, "stat": stat,
+                "fingerprints": _load_fingerprints(store, content_hash), "kept": None, "chars": 0,
+            }
+
+        kept, report = _deduplicate(corpus)
+
+        # Splice: only sources whose kept pages changed are re-indexed, streamed from the store
+        index = _manual_index if _manual_index is not None else ManualIndex(embed_fn=load_local_embedder())
+        for f in set(_corpus) | set(corpus):
+            pages = kept.get(f)
+            if pages is None:
+                index.remove_source(f)
+                _glossary.remove_source(f)
+                if f in corpus:
+                    corpus[f] = dict(corpus[f], kept=None, chars=0)
+            elif corpus[f]["kept"] != pages:
+                stats = {"source": f, "chars": 0}
+                pages_stream = _stream_pages(store, corpus[f]["hash"], set(pages), stats)
+                index.replace_source(f, _glossary.tap(f, pages_stream))
+                corpus[f] = dict(corpus[f], kept=pages, chars=stats["chars"])
+
+        _corpus = corpus
+        _manual_index = index
+        _dedup_report = report
+        _context_length = sum(entry["chars"] for entry in corpus.values())
+        _corpus_version = hashlib.sha256(
+            "|".join(f"{f}:{corpus[f]['hash']}:{len(kept[f])}" for f in sorted(kept)).encode("utf-8")
+        ).hexdigest()[:16]
+        _corpus_loaded = True
+        # Precomputed answers citing a changed or removed manual stop being served
+        get_answer_bank().sync_corpus(
+            {f: entry["hash"] for f, entry in corpus.items() if entry["kept"] is not None}, _corpus_version
+        )
+        if _context_length:
+            print(f"Loaded full context: {_context_length} chars, {len(index)} chunks "
+                  f"(added {len(diff['added'])}, changed {len(diff['changed'])}, removed {len(diff['removed'])}, "
+                  f"duplicate pages skipped {len(report['duplicate_pages'])})")
+        return diff
+
+def _ensure_corpus() -> bool:
+    """Loads the corpus on first use. Returns True if any manual text is available."""
+    if not _corpus_loaded:
+        try:
+            print("Loading PDF manuals locally...")
+            _sync_corpus()
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            print(f"Error loading full context: {e}")
+    return _context_length > 0
+
+def corpus_changed() -> bool:
+    """True if a manual was added, changed or removed in MANUALS_DIR since the loaded corpus was synced."""
+    if not _corpus_loaded:
+        return False
+    files = _scan_manuals() if os.path.exists(MANUALS_DIR) else {}
+    pending = {f: stat for f, stat in files.items() if _unparseable.get(f) != stat}
+    return pending != {f: entry["stat"] for f, entry in _corpus.items()}
+
+def get_corpus_version() -> str:
+    """Short hash identifying the loaded manuals; changes whenever ingestion changes the corpus."""
+    _ensure_corpus()
+    return _corpus_version
+
+def iter_context_pages():
+    """Yields the [[Source | Page]] block of every kept page, streamed from the manual store."""
+    if not _ensure_corpus():
+        return
+    store = get_manual_store()
+    corpus = _corpus
+    for f in sorted(corpus):
+        entry = corpus[f]
+        if not entry["kept"]:
+            continue
+        for page_num, text in store.iter_pages(entry["hash"], set(entry["kept"])):
+            yield _format_page(f, page_num, text)
+
+def get_full_context(max_tokens: Optional[int] = None):
+    """
+    Returns manual text with page markers, assembled from the store on demand.
+    With max_tokens, stops at the last whole page that fits the (estimated) token budget
+    instead of reading every manual.
+    """
+    if max_tokens is None:
+        return "\n".join(iter_context_pages())
+    blocks, _ = pack_pages(iter_context_pages(), max_tokens)
+    return "\n".join(blocks)
+
+def get_manual_index() -> Optional[ManualIndex]:
+    """Returns the chunk index built at ingest time, loading manuals if needed."""
+    _ensure_corpus()
+    return _manual_index
+
+def retrieve_context(query: str, max_tokens: int = TOKEN_BUDGETS["diagnosis"]) -> str:
+    """
+    Returns the manual chunks most relevant to the query, packed whole (best first) into
+    max_tokens, formatted with page markers.
+    """
+    index = get_manual_index()
+    if not index:
         return ""
+    chunks = index.search(_glossary.expand_query(query), k=CONTEXT_CANDIDATES)
+    if not chunks:
+        # Nothing matched lexically; fall back to the start of the manual (TOC / basics)
+        chunks = index.first_chunks(TOP_K)
+    chosen, _ = pack_chunks(chunks, max_tokens)
+    return format_chunks(chosen)
+
+def locate_page(text: str, page: Optional[int] = None) -> Optional[tuple]:
+    """
+    Resolves a script scene to a (manual, page).
+    With an explicit page number, picks the manual whose chunks on that page best match the text;
+    without one, uses the best matching chunk's page.
+    """
+    index = get_manual_index()
+    if not index:
+        return None
+    hits = index.search(text, k=TOP_K) if text.strip() else []
+    if page is None:
+        return (hits[0]["source"], hits[0]["page"]) if hits else None
+    for chunk in hits:
+        if chunk["page"] == page:
+            return chunk["source"], page
+    if hits:
+        return hits[0]["source"], page
+    return (next(iter(_corpus)), page) if len(_corpus) == 1 else None
 
 def _ensure_cache():
     """Ensures that the Gemini Context Cache is created and valid."""
-    global _gemini_cache, _cache_expiry
-    
-    # Configure GenAI globally/idempotently
-    if os.environ.get("GOOGLE_API_KEY"):
-        genai.configure(api_key=os.environ["GOOGLE_API_KEY"])
-    else:
+    # Configure GenAI once per key
+    if not llm_client.configure():
         print("GOOGLE_API_KEY not found in environment.")
         return None
 
-    full_context = get_full_context()
-    if not full_context:
+    if not _ensure_corpus():
         print("Full context is empty, cannot create cache.")
         return None
 
-    # Check if cache exists and is valid
-    current_time = time.time()
-    if _gemini_cache and current_time < _cache_expiry:
-        return _gemini_cache
-
-    print("Context Caching is disabled or not supported in this environment.")
-    return None
-    # try:
-    #     # Create cache
-    #     _gemini_cache = genai.caching.CachedContent.create(
-    #         model='models/gemini-2.0-flash-001',
-    #         display_name='manual_cache',
-    #         system_instruction='You are a helpful technical support assistant for Canon TS6330.',
-    #         contents=[full_context],
-    #         ttl=datetime.timedelta(minutes=60)
-    #     )
-    #     _cache_expiry = current_time + (55 * 60) # Refresh before 60 mins
-    #     print(f"Cache created: {_gemini_cache.name}")
-    #     return _gemini_cache
-    # except Exception as e:
-    #     print(f"Error creating cache: {e}")
-    #     return None
-
-import datetime
+    if os.environ.get("GEMINI_CONTEXT_CACHE", "1") == "0":
+        return None
+    return _context_cache.get()
 
 def ingest_manuals():
-    """Refreshes the full context cache and Gemini cache."""
-    global _full_context_cache, _gemini_cache
-    _full_context_cache = None
-    _gemini_cache = None # Force recreation
-    
-    ctx = get_full_context()
-    if ctx:
+    """Re-syncs the corpus with MANUALS_DIR (parsing only new or changed files) and the Gemini cache."""
+    try:
+        diff = _sync_corpus()
+    except Exception as e:
+        print(f"Error ingesting manuals: {e}")
+        return "No manuals found or error loading."
+
+    if diff["added"] or diff["changed"] or diff["removed"]:
+        _context_cache.invalidate() # Force recreation
+        answer_cache.clear()
+        get_page_cache().prune(entry["hash"] for entry in _corpus.values())
+        document_pool.invalidate()
+
+    warmed = prewarm_page_cache(MANUALS_DIR, PREWARM_TOP_N, fmt="webp")
+    if warmed:
+        print(f"DEBUG: Pre-rendered {warmed} frequently referenced pages")
+
+    if _context_length:
         # Pre-warm cache
         _ensure_cache()
-        return f"Loaded {len(ctx)} characters from manuals and updated cache."
+        return (f"Loaded {_context_length} characters from manuals and updated cache "
+                f"(added: {len(diff['added'])}, changed: {len(diff['changed'])}, removed: {len(diff['removed'])}).")
     else:
         return "No manuals found or error loading."
 
@@ -135,219 +350,363 @@ def get_loaded_status():
     
     return {
         "manuals": manuals,
-        "is_context_loaded": _full_context_cache is not None,
-        "context_length": len(_full_context_cache) if _full_context_cache else 0,
-        "is_gemini_cached": _gemini_cache is not None
+        "is_context_loaded": _corpus_loaded and _context_length > 0,
+        "context_length": _context_length,
+        "index_chunks": len(_manual_index) if _manual_index else 0,
+        "stored_manuals": len(get_manual_store().list_manuals()),
+        "dedup": {
+            "duplicate_files": _dedup_report["duplicate_files"],
+            "duplicate_page_count": len(_dedup_report["duplicate_pages"]),
+            "duplicate_pages": _dedup_report["duplicate_pages"][:100],
+        },
+        "is_gemini_cached": _context_cache.is_valid(),
+        "gemini_cache": _context_cache.status(),
+        "corpus_version": _corpus_version,
+        "answer_cache": answer_cache.stats(),
+        "answer_bank": get_answer_bank().stats(),
+        "response_parser": parse_stats.stats(),
+        "llm": llm_client.stats(),
+        "token_usage": token_usage.stats(),
+        "glossary": _glossary.stats(),
+        "page_cache": get_page_cache().stats(),
     }
 
-def get_rag_diagnosis(query: str, persona: str = "Technical"):
+_PERSONA_INSTRUCTION = {
+    "YouTuber": "あなたは元気いっぱいのガジェット系YouTuberです。視聴者に語りかけるように、エネルギッシュでフレンドリーに応対してください。",
+    "Teacher": "あなたは親切なベテラン技術講師です。論理的で分かりやすく、敬語で丁寧に指導してください。",
+    "Technical": "あなたは Canon TS6330 の専門技術者です。正確かつ迅速な解決策をプロフェッショナルに提示してください。"
+}
+
+_PERSONA_STYLE = {
+    "YouTuber": "ガジェット系YouTuber風に、テンション高めで「こんにちは！今日は〇〇の解決策をお届けします！」と始めてください。",
+    "Teacher": "ベテラン技術講師風に、落ち着いたトーンで「それでは解説を始めましょう」と始めてください。",
+    "Technical": "親しみやすいラジオMC風に、共感を示しながら始めてください。"
+}
+
+def _prepare_diagnosis(query: str, persona: str) -> dict:
     """
-    Diagnosis using Gemini with persona support and Visual RAG.
+    Picks the cached or fallback model and builds the prompt.
+    Returns {"model", "prompt", "prompt_tokens", "cached", "generation_config"},
+    or {"error": payload} when no manual is loaded.
+    generation_config requests JSON constrained to the DiagnoseResponse schema.
+    Blocking (may create the context cache), so async callers run it in a thread.
     """
-    try:
-        cache = _ensure_cache()
-        
-        if not cache:
-            # Fallback to non-cached if cache creation failed
-            print("Fallback to non-cached RAG")
-            full_context = get_full_context()
-            if not full_context:
-                 return {
-                    "probable_causes": ["Manual not loaded"],
-                    "steps": ["Please upload the manual PDF."],
-                    "confidence": 0.0,
-                    "cautions": [],
-                    "next_actions": {},
-                    "disclaimer": "System not initialized.",
-                    "referenced_pages": [],
-                    "source_file": None
-                }
-            
-            # Just use direct genai without cache for fallback
-            # Ensure configured even if _ensure_cache returned None (though it does configure now)
-            if os.environ.get("GOOGLE_API_KEY"):
-                genai.configure(api_key=os.environ["GOOGLE_API_KEY"])
-
-            # Fallback model: use stable gemini-flash-latest
-            model = genai.GenerativeModel('gemini-flash-latest')
-            print(f"[{time.time()}] Gemini Flash Fallback Prompting...", flush=True)
-
-            # Persona adjustment
-            persona_instruction = {
-                "YouTuber": "あなたは元気いっぱいのガジェット系YouTuberです。視聴者に語りかけるように、エネルギッシュでフレンドリーに応対してください。",
-                "Teacher": "あなたは親切なベテラン技術講師です。論理的で分かりやすく、敬語で丁寧に指導してください。",
-                "Technical": "あなたは Canon TS6330 の専門技術者です。正確かつ迅速な解決策をプロフェッショナルに提示してください。"
-            }.get(persona, "あなたは Canon TS6330 の専門技術者です。")
-
-            prompt = f"""
-            {persona_instruction}
-            以下のマニュアルを使用して、ユーザーの問題: "{query}" を診断してください。
-            
-            マニュアル:
-            {full_context[:60000]} (Truncated if needed, but Flash handles large context well)
-            
-            JSON形式で回答してください:
-            {{
-                "probable_causes": ["原因1"],
-                "confidence": 0.8,
-                "steps": ["手順1"],
+    cache = _ensure_cache()
+    
+    if not cache:
+        # Fallback to non-cached if cache creation failed
+        print("Fallback to non-cached RAG")
+        manual_context = retrieve_context(query, budget_for("diagnosis", persona))
+        if not manual_context:
+             return {"error": {
+                "probable_causes": ["Manual not loaded"],
+                "steps": ["Please upload the manual PDF."],
+                "confidence": 0.0,
                 "cautions": [],
-                "next_actions": {{}},
-                "disclaimer": "...",
-                "referenced_pages": [10, 20],
-                "source_file": "manual.pdf"
+                "next_actions": {},
+                "disclaimer": "System not initialized.",
+                "referenced_pages": [],
+                "source_file": None
             }}
-            IMPORTANT: "referenced_pages" MUST be a list of integers. Do NOT use strings like "P.10". Only numbers. e.g. [10, 35].
-            """
-            
-            try:
-                resp = model.generate_content(prompt)
-                print(f"[{time.time()}] Gemini Flash Fallback Response Received.", flush=True)
-                text = resp.text
-                if "```json" in text:
-                    text = text.split("```json")[1].split("```")[0]
-                elif "```" in text:
-                    text = text.split("```")[1].split("```")[0]
-                
-                data = json.loads(text)
-                
-                # --- NORMALIZE DATA FOR PYDANTIC ---
-                # 1. Normalize steps (Ensure List[str])
-                if "steps" in data:
-                    new_steps = []
-                    for s in data["steps"]:
-                        if isinstance(s, str):
-                            new_steps.append(s)
-                        elif isinstance(s, dict) and "description" in s:
-                             new_steps.append(s["description"])
-                        elif isinstance(s, dict) and "step" in s:
-                             new_steps.append(s["step"])
-                        else:
-                            new_steps.append(str(s))
-                    data["steps"] = new_steps
-
-                # 2. Normalize referenced_pages (Ensure List[int])
-                if "referenced_pages" in data:
-                    new_pages = []
-                    for p in data["referenced_pages"]:
-                        try:
-                            if isinstance(p, int):
-                                new_pages.append(p)
-                            elif isinstance(p, str):
-                                # Extract digits
-                                import re
-                                digits = re.findall(r'\d+', p)
-                                if digits:
-                                    new_pages.append(int(digits[0]))
-                        except:
-                            pass
-                    data["referenced_pages"] = new_pages
-                
-                # 3. Visual RAG: Extract diagram if possible
-                if data.get("referenced_pages") and data.get("source_file"):
-                    try:
-                        first_page = data["referenced_pages"][0]
-                        m_path = get_manual_path(data["source_file"])
-                        data["visual_page_base64"] = extract_page_as_base64(m_path, first_page)
-                    except Exception as ve:
-                        print(f"DEBUG: Visual RAG Error: {ve}")
-
-                return data
-            except Exception as e:
-                print(f"[{time.time()}] Fallback Generation Error: {e}")
-                import traceback
-                traceback.print_exc()
-                return {"probable_causes": ["Diagnosis failed (API Error)"], "steps": ["Please try again."], "confidence": 0.0, "referenced_pages": [], "next_actions": {}, "cautions": [], "disclaimer": f"Gemini Error: {str(e)}"}
-
-        # Cached Path
-        model = genai.GenerativeModel.from_cached_content(cached_content=cache)
         
+        # Fallback model without cache: the shared gemini-flash-latest model
+        model = llm_client.model()
+        print(f"[{time.time()}] Gemini Flash Fallback Prompting...", flush=True)
+
+        # Persona adjustment
+        persona_instruction = _PERSONA_INSTRUCTION.get(persona, "あなたは Canon TS6330 の専門技術者です。")
+
         prompt = f"""
-        ユーザーの課題: {query}
+        {persona_instruction}
+        以下のマニュアルを使用して、ユーザーの問題: "{query}" を診断してください。
+        
+        マニュアル (質問に関連する抜粋):
+        {manual_context}
         
-        専門用語をなるべく使わず、初心者にもわかりやすい言葉で以下のJSON形式で診断してください:
+        JSON形式で回答してください:
         {{
-            "probable_causes": ["原因1", "原因2"],
+            "probable_causes": ["原因1"],
             "confidence": 0.8,
-            "steps": ["手順1", "手順2"],
-            "cautions": ["注意点"],
-            "next_actions": {{ "primary": "action", "secondary": [] }},
+            "steps": ["手順1"],
+            "cautions": [],
+            "next_actions": {{}},
             "disclaimer": "...",
-            "referenced_pages": [10, 12],
-            "source_file": "TS6330.pdf"
+            "referenced_pages": [10, 20],
+            "source_file": "manual.pdf"
         }}
-        Important: "referenced_pages" MUST be integers extracted from [[Source: ... | Page: X]] markers.
+        IMPORTANT: "referenced_pages" MUST be a list of integers. Do NOT use strings like "P.10". Only numbers. e.g. [10, 35].
         """
-        
+        return {"model": model, "prompt": prompt, "prompt_tokens": estimate_tokens(prompt), "cached": False,
+                "generation_config": diagnosis_generation_config()}
+
+    # Cached Path
+    model = _context_cache.model_for(cache)
+    # The whole manual is cached, so point the model at the manual's own terms for the user's wording
+    terms = _glossary.expand(query)
+    term_hint = f"関連するマニュアル用語: {', '.join(terms)}" if terms else ""
+    
+    prompt = f"""
+    ユーザーの課題: {query}
+    {term_hint}
+    
+    専門用語をなるべく使わず、初心者にもわかりやすい言葉で以下のJSON形式で診断してください:
+    {{
+        "probable_causes": ["原因1", "原因2"],
+        "confidence": 0.8,
+        "steps": ["手順1", "手順2"],
+        "cautions": ["注意点"],
+        "next_actions": {{ "primary": "action", "secondary": [] }},
+        "disclaimer": "...",
+        "referenced_pages": [10, 12],
+        "source_file": "TS6330.pdf"
+    }}
+    Important: "referenced_pages" MUST be integers extracted from [[Source: ... | Page: X]] markers.
+    """
+    return {"model": model, "prompt": prompt, "prompt_tokens": estimate_tokens(prompt), "cached": True,
+            "generation_config": diagnosis_generation_config()}
+
+def _attach_visual(data: dict) -> dict:
+    """
+    Visual RAG: links the first referenced page as an image URL served by /api/pages,
+    cropped to its main diagram when one was detected.
+    Hashes the manual on first use, so async callers offload it.
+    """
+    if data.get("referenced_pages") and data.get("source_file"):
         try:
-            response = model.generate_content(prompt)
-            text = response.text
-            if "```json" in text:
-                text = text.split("```json")[1].split("```")[0]
-            elif "```" in text:
-                text = text.split("```")[1].split("```")[0]
-            return json.loads(text)
+            cache = get_page_cache()
+            for page_num in data["referenced_pages"]:
+                cache.record_reference(data["source_file"], page_num)
+            first_page = data["referenced_pages"][0]
+            if os.path.exists(get_manual_path(data["source_file"])):
+                data["visual_page_url"] = visual_page_url(data["source_file"], first_page)
+        except Exception as ve:
+            print(f"DEBUG: Visual RAG Error: {ve}")
+    return data
+
+def _generation_error(e: Exception, cached: bool) -> dict:
+    import traceback
+    traceback.print_exc()
+    if cached:
+        print(f"Cached Generation Error: {e}")
+        return {"probable_causes": ["Error (Cached)"], "steps": ["Try again."], "confidence": 0, "referenced_pages": [], "next_actions": {}, "cautions": [], "disclaimer": str(e)}
+    print(f"[{time.time()}] Fallback Generation Error: {e}")
+    return {"probable_causes": ["Diagnosis failed (API Error)"], "steps": ["Please try again."], "confidence": 0.0, "referenced_pages": [], "next_actions": {}, "cautions": [], "disclaimer": f"Gemini Error: {str(e)}"}
+
+def _system_error(e: Exception) -> dict:
+    print(f"Outer Diagnosis Error: {e}")
+    return {"probable_causes": ["System Error"], "steps": [], "confidence": 0, "referenced_pages": [], "next_actions": {}, "cautions": [], "disclaimer": str(e)}
+
+def _fallback_answer(query: str, persona: str, e: Exception) -> dict:
+    """
+    Answer while Gemini is unavailable: the cached answer for a similar question (even if expired),
+    otherwise a degraded answer pointing at the best-matching manual pages.
+    """
+    print(f"DEBUG: Gemini unavailable ({e}), answering without the LLM", flush=True)
+    cached = answer_cache.get(query, persona, _corpus_version, allow_stale=True)
+    if cached is not None:
+        return cached
+    hits = _manual_index.search(query, k=3) if _manual_index else []
+    source = hits[0]["source"] if hits else None
+    pages = sorted({h["page"] for h in hits if h["source"] == source})
+    return _attach_visual({
+        "probable_causes": ["AIによる診断が一時的に利用できません"],
+        "steps": [f"マニュアル「{source}」の {p} ページをご確認ください。" for p in pages] or ["しばらくしてから再度お試しください。"],
+        "confidence": 0.0,
+        "cautions": [],
+        "next_actions": {"primary": "しばらくしてから再度お試しください。", "secondary": []},
+        "disclaimer": f"Degraded answer (Gemini unavailable): {e}",
+        "referenced_pages": pages,
+        "source_file": source,
+    })
+
+def get_rag_diagnosis(query: str, persona: str = "Technical"):
+    """
+    Diagnosis using Gemini with persona support and Visual RAG.
+    """
+    try:
+        plan = _prepare_diagnosis(query, persona)
+        if "error" in plan:
+            return plan["error"]
+        try:
+            response = llm_client.generate(plan["model"], plan["prompt"], generation_config=plan["generation_config"])
+            print(f"[{time.time()}] Gemini Response Received.", flush=True)
+            token_usage.record("diagnosis", persona, plan["prompt_tokens"], response, response.text)
+            return _attach_visual(parse_diagnosis(response.text))
+        except UpstreamUnavailable as e:
+            return _fallback_answer(query, persona, e)
         except Exception as e:
-            print(f"Cached Generation Error: {e}")
-            import traceback
-            traceback.print_exc()
-            return {"probable_causes": ["Error (Cached)"], "steps": ["Try again."], "confidence": 0, "referenced_pages": [], "next_actions": {}, "cautions": [], "disclaimer": str(e)}
+            return _generation_error(e, plan["cached"])
+    except Exception as e:
+        return _system_error(e)
 
+async def get_rag_diagnosis_async(query: str, persona: str = "Technical"):
+    """
+    Non-blocking get_rag_diagnosis for the FastAPI event loop.
+    Uses the async Gemini client under the 'gemini' concurrency limit and offloads
+    cache/corpus setup and page rendering to worker threads.
+    """
+    try:
+        plan = await run_blocking("setup", _prepare_diagnosis, query, persona)
+        if "error" in plan:
+            return plan["error"]
+        try:
+            response = await llm_client.generate_async(
+                plan["model"], plan["prompt"], generation_config=plan["generation_config"]
+            )
+            print(f"[{time.time()}] Gemini Response Received.", flush=True)
+            token_usage.record("diagnosis", persona, plan["prompt_tokens"], response, response.text)
+            data = parse_diagnosis(response.text)
+            return await run_blocking("render", _attach_visual, data)
+        except UpstreamUnavailable as e:
+            return await run_blocking("render", _fallback_answer, query, persona, e)
+        except Exception as e:
+            return _generation_error(e, plan["cached"])
     except Exception as e:
-        print(f"Outer Diagnosis Error: {e}")
-        return {"probable_causes": ["System Error"], "steps": [], "confidence": 0, "referenced_pages": [], "next_actions": {}, "cautions": [], "disclaimer": str(e)}
+        return _system_error(e)
 
-def get_video_script(query: str, persona: str = "Technical"):
+class _StreamingArrayReader:
     """
-    Generates persona-based script using Gemini Context Caching or Fallback.
+    Pulls complete elements of one JSON array (e.g. "steps") out of a JSON object
+    that is still being received, so they can be shown before the answer is finished.
+    """
+
+    def __init__(self, key: str):
+        self.pattern = re.compile(r'"%s"\s*:\s*\[' % re.escape(key))
+        self.pos = None
+        self.done = False
+        self._decoder = json.JSONDecoder()
+
+    def feed(self, text: str) -> list:
+        """Returns the elements completed since the previous call; text is everything received so far."""
+        values = []
+        if self.done:
+            return values
+        if self.pos is None:
+            match = self.pattern.search(text)
+            if not match:
+                return values
+            self.pos = match.end()
+        while True:
+            i = self.pos
+            while i < len(text) and text[i] in " \t\r\n,":
+                i += 1
+            self.pos = i
+            if i >= len(text):
+                break
+            if text[i] == "]":
+                self.done = True
+                break
+            try:
+                value, end = self._decoder.raw_decode(text, i)
+            except ValueError:
+                break  # element not fully received yet
+            values.append(value)
+            self.pos = end
+        return values
+
+async def stream_rag_diagnosis(query: str, persona: str = "Technical"):
+    """
+    Streaming variant of get_rag_diagnosis_async. Async generator of (event, data):
+    "cause" / "step" as soon as each array element is complete in the token stream,
+    "pages" once the answer is parsed, then "result" with the full payload (visual included).
+    Errors are reported as a "result" carrying the usual error payload.
     """
     try:
-        cache = _ensure_cache()
-        if cache:
-             model = genai.GenerativeModel.from_cached_content(cached_content=cache)
-        else:
-             print("Video Gen: Falling back to non-cached")
-             if os.environ.get("GOOGLE_API_KEY"):
-                genai.configure(api_key=os.environ["GOOGLE_API_KEY"])
-             model = genai.GenerativeModel('gemini-flash-latest')
-        
-        # If fallback, we need context in prompt? 
-        # Yes, if no cache, manual isn't loaded in model.
-        # But for video script, maybe we don't need FULL manual if we have diagnosis?
-        # Ideally we pass full context or the relevant parts.
-        # For simplicity, let's pass context if fallback.
+        plan = await run_blocking("setup", _prepare_diagnosis, query, persona)
+        if "error" in plan:
+            yield "result", plan["error"]
+            return
+        readers = {"cause": _StreamingArrayReader("probable_causes"), "step": _StreamingArrayReader("steps")}
+        text = ""
+        try:
+            chunk = None
+            # aclosing: the Gemini slot is released as soon as this loop exits, even on error
+            async with aclosing(llm_client.stream_async(
+                plan["model"], plan["prompt"], generation_config=plan["generation_config"]
+            )) as stream:
+                async for chunk in stream:
+                    text += chunk.text
+                    for event, reader in readers.items():
+                        for value in reader.feed(text):
+                            yield event, normalize_step(value) if event == "step" else str(value)
+            print(f"[{time.time()}] Gemini Stream Completed.", flush=True)
+            # The last chunk carries the usage totals for the whole response
+            token_usage.record("diagnosis", persona, plan["prompt_tokens"], chunk, text)
+            data = parse_diagnosis(text)
+        except UpstreamUnavailable as e:
+            yield "result", await run_blocking("render", _fallback_answer, query, persona, e)
+            return
+        except Exception as e:
+            yield "result", _generation_error(e, plan["cached"])
+            return
+        yield "pages", {"referenced_pages": data.get("referenced_pages", []), "source_file": data.get("source_file")}
+        yield "result", await run_blocking("render", _attach_visual, data)
+    except Exception as e:
+        yield "result", _system_error(e)
+
+def _prepare_video_script(query: str, persona: str) -> tuple:
+    """Returns (model, prompt) for the narration script, with manual context when uncached."""
+    cache = _ensure_cache()
+    if cache:
+         model = _context_cache.model_for(cache)
+    else:
+         print("Video Gen: Falling back to non-cached")
+         model = llm_client.model()
+    
+    # If fallback, we need context in prompt? 
+    # Yes, if no cache, manual isn't loaded in model.
+    # But for video script, maybe we don't need FULL manual if we have diagnosis?
+    # Ideally we pass full context or the relevant parts.
+    # For simplicity, let's pass context if fallback.
+    
+    persona_style = _PERSONA_STYLE.get(persona, "親しみやすいラジオMC風に始めてください。")
+
+    if not cache:
+        # Pages relevant to the question, within the video script token budget
+        manual_context = retrieve_context(query, budget_for("video_script", persona))
+        prompt = f"""
+        ユーザーの質問: {query}
+        マニュアル情報: {manual_context}
         
-        persona_style = {
-            "YouTuber": "ガジェット系YouTuber風に、テンション高めで「こんにちは！今日は〇〇の解決策をお届けします！」と始めてください。",
-            "Teacher": "ベテラン技術講師風に、落ち着いたトーンで「それでは解説を始めましょう」と始めてください。",
-            "Technical": "親しみやすいラジオMC風に、共感を示しながら始めてください。"
-        }.get(persona, "親しみやすいラジオMC風に始めてください。")
-
-        if not cache:
-            full_context = get_full_context()
-            prompt = f"""
-            ユーザーの質問: {query}
-            マニュアル情報: {full_context[:30000]}
-            
-            これに対する解説スクリプトを作成してください。
-            - {persona_style}
-            - 具体的なページ番号に言及する。
-            - 1分程度。
-            - 将来的な動画生成（Veo/Sora）のために、[Visual Prompt: 指示] の形式で、各シーンの視覚的な指示もスクリプトに含めてください。
-            """
-        else:
-            prompt = f"""
-            ユーザーの質問: {query}
-            
-            これに対する解説スクリプトを作成してください。
-            - {persona_style}
-            - 具体的なページ番号に言及する。
-            - 1分程度。
-            - 将来的な動画生成（Veo/Sora）のために、[Visual Prompt: 指示] の形式で、各シーンの視覚的な指示もスクリプトに含めてください。
-            """
+        これに対する解説スクリプトを作成してください。
+        - {persona_style}
+        - 具体的なページ番号に言及する。
+        - 1分程度。
+        - 将来的な動画生成（Veo/Sora）のために、[Visual Prompt: 指示] の形式で、各シーンの視覚的な指示もスクリプトに含めてください。
+        """
+    else:
+        prompt = f"""
+        ユーザーの質問: {query}
         
-        response = model.generate_content(prompt)
-        return response.text
+        これに対する解説スクリプトを作成してください。
+        - {persona_style}
+        - 具体的なページ番号に言及する。
+        - 1分程度。
+        - 将来的な動画生成（Veo/Sora）のために、[Visual Prompt: 指示] の形式で、各シーンの視覚的な指示もスクリプトに含めてください。
+        """
+    return model, prompt
+
+def get_video_script(query: str, persona: str = "Technical") -> Optional[str]:
+    """
+    Generates persona-based script using Gemini Context Caching or Fallback.
+    Returns None on failure, so callers never narrate or store an error message.
+    """
+    try:
+        model, prompt = _prepare_video_script(query, persona)
+        response = llm_client.generate(model, prompt)
+        token_usage.record("video_script", persona, estimate_tokens(prompt), response, response.text)
+        return response.text or None
     except Exception as e:
         print(f"Script Error: {e}")
-        return "エラーが発生しました。"
+        return None
+
+async def get_video_script_async(query: str, persona: str = "Technical") -> Optional[str]:
+    """Non-blocking get_video_script for the FastAPI event loop."""
+    try:
+        model, prompt = await run_blocking("setup", _prepare_video_script, query, persona)
+        response = await llm_client.generate_async(model, prompt, hedge=False)
+        token_usage.record("video_script", persona, estimate_tokens(prompt), response, response.text)
+        return response.text or None
+    except Exception as e:
+        print(f"Script Error: {e}")
+        return None
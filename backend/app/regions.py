@@ -0,0 +1,91 @@
+import os
+from typing import List
+
+import fitz  # PyMuPDF
+
+# Regions smaller than this share of the page are icons/bullets; larger ones are page frames
+MIN_REGION_AREA = float(os.environ.get("REGION_MIN_AREA", "0.015"))
+MAX_REGION_AREA = float(os.environ.get("REGION_MAX_AREA", "0.85"))
+# Vector strokes closer than this (points) belong to the same diagram
+MERGE_GAP = 12.0
+PADDING = 6.0
+MAX_REGIONS_PER_PAGE = 8
+# Pages with more vector paths than this are typically rasterized art; only their images are used
+MAX_DRAWINGS = 3000
+# Crops are rendered at the lowest DPI level that gives at least this many pixels across
+TILE_TARGET_PX = int(os.environ.get("TILE_TARGET_PX", "900"))
+DPI_LEVELS = (72, 110, 150, 220, 300)
+
+
+def _merge_rects(rects: List[fitz.Rect], gap: float = MERGE_GAP) -> List[fitz.Rect]:
+    """Greedily unions rectangles that overlap or lie within gap points of each other."""
+    merged = []
+    for rect in sorted(rects, key=lambda r: (r.y0, r.x0)):
+        rect = fitz.Rect(rect)
+        changed = True
+        while changed:
+            changed = False
+            for other in merged:
+                if fitz.Rect(other.x0 - gap, other.y0 - gap, other.x1 + gap, other.y1 + gap).intersects(rect):
+                    merged.remove(other)
+                    rect |= other
+                    changed = True
+                    break
+        merged.append(rect)
+    return merged
+
+
+def detect_regions(page: fitz.Page) -> List[list]:
+    """
+    Finds embedded images and clusters of vector drawings on a page.
+    Returns [x0, y0, x1, y1, kind] boxes in PDF points, largest first.
+    """
+    bounds = page.rect
+    page_area = bounds.width * bounds.height or 1.0
+    found = []
+
+    for img in page.get_images(full=True):
+        try:
+            found.extend((rect, "image") for rect in page.get_image_rects(img[0]))
+        except Exception:
+            continue
+
+    drawings = page.get_drawings()
+    if len(drawings) <= MAX_DRAWINGS:
+        # Straight lines have zero-area rects, which PyMuPDF treats as empty in unions
+        strokes = [fitz.Rect(r.x0 - 0.5, r.y0 - 0.5, r.x1 + 0.5, r.y1 + 0.5)
+                   for r in (d.get("rect") for d in drawings) if r and (r.width > 1 or r.height > 1)]
+        found.extend((rect, "drawing") for rect in _merge_rects(strokes))
+
+    regions = []
+    for rect, kind in found:
+        rect = fitz.Rect(rect.x0 - PADDING, rect.y0 - PADDING, rect.x1 + PADDING, rect.y1 + PADDING) & bounds
+        share = rect.width * rect.height / page_area
+        if rect.is_empty or not MIN_REGION_AREA <= share <= MAX_REGION_AREA:
+            continue
+        if any(fitz.Rect(r[:4]).contains(rect) for r in regions):
+            continue
+        regions.append([round(rect.x0, 1), round(rect.y0, 1), round(rect.x1, 1), round(rect.y1, 1), kind])
+
+    regions.sort(key=lambda r: (r[2] - r[0]) * (r[3] - r[1]), reverse=True)
+    return regions[:MAX_REGIONS_PER_PAGE]
+
+
+def detect_page_range(path: str, start: int, end: int) -> dict:
+    """Regions for pages [start, end) (0-indexed), keyed by 1-indexed page number."""
+    with fitz.open(path) as doc:
+        return {i + 1: detect_regions(doc.load_page(i)) for i in range(start, min(end, len(doc)))}
+
+
+def snap_dpi(dpi: int) -> int:
+    """Nearest DPI level, so arbitrary dpi parameters map onto a few cacheable renders."""
+    return min(DPI_LEVELS, key=lambda level: (abs(level - dpi), level))
+
+
+def tile_dpi(region: list, target_px: int = TILE_TARGET_PX) -> int:
+    """Lowest DPI level at which the region is at least target_px wide, so small diagrams get sharper tiles."""
+    width = region[2] - region[0]
+    for dpi in DPI_LEVELS:
+        if width * dpi / 72 >= target_px:
+            return dpi
+    return DPI_LEVELS[-1]
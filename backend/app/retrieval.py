@@ -0,0 +1,209 @@
+import heapq
+import math
+import os
+import re
+import threading
+import unicodedata
+from collections import Counter, defaultdict
+from typing import Callable, List, Optional
+
+# CJK scripts are tokenized as character bigrams, everything else as words
+_CJK_RUN_RE = re.compile(r"[぀-ヿ㐀-䶿一-鿿豈-﫿]+")
+_WORD_RE = re.compile(r"[a-z0-9]+")
+
+CHUNK_SIZE = int(os.environ.get("RAG_CHUNK_SIZE", "500"))
+CHUNK_OVERLAP = int(os.environ.get("RAG_CHUNK_OVERLAP", "100"))
+TOP_K = int(os.environ.get("RAG_TOP_K", "8"))
+
+
+def normalize_text(text: str) -> str:
+    """NFKC-folds width variants and lowercases latin characters."""
+    return unicodedata.normalize("NFKC", text).lower()
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Japanese-aware tokenizer.
+    CJK runs become overlapping character bigrams (single characters stay unigrams),
+    latin/digit runs become whole words.
+    """
+    text = normalize_text(text)
+    tokens = []
+    for run in _CJK_RUN_RE.findall(text):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    tokens.extend(_WORD_RE.findall(_CJK_RUN_RE.sub(" ", text)))
+    return tokens
+
+
+def chunk_page(text: str, size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> List[str]:
+    """Splits page text into overlapping windows, preferring to cut after a sentence end."""
+    text = text.strip()
+    if len(text) <= size:
+        return [text] if text else []
+
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(start + size, len(text))
+        if end < len(text):
+            # Look back over the last fifth of the window for a natural break
+            window = text[start + size * 4 // 5:end]
+            cut = max(window.rfind("。"), window.rfind(". "), window.rfind(" "))
+            if cut != -1:
+                end = start + size * 4 // 5 + cut + 1
+        chunks.append(text[start:end].strip())
+        if end >= len(text):
+            break
+        start = max(end - overlap, start + 1)
+    return [c for c in chunks if c]
+
+
+def load_local_embedder() -> Optional[Callable[[List[str]], List[List[float]]]]:
+    """
+    Returns a local embedding function if RAG_EMBEDDINGS=local and sentence-transformers is installed.
+    Lexical retrieval is used on its own otherwise.
+    """
+    if os.environ.get("RAG_EMBEDDINGS", "").lower() != "local":
+        return None
+    try:
+        from sentence_transformers import SentenceTransformer
+    except ImportError:
+        print("DEBUG: RAG_EMBEDDINGS=local but sentence-transformers is not installed, using BM25 only")
+        return None
+
+    model = SentenceTransformer(os.environ.get("RAG_EMBED_MODEL", "intfloat/multilingual-e5-small"))
+
+    def embed(texts: List[str]) -> List[List[float]]:
+        return model.encode(texts, normalize_embeddings=True).tolist()
+
+    return embed
+
+
+class ManualIndex:
+    """
+    In-memory BM25 index over manual chunks, with optional dense re-ranking.
+    Each chunk keeps its source file and page so retrieved text can be re-emitted
+    with the same [[Source | Page]] markers the prompts rely on.
+    Sources can be replaced or removed individually, so ingesting one manual does not
+    re-tokenize the others. Mutations and searches are serialized by a lock; chunking
+    and tokenizing happen outside it.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75, embed_fn=None):
+        self.k1 = k1
+        self.b = b
+        self.embed_fn = embed_fn
+        self.chunks = {}  # chunk_id -> chunk dict
+        self._postings = defaultdict(dict)  # term -> {chunk_id: tf}
+        self._terms = {}  # chunk_id -> Counter of terms
+        self._doc_len = {}  # chunk_id -> token count
+        self._vectors = {}  # chunk_id -> dense vector or None
+        self._by_source = defaultdict(list)  # source -> [chunk_id]
+        self._total_len = 0
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def _prepare(self, pages) -> List[tuple]:
+        """Chunks and tokenizes (source, page, text) tuples without touching the index."""
+        prepared = []
+        for source, page, text in pages:
+            texts = chunk_page(text)
+            vectors = self.embed_fn(texts) if (self.embed_fn and texts) else [None] * len(texts)
+            for chunk_text, vec in zip(texts, vectors):
+                prepared.append((source, page, chunk_text, Counter(tokenize(chunk_text)), vec))
+        return prepared
+
+    def _insert(self, prepared: List[tuple]):
+        for source, page, chunk_text, terms, vec in prepared:
+            chunk_id = self._next_id
+            self._next_id += 1
+            self.chunks[chunk_id] = {"id": chunk_id, "source": source, "page": page, "text": chunk_text}
+            for term, tf in terms.items():
+                self._postings[term][chunk_id] = tf
+            self._terms[chunk_id] = terms
+            self._doc_len[chunk_id] = sum(terms.values())
+            self._vectors[chunk_id] = vec
+            self._by_source[source].append(chunk_id)
+            self._total_len += self._doc_len[chunk_id]
+
+    def _delete_source(self, source: str):
+        for chunk_id in self._by_source.pop(source, []):
+            terms = self._terms.pop(chunk_id)
+            for term in terms:
+                postings = self._postings[term]
+                postings.pop(chunk_id, None)
+                if not postings:
+                    del self._postings[term]
+            self._total_len -= self._doc_len.pop(chunk_id)
+            del self.chunks[chunk_id]
+            del self._vectors[chunk_id]
+
+    def replace_source(self, source: str, pages):
+        """
+        Atomically swaps all chunks of one source for the given (page, text) pairs.
+        pages may be a generator; it is consumed before the lock is taken.
+        """
+        prepared = self._prepare((source, page, text) for page, text in pages)
+        with self._lock:
+            self._delete_source(source)
+            self._insert(prepared)
+
+    def remove_source(self, source: str):
+        with self._lock:
+            self._delete_source(source)
+
+    def first_chunks(self, k: int) -> List[dict]:
+        with self._lock:
+            return [self.chunks[cid] for cid in sorted(self.chunks)[:k]]
+
+    def search(self, query: str, k: int = TOP_K) -> List[dict]:
+        """Returns the top-k chunks for the query, best first, each with a 'score'."""
+        query_terms = set(tokenize(query))
+        with self._lock:
+            if not self.chunks:
+                return []
+            n = len(self.chunks)
+            avg_len = self._total_len / n if n else 0.0
+            scores = defaultdict(float)
+            for term in query_terms:
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+                for chunk_id, tf in postings.items():
+                    norm = self.k1 * (1 - self.b + self.b * self._doc_len[chunk_id] / avg_len)
+                    scores[chunk_id] += idf * tf * (self.k1 + 1) / (tf + norm)
+
+            ranked = heapq.nlargest(k * 4 if self.embed_fn else k, scores.items(), key=lambda kv: kv[1])
+            if self.embed_fn and ranked:
+                ranked = self._rerank(query, ranked, k)
+            return [dict(self.chunks[cid], score=round(score, 4)) for cid, score in ranked[:k]]
+
+    def _rerank(self, query: str, ranked: List[tuple], k: int) -> List[tuple]:
+        """Fuses lexical and dense rankings with reciprocal rank fusion."""
+        q_vec = self.embed_fn([query])[0]
+        dense = sorted(
+            ranked,
+            key=lambda kv: -sum(a * b for a, b in zip(q_vec, self._vectors[kv[0]] or [])),
+        )
+        fused = defaultdict(float)
+        for rank, (cid, _) in enumerate(ranked):
+            fused[cid] += 1.0 / (60 + rank)
+        for rank, (cid, _) in enumerate(dense):
+            fused[cid] += 1.0 / (60 + rank)
+        return heapq.nlargest(k, fused.items(), key=lambda kv: kv[1])
+
+
+def format_chunks(chunks: List[dict]) -> str:
+    """Re-emits retrieved chunks in manual order with their [[Source | Page]] markers."""
+    ordered = sorted(chunks, key=lambda c: (c["source"], c["page"], c["id"]))
+    blocks = []
+    for c in ordered:
+        blocks.append(f"[[Source: {c['source']} | Page: {c['page']}]]\n{c['text']}\n")
+    return "\n".join(blocks)
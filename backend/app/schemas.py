@@ -15,6 +15,7 @@ class DiagnoseResponse(BaseModel):
     disclaimer: str
     referenced_pages: List[int] = []
     source_file: Optional[str] = None
-    visual_page_base64: Optional[str] = None
+    visual_page_base64: Optional[str] = None  # Deprecated: use visual_page_url
+    visual_page_url: Optional[str] = None
     video_status: Optional[str] = None
     request_id: Optional[str] = None
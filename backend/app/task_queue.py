@@ -0,0 +1,181 @@
+import os
+import time
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, Optional
+
+# local: video jobs run in the API process on the background lane.
+# sqlite: the API only records queued jobs in the video job store; `python -m app.worker` runs them.
+TASK_QUEUE_BACKEND = os.environ.get("TASK_QUEUE_BACKEND", "local")
+
+# Lanes in priority order. A lane only starts work while no higher-priority lane has tasks
+# waiting, so a burst of video jobs can never take capacity from interactive diagnosis.
+LANES = {
+    "interactive": {
+        "concurrency": int(os.environ.get("INTERACTIVE_CONCURRENCY", "16")),
+        "max_depth": int(os.environ.get("INTERACTIVE_MAX_QUEUE", "64")),
+    },
+    "background": {
+        "concurrency": int(os.environ.get("BACKGROUND_CONCURRENCY", "2")),
+        "max_depth": int(os.environ.get("BACKGROUND_MAX_QUEUE", "32")),
+    },
+}
+
+_WAIT_SAMPLES = 200
+
+
+class QueueFullError(Exception):
+    """Raised instead of queueing when a lane already has max_depth tasks waiting."""
+
+    def __init__(self, lane: str, depth: int):
+        super().__init__(f"{lane} queue is full ({depth} waiting)")
+        self.lane = lane
+        self.depth = depth
+
+
+class _Lane:
+    def __init__(self, name: str, priority: int, concurrency: int, max_depth: int):
+        self.name = name
+        self.priority = priority
+        self.concurrency = concurrency
+        self.max_depth = max_depth
+        self.waiting = 0
+        self.running = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.waits = deque(maxlen=_WAIT_SAMPLES)
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._idle: Optional[asyncio.Event] = None
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    @property
+    def idle(self) -> asyncio.Event:
+        """Set while no task is waiting in this lane."""
+        if self._idle is None:
+            self._idle = asyncio.Event()
+            if self.waiting == 0:
+                self._idle.set()
+        return self._idle
+
+    def stats(self) -> dict:
+        waits = sorted(self.waits)
+        return {
+            "concurrency": self.concurrency,
+            "max_depth": self.max_depth,
+            "depth": self.waiting,
+            "running": self.running,
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            "completed": self.completed,
+            "failed": self.failed,
+            "wait_p50_ms": round(waits[len(waits) // 2] * 1000, 1) if waits else 0.0,
+            "wait_p95_ms": round(waits[int(len(waits) * 0.95)] * 1000, 1) if waits else 0.0,
+            "wait_max_ms": round(waits[-1] * 1000, 1) if waits else 0.0,
+        }
+
+
+class TaskQueue:
+    """
+    In-process task queue with priority lanes for async work.
+    Each lane has its own concurrency limit and a bounded wait queue (back-pressure:
+    QueueFullError when full), and records queue depth and wait-time metrics.
+    """
+
+    def __init__(self, lanes: Dict[str, dict] = LANES):
+        self._lanes = {
+            name: _Lane(name, priority, cfg["concurrency"], cfg["max_depth"])
+            for priority, (name, cfg) in enumerate(lanes.items())
+        }
+        self._tasks = set()
+
+    def _lane(self, name: str) -> _Lane:
+        lane = self._lanes.get(name)
+        if lane is None:
+            raise ValueError(f"Unknown task lane: {name}")
+        return lane
+
+    def _admit(self, lane: _Lane):
+        if lane.waiting >= lane.max_depth:
+            lane.rejected += 1
+            raise QueueFullError(lane.name, lane.waiting)
+        lane.submitted += 1
+        lane.waiting += 1
+        lane.idle.clear()
+
+    @asynccontextmanager
+    async def slot(self, lane_name: str):
+        """Holds one slot of the lane for the body; raises QueueFullError if the lane is saturated."""
+        lane = self._lane(lane_name)
+        self._admit(lane)
+        async with self._acquired(lane):
+            yield
+
+    async def run(self, lane_name: str, fn: Callable[..., Awaitable], *args, **kwargs):
+        """Runs fn(*args, **kwargs) once the lane has a free slot."""
+        async with self.slot(lane_name):
+            return await fn(*args, **kwargs)
+
+    def submit(self, lane_name: str, fn: Callable[..., Awaitable], *args, **kwargs) -> asyncio.Task:
+        """Fire-and-forget variant of run(). The queue-full check happens immediately."""
+        lane = self._lane(lane_name)
+        self._admit(lane)
+
+        async def execute():
+            async with self._acquired(lane):
+                return await fn(*args, **kwargs)
+
+        task = asyncio.ensure_future(execute())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    @asynccontextmanager
+    async def _acquired(self, lane: _Lane):
+        enqueued = time.monotonic()
+        try:
+            await lane.semaphore.acquire()
+            try:
+                for higher in self._lanes.values():
+                    if higher.priority < lane.priority:
+                        await higher.idle.wait()
+            except BaseException:
+                lane.semaphore.release()
+                raise
+        finally:
+            lane.waiting -= 1
+            if lane.waiting == 0:
+                lane.idle.set()
+
+        lane.waits.append(time.monotonic() - enqueued)
+        lane.running += 1
+        try:
+            yield
+            lane.completed += 1
+        except Exception:
+            lane.failed += 1
+            raise
+        finally:
+            lane.running -= 1
+            lane.semaphore.release()
+
+    def is_full(self, lane_name: str) -> bool:
+        lane = self._lane(lane_name)
+        return lane.waiting >= lane.max_depth
+
+    def has_capacity(self, lane_name: str) -> bool:
+        lane = self._lane(lane_name)
+        return lane.running + lane.waiting < lane.concurrency
+
+    def stats(self) -> dict:
+        return {"backend": TASK_QUEUE_BACKEND, "lanes": {name: lane.stats() for name, lane in self._lanes.items()}}
+
+
+task_queue = TaskQueue()
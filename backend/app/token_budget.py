@@ -0,0 +1,112 @@
+import os
+import re
+import threading
+from typing import Iterable, List, Optional, Tuple
+
+# Local token estimate for Gemini: CJK characters are roughly one token each,
+# other text about CHARS_PER_TOKEN characters per token
+CJK_TOKENS_PER_CHAR = float(os.environ.get("CJK_TOKENS_PER_CHAR", "1.0"))
+CHARS_PER_TOKEN = float(os.environ.get("CHARS_PER_TOKEN", "4"))
+
+# Manual context sent per endpoint, in estimated tokens
+TOKEN_BUDGETS = {
+    "diagnosis": int(os.environ.get("CONTEXT_BUDGET_DIAGNOSIS", "4000")),
+    "video_script": int(os.environ.get("CONTEXT_BUDGET_VIDEO", "6000")),
+    "summary": int(os.environ.get("CONTEXT_BUDGET_SUMMARY", "80000")),
+}
+# Teacher answers explain more background, YouTuber scripts stay short
+PERSONA_BUDGET_SCALE = {"Technical": 1.0, "Teacher": 1.25, "YouTuber": 0.75}
+# Retrieval candidates considered when packing, best first
+CONTEXT_CANDIDATES = int(os.environ.get("CONTEXT_CANDIDATES", "32"))
+# Chunks scoring below this fraction of the best hit are left out, so a question with one
+# clear match sends less context than a vague one
+RELEVANCE_FLOOR = float(os.environ.get("CONTEXT_RELEVANCE_FLOOR", "0.25"))
+
+_CJK_RE = re.compile(r"[぀-ヿ㐀-䶿一-鿿豈-﫿＀-￯]")
+_SPACE_RE = re.compile(r"\s+")
+# [[Source: manual.pdf | Page: 12]] plus the line break
+_MARKER_TOKENS = 12
+
+
+def estimate_tokens(text: str) -> int:
+    if not text:
+        return 0
+    cjk = len(_CJK_RE.findall(text))
+    other = len(_SPACE_RE.sub(" ", text)) - cjk
+    return int(cjk * CJK_TOKENS_PER_CHAR + other / CHARS_PER_TOKEN) + 1
+
+
+def budget_for(endpoint: str, persona: Optional[str] = None) -> int:
+    return int(TOKEN_BUDGETS[endpoint] * PERSONA_BUDGET_SCALE.get(persona, 1.0))
+
+
+def pack_chunks(chunks: List[dict], budget: int) -> Tuple[List[dict], int]:
+    """
+    Picks whole retrieved chunks, best first, until the token budget is spent.
+    Chunks below the relevance floor are dropped; a chunk that does not fit is skipped
+    so a smaller, lower-ranked one can still use the remaining budget.
+    Returns (chosen chunks, estimated tokens).
+    """
+    if not chunks:
+        return [], 0
+    floor = (chunks[0].get("score") or 0.0) * RELEVANCE_FLOOR
+    chosen, used = [], 0
+    for chunk in chunks:
+        if chosen and (chunk.get("score") or 0.0) < floor:
+            break
+        cost = estimate_tokens(chunk["text"]) + _MARKER_TOKENS
+        if used + cost > budget:
+            continue
+        chosen.append(chunk)
+        used += cost
+    return chosen, used
+
+
+def pack_pages(blocks: Iterable[str], budget: int) -> Tuple[List[str], int]:
+    """Takes whole [[Source | Page]] blocks in order until the next one would exceed the budget."""
+    chosen, used = [], 0
+    for block in blocks:
+        cost = estimate_tokens(block)
+        if used + cost > budget:
+            break
+        chosen.append(block)
+        used += cost
+    return chosen, used
+
+
+class TokenUsage:
+    """
+    Per-endpoint totals of tokens sent and received.
+    Uses Gemini's usage_metadata when the response carries it, the local estimate otherwise.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals = {}
+
+    def record(self, endpoint: str, persona: Optional[str], prompt_estimate: int, response=None,
+               output_text: str = "") -> dict:
+        usage = getattr(response, "usage_metadata", None)
+        sent = getattr(usage, "prompt_token_count", 0) or prompt_estimate
+        cached = getattr(usage, "cached_content_token_count", 0) or 0
+        received = getattr(usage, "candidates_token_count", 0) or estimate_tokens(output_text)
+        print(f"DEBUG: Tokens [{endpoint}/{persona}] sent={sent} (cached={cached}, "
+              f"estimated={prompt_estimate}) received={received}", flush=True)
+        with self._lock:
+            totals = self._totals.setdefault(endpoint, {"requests": 0, "sent": 0, "cached": 0, "received": 0})
+            totals["requests"] += 1
+            totals["sent"] += sent
+            totals["cached"] += cached
+            totals["received"] += received
+        return {"sent": sent, "cached": cached, "received": received}
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                endpoint: {**totals, "avg_sent": totals["sent"] // totals["requests"],
+                           "avg_received": totals["received"] // totals["requests"]}
+                for endpoint, totals in self._totals.items()
+            }
+
+
+token_usage = TokenUsage()
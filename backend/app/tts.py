@@ -0,0 +1,266 @@
+import io
+import os
+import re
+import wave
+import time
+import shutil
+import hashlib
+import threading
+import subprocess
+from abc import ABC, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Optional
+
+from .concurrency import LIMITS
+from .manual_store import DB_DIR
+
+# gtts (Google Translate TTS, needs network) or local (espeak-ng, fully offline)
+TTS_BACKEND = os.environ.get("TTS_BACKEND", "gtts")
+TTS_CACHE_DIR = os.environ.get("TTS_CACHE_DIR", os.path.join(DB_DIR, "tts_cache"))
+TTS_LOCAL_COMMAND = os.environ.get("TTS_LOCAL_COMMAND", "espeak-ng")
+# Finished narration files served by /api/audio; removed after AUDIO_TTL seconds
+AUDIO_DIR = os.environ.get("AUDIO_DIR", os.path.join(DB_DIR, "audio"))
+AUDIO_TTL = int(os.environ.get("AUDIO_TTL", str(7 * 24 * 3600)))
+AUDIO_MEDIA_TYPES = {"mp3": "audio/mpeg", "wav": "audio/wav"}
+_AUDIO_NAME_RE = re.compile(r"^[0-9a-f]{32}\.(mp3|wav)$")
+
+# Sentence boundaries: Japanese/Latin terminal punctuation and line breaks
+_SENTENCE_RE = re.compile(r"[^。！？!?\n]+[。！？!?]*")
+# gTTS returns 32 kbps MP3, so the byte count gives the duration
+_GTTS_BYTES_PER_SECOND = 32000 / 8
+
+
+def split_sentences(text: str) -> List[str]:
+    return [s.strip() for s in _SENTENCE_RE.findall(text) if s.strip()]
+
+
+class TTSBackend(ABC):
+    """Synthesizes one sentence. Subclasses set name/format and implement synthesize(), duration() and join()."""
+
+    name = "base"
+    format = "mp3"
+    media_type = "audio/mpeg"
+
+    @abstractmethod
+    def synthesize(self, text: str, voice: str) -> bytes:
+        """Encoded audio of one sentence."""
+
+    @abstractmethod
+    def duration(self, audio: bytes) -> float:
+        """Length of encoded audio in seconds."""
+
+    @abstractmethod
+    def join(self, parts: List[bytes]) -> bytes:
+        """Concatenates encoded sentences into one file."""
+
+
+class GTTSBackend(TTSBackend):
+    """Google Translate TTS via gTTS. voice is the Google domain (tld), which changes the accent."""
+
+    name = "gtts"
+
+    def synthesize(self, text: str, voice: str) -> bytes:
+        from gtts import gTTS
+        buf = io.BytesIO()
+        gTTS(text=text, lang="ja", tld=voice or "com").write_to_fp(buf)
+        return buf.getvalue()
+
+    def duration(self, audio: bytes) -> float:
+        return len(audio) / _GTTS_BYTES_PER_SECOND
+
+    def join(self, parts: List[bytes]) -> bytes:
+        # MP3 is a stream of self-contained frames, so sentences concatenate directly
+        return b"".join(parts)
+
+
+class LocalTTSBackend(TTSBackend):
+    """Offline synthesis with the espeak-ng command line (WAV). voice is an espeak voice name."""
+
+    name = "local"
+    format = "wav"
+    media_type = "audio/wav"
+
+    def __init__(self, command: str = TTS_LOCAL_COMMAND):
+        self.command = shutil.which(command) or shutil.which("espeak")
+        if not self.command:
+            raise RuntimeError(f"Local TTS engine '{command}' is not installed")
+
+    def synthesize(self, text: str, voice: str) -> bytes:
+        result = subprocess.run(
+            [self.command, "-v", voice or "ja", "--stdout", text],
+            capture_output=True, check=True, timeout=60,
+        )
+        return result.stdout
+
+    def duration(self, audio: bytes) -> float:
+        # espeak-ng --stdout cannot seek back to patch the header, so getnframes() is a
+        # placeholder (0x7ffff000); count the frames actually present instead
+        with wave.open(io.BytesIO(audio)) as w:
+            frames = w.readframes(w.getnframes())
+            return len(frames) / float(w.getsampwidth() * w.getnchannels() * w.getframerate())
+
+    def join(self, parts: List[bytes]) -> bytes:
+        out = io.BytesIO()
+        with wave.open(out, "wb") as writer:
+            for i, part in enumerate(parts):
+                with wave.open(io.BytesIO(part)) as reader:
+                    if i == 0:
+                        writer.setparams(reader.getparams())
+                    writer.writeframes(reader.readframes(reader.getnframes()))
+        return out.getvalue()
+
+
+BACKENDS = {"gtts": GTTSBackend, "local": LocalTTSBackend}
+
+# Voice per backend and persona
+VOICES = {
+    "gtts": {"Technical": "com", "YouTuber": "com", "Teacher": "co.jp"},
+    "local": {"Technical": "ja+f2", "YouTuber": "ja+m3", "Teacher": "ja+m1"},
+}
+
+
+class SentenceSynthesizer:
+    """
+    Synthesizes scripts sentence by sentence in parallel, caching every sentence on disk
+    under (backend, voice, persona, sentence). Recurring lines such as persona greetings and
+    disclaimers are synthesized once, and concurrent requests for the same sentence share
+    a single synthesis. All scripts share one pool of `workers` threads, so at most that
+    many sentences are synthesized at once however many scripts are in flight.
+    """
+
+    def __init__(self, backend: TTSBackend, cache_dir: str = TTS_CACHE_DIR, workers: int = LIMITS["tts"]):
+        self.backend = backend
+        self.cache_dir = cache_dir
+        self.workers = max(1, workers)
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="tts")
+        self._inflight = {}  # cache key -> Future
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _key(self, sentence: str, voice: str, persona: str) -> str:
+        raw = "\x00".join([self.backend.name, voice, persona, sentence])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.{self.backend.format}")
+
+    def sentence_audio(self, sentence: str, voice: str, persona: str) -> bytes:
+        key = self._key(sentence, voice, persona)
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                self.hits += 1
+                return f.read()
+        except FileNotFoundError:
+            pass
+
+        with self._lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+        if not owner:
+            return future.result()
+
+        try:
+            audio = self.backend.synthesize(sentence, voice)
+            self.misses += 1
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(audio)
+            os.replace(tmp, path)
+            future.set_result(audio)
+            return audio
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def synthesize(self, text: str, persona: str = "Technical", voice: Optional[str] = None) -> dict:
+        """
+        Returns {"audio": bytes, "format", "media_type", "segments": [{"text", "start", "duration"}]}.
+        Sentences that fail to synthesize are skipped rather than failing the whole script.
+        """
+        voice = voice or VOICES.get(self.backend.name, {}).get(persona, "")
+        sentences = split_sentences(text)
+        unique = list(dict.fromkeys(sentences))
+        audio = {}
+        futures = {s: self._pool.submit(self.sentence_audio, s, voice, persona) for s in unique}
+        for sentence, future in futures.items():
+            try:
+                audio[sentence] = future.result()
+            except Exception as e:
+                print(f"DEBUG: TTS failed for sentence '{sentence[:20]}': {e}")
+
+        parts, segments, start = [], [], 0.0
+        for sentence in sentences:
+            if sentence not in audio:
+                continue
+            duration = self.backend.duration(audio[sentence])
+            parts.append(audio[sentence])
+            segments.append({"text": sentence, "start": round(start, 2), "duration": round(duration, 2)})
+            start += duration
+        return {
+            "audio": self.backend.join(parts) if parts else b"",
+            "format": self.backend.format,
+            "media_type": self.backend.media_type,
+            "segments": segments,
+        }
+
+    def stats(self) -> dict:
+        return {"backend": self.backend.name, "hits": self.hits, "misses": self.misses}
+
+
+def save_audio(audio: bytes, fmt: str, audio_dir: str = AUDIO_DIR) -> str:
+    """
+    Writes narration audio under its content hash and returns the file name.
+    Identical narrations share one file; files older than AUDIO_TTL are pruned on the way.
+    """
+    os.makedirs(audio_dir, exist_ok=True)
+    name = f"{hashlib.sha256(audio).hexdigest()[:32]}.{fmt}"
+    path = os.path.join(audio_dir, name)
+    if not os.path.exists(path):
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(audio)
+        os.replace(tmp, path)
+    else:
+        os.utime(path)
+    _prune_audio(audio_dir)
+    return name
+
+
+def _prune_audio(audio_dir: str):
+    cutoff = time.time() - AUDIO_TTL
+    for entry in os.scandir(audio_dir):
+        try:
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+
+def audio_path(name: str, audio_dir: str = AUDIO_DIR) -> Optional[str]:
+    """Path of a saved narration file, or None if the name is malformed or the file is gone."""
+    if not _AUDIO_NAME_RE.match(name):
+        return None
+    path = os.path.join(audio_dir, name)
+    return path if os.path.exists(path) else None
+
+
+_synthesizer: Optional[SentenceSynthesizer] = None
+
+
+def get_synthesizer() -> SentenceSynthesizer:
+    global _synthesizer
+    if _synthesizer is None:
+        backend = BACKENDS.get(TTS_BACKEND)
+        if backend is None:
+            raise ValueError(f"Unknown TTS_BACKEND: {TTS_BACKEND}")
+        _synthesizer = SentenceSynthesizer(backend())
+    return _synthesizer
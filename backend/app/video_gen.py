@@ -1,34 +1,134 @@
-import base64
-import io
-from gtts import gTTS
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
-def generate_audio(text: str) -> str:
+from .concurrency import LIMITS
+from .tts import get_synthesizer, save_audio, split_sentences
+
+def generate_audio(text: str, persona: str = "Technical") -> dict:
     """
-    Generates audio from text using gTTS and returns it as a base64 encoded string.
+    Synthesizes the narration with the configured TTS backend (TTS_BACKEND) and saves it
+    as a file served by /api/audio. Sentences are synthesized in parallel and cached.
+    Returns {"audio_url", "audio_format", "segments"}; audio_url is None on failure.
     """
     try:
-        mp3_fp = io.BytesIO()
-        tts = gTTS(text=text, lang='ja')
-        tts.write_to_fp(mp3_fp)
-        mp3_fp.seek(0)
-        audio_content = mp3_fp.read()
-        return base64.b64encode(audio_content).decode('utf-8')
+        result = get_synthesizer().synthesize(text, persona=persona)
+        if not result["audio"]:
+            raise ValueError("no sentence could be synthesized")
+        name = save_audio(result["audio"], result["format"])
+        return {"audio_url": f"/api/audio/{name}", "audio_format": result["format"], "segments": result["segments"]}
     except Exception as e:
         print(f"Error generating audio: {e}")
-        return ""
-
-def create_slides(context: str) -> list[dict]:
-    """
-    Generates a list of slides based on the context.
-    For this PoC, it returns a placeholder slide with the context summary or title.
-    Real implementation would analyze context to pick specific PDF pages.
-    """
-    # specific logic to parse context and find relevant page numbers or images could go here.
-    # For PoC, we return a generic slide structure.
-    return [
-        {
-            "type": "title",
-            "text": "解説",
-            "image": None # Placeholder for URL
-        }
-    ]
+        return {"audio_url": None, "audio_format": None, "segments": []}
+
+# Scene markers the video script prompt asks for; full-width brackets/colons also occur
+_VISUAL_RE = re.compile(r"[\[［]\s*Visual\s*Prompt\s*[:：]\s*(.*?)[\]］]", re.IGNORECASE | re.DOTALL)
+# "p.12" / "Page 12" (not inside a word like "step 2") or "12ページ" / "12頁"
+_PAGE_RE = re.compile(r"(?<![A-Za-z])[pP](?:\.|age)\s*(\d{1,4})|(\d{1,4})\s*(?:ページ|頁)")
+# Japanese TTS narration rate, used to time slides against the audio
+CHARS_PER_SECOND = float(os.environ.get("NARRATION_CHARS_PER_SECOND", "7.0"))
+MIN_SLIDE_SECONDS = 2.0
+
+def split_scenes(script: str) -> list[dict]:
+    """
+    Splits a video script into scenes at each [Visual Prompt: ...] marker.
+    Returns [{"visual": prompt or None, "narration": spoken text}] in order.
+    """
+    scenes = []
+    pos, visual = 0, None
+    for match in _VISUAL_RE.finditer(script):
+        narration = script[pos:match.start()].strip()
+        if narration or visual:
+            scenes.append({"visual": visual, "narration": narration})
+        visual, pos = match.group(1).strip(), match.end()
+    narration = script[pos:].strip()
+    if narration or visual:
+        scenes.append({"visual": visual, "narration": narration})
+    return scenes
+
+def narration_text(script: str) -> str:
+    """The script with visual markers removed, i.e. what should be read aloud."""
+    return "\n".join(scene["narration"] for scene in split_scenes(script) if scene["narration"])
+
+def _page_ref(text: str):
+    match = _PAGE_RE.search(text or "")
+    return int(match.group(1) or match.group(2)) if match else None
+
+def _render_tile(source: str, page: int):
+    """Renders (or fetches from cache) the tile shown for a page and returns its URL, or None."""
+    from .image_utils import get_manual_path, get_page_image, page_image_url, visual_tile
+    pdf_path = get_manual_path(source)
+    if not os.path.exists(pdf_path):
+        return None
+    region, dpi = visual_tile(pdf_path, page)
+    if not get_page_image(pdf_path, page, dpi, "webp", region):
+        return None
+    return page_image_url(source, page, dpi, "webp", region)
+
+def _scene_durations(scenes: list[dict], segments: Optional[list[dict]]) -> list[float]:
+    """
+    Seconds each scene is on screen: the synthesized length of its sentences when audio
+    segments are given (so slides stay in sync with playback), otherwise estimated.
+    """
+    durations = []
+    remaining = list(segments or [])
+    for scene in scenes:
+        if segments:
+            duration = 0.0
+            for sentence in split_sentences(scene["narration"]):
+                if remaining and remaining[0]["text"] == sentence:
+                    duration += remaining.pop(0)["duration"]
+        else:
+            duration = max(len(scene["narration"]) / CHARS_PER_SECOND, MIN_SLIDE_SECONDS)
+        durations.append(duration)
+    return durations
+
+def create_slides(script: str, source_file: Optional[str] = None, segments: Optional[list[dict]] = None) -> list[dict]:
+    """
+    Builds the slide deck for a video script.
+    Each [Visual Prompt: ...] scene becomes a slide showing the manual page it refers to
+    (cropped to its main diagram), timed to its narration (segments from generate_audio).
+    Scenes without a page reference keep the previous page; the first one is matched by retrieval.
+    Distinct pages are rendered once, in parallel, through the page cache.
+    """
+    from .rag import locate_page
+
+    scenes = split_scenes(script) or [{"visual": None, "narration": script}]
+    locations = []
+    current = None
+    for scene in scenes:
+        text = f"{scene['visual'] or ''} {scene['narration']}"
+        page = _page_ref(text)
+        if page is not None:
+            current = (source_file, page) if source_file else (locate_page(text, page) or current)
+        elif current is None:
+            current = locate_page(text)
+        locations.append(current)
+
+    pages = {loc for loc in locations if loc}
+    urls = {}
+    if pages:
+        with ThreadPoolExecutor(max_workers=min(len(pages), LIMITS["render"])) as pool:
+            futures = {loc: pool.submit(_render_tile, *loc) for loc in pages}
+        for loc, future in futures.items():
+            try:
+                urls[loc] = future.result()
+            except Exception as e:
+                print(f"DEBUG: Failed to render slide for {loc}: {e}")
+
+    slides = []
+    start = 0.0
+    for scene, loc, duration in zip(scenes, locations, _scene_durations(scenes, segments)):
+        image = urls.get(loc) if loc else None
+        slides.append({
+            "type": "page" if image else "title",
+            "text": scene["visual"] or scene["narration"][:60] or "解説",
+            "image": image,
+            "source_file": loc[0] if image else None,
+            "page": loc[1] if image else None,
+            "start": round(start, 2),
+            "duration": round(duration, 2),
+        })
+        start += duration
+    return slides
@@ -0,0 +1,161 @@
+import os
+import time
+import uuid
+import asyncio
+from typing import Optional
+
+from .concurrency import run_blocking
+from .job_store import DONE, FAILED, VIDEO_JOB_POLL_INTERVAL, get_job_store, video_cache_key
+from .task_queue import LANES, TASK_QUEUE_BACKEND, QueueFullError, task_queue
+
+# How often app.worker checks the manuals directory for uploads made through the API process
+CORPUS_SYNC_INTERVAL = float(os.environ.get("WORKER_CORPUS_SYNC_INTERVAL", "30"))
+
+# cache key -> Task generating that video in this process
+_inflight_videos = {}
+
+
+async def store_call(method: str, *args, **kwargs):
+    """
+    Calls a VideoJobStore method in a worker thread: a SQLite call can wait up to 30 s on
+    another process's write lock (app.worker), which must not stall the event loop.
+    """
+    return await run_blocking("store", lambda: getattr(get_job_store(), method)(*args, **kwargs))
+
+
+async def generate_video_assets(query: str, persona: str) -> Optional[dict]:
+    """Script, narration audio and slides for a query, or None if the script could not be generated."""
+    from .rag import get_video_script_async
+    from .video_gen import generate_audio, create_slides, narration_text
+
+    # 1. Generate Script (Dialogue)
+    script = await get_video_script_async(query, persona=persona)
+    if not script:
+        return None
+
+    # 2. Generate Audio (TTS) - saved as a file and streamed from /api/audio; visual markers are not read aloud
+    audio = await run_blocking("tts", generate_audio, narration_text(script), persona)
+
+    # 3. Create Slides from the scenes and page references in the script, timed to the audio
+    slides = await run_blocking("render", create_slides, script, None, audio["segments"])
+    return {"script": script, **audio, "slides": slides}
+
+
+def is_generating(query: str, persona: str) -> bool:
+    return video_cache_key(query, persona) in _inflight_videos
+
+
+async def generate_video_single_flight(query: str, persona: str) -> Optional[dict]:
+    """
+    Runs at most one generation per query/persona in this process: later callers attach to
+    the running task instead of paying for another script and TTS run. The task is shielded,
+    so a disconnecting client does not cancel it for the others.
+    """
+    key = video_cache_key(query, persona)
+    task = _inflight_videos.get(key)
+    if task is None:
+        task = asyncio.ensure_future(generate_video_assets(query, persona))
+        _inflight_videos[key] = task
+        task.add_done_callback(lambda _: _inflight_videos.pop(key, None))
+    else:
+        print(f"DEBUG: Attaching to in-flight video generation for {key}", flush=True)
+    return await asyncio.shield(task)
+
+
+async def await_job(request_id: str) -> Optional[dict]:
+    """Waits for a job owned by another worker (or not yet started here); None if it failed."""
+    while True:
+        job = await store_call("get", request_id)
+        if job is None or job["status"] == FAILED:
+            return None
+        if job["status"] == DONE:
+            return job["result"]
+        await asyncio.sleep(VIDEO_JOB_POLL_INTERVAL)
+
+
+async def process_video_background(request_id: str, query: str, persona: str):
+    """
+    Background task to generate video assets.
+    Progress is recorded in the video job store and can be polled at /api/video/{request_id}.
+    """
+    print(f"DEBUG: Starting background video generation for query='{query}', persona='{persona}'", flush=True)
+    try:
+        cached = await store_call("find_done", query, persona)
+        if cached:
+            await store_call("complete", request_id, cached)
+            print(f"DEBUG: Reused finished video for {request_id}", flush=True)
+            return
+
+        await store_call("mark_running", request_id)
+        video = None
+        # An older job for the same video (possibly on another worker) is already generating it
+        active = await store_call("find_active", query, persona)
+        if active and active != request_id and not is_generating(query, persona):
+            video = await await_job(active)
+        if not video:
+            video = await generate_video_single_flight(query, persona)
+        if video:
+            await store_call("complete", request_id, video)
+            print(f"DEBUG: Background video generation completed for {request_id}", flush=True)
+        else:
+            await store_call("fail", request_id, "Failed to generate script.")
+            print(f"DEBUG: Background script generation failed for {request_id}", flush=True)
+    except Exception as e:
+        print(f"DEBUG: Background video generation error: {e}", flush=True)
+        await store_call("fail", request_id, str(e))
+
+
+async def schedule_video(query: str, persona: str) -> tuple:
+    """
+    Registers a video job and hands it to the background lane (or, with TASK_QUEUE_BACKEND=sqlite,
+    leaves it queued for app.worker). Returns (request_id, video_status); the status is
+    "unavailable" when the background queue is full.
+    """
+    request_id = str(uuid.uuid4())
+    if TASK_QUEUE_BACKEND == "sqlite":
+        if await store_call("count", "queued") >= LANES["background"]["max_depth"]:
+            print(f"DEBUG: Video queue full, skipping video for {request_id}", flush=True)
+            return request_id, "unavailable"
+        await store_call("create", request_id, query, persona)
+        return request_id, "processing"
+
+    await store_call("create", request_id, query, persona, owned=True)
+    try:
+        task_queue.submit("background", process_video_background, request_id, query, persona)
+    except QueueFullError as e:
+        await store_call("fail", request_id, str(e))
+        return request_id, "unavailable"
+    return request_id, "processing"
+
+
+async def register_video(request_id: str, query: str, persona: str, video: dict) -> tuple:
+    """
+    Exposes an already generated video (e.g. from the answer bank) as a finished job under a
+    stable request_id. Returns (request_id, "done").
+    """
+    if await store_call("get", request_id) is None:
+        await store_call("create", request_id, query, persona, status=DONE, result=video)
+    return request_id, DONE
+
+
+async def run_worker(poll_interval: float = VIDEO_JOB_POLL_INTERVAL):
+    """
+    Claims queued jobs from the job store whenever the background lane has a free slot.
+    Re-syncs the corpus (index, glossary and Gemini context cache) when the manuals change,
+    so scripts written after an /api/upload cite the new manuals.
+    """
+    from .rag import corpus_changed, ingest_manuals
+
+    print(f"DEBUG: Video worker started ({LANES['background']['concurrency']} concurrent jobs)", flush=True)
+    synced_at = time.monotonic()
+    while True:
+        if time.monotonic() - synced_at >= CORPUS_SYNC_INTERVAL:
+            synced_at = time.monotonic()
+            if await run_blocking("setup", corpus_changed):
+                msg = await run_blocking("setup", ingest_manuals)
+                print(f"DEBUG: Video worker re-synced manuals: {msg}", flush=True)
+        job = await store_call("claim_next") if task_queue.has_capacity("background") else None
+        if job is None:
+            await asyncio.sleep(poll_interval)
+            continue
+        task_queue.submit("background", process_video_background, job["request_id"], job["query"], job["persona"])
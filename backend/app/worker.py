@@ -0,0 +1,21 @@
+"""
+Standalone video worker for TASK_QUEUE_BACKEND=sqlite.
+
+    python -m app.worker
+
+Runs queued video jobs (script, TTS, slide rendering) from the shared video job store, so this
+work never competes with the API process serving interactive diagnosis.
+"""
+import os
+import asyncio
+
+from dotenv import load_dotenv
+
+if __name__ == "__main__":
+    # Before importing the app modules, which read their settings from the environment
+    env_path = os.path.join(os.path.dirname(__file__), "..", ".env")
+    if os.path.exists(env_path):
+        load_dotenv(env_path)
+
+    from .video_jobs import run_worker
+    asyncio.run(run_worker())
@@ -0,0 +1,44 @@
+import os
+import sys
+import asyncio
+import argparse
+from dotenv import load_dotenv
+
+# Add current dir to path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+# Load env variables (before importing the app, which reads its settings from the environment)
+load_dotenv(os.path.join(os.path.dirname(__file__), ".env"))
+
+from app.answer_bank import get_answer_bank, refresh_answer_bank
+from app.llm_client import llm_client
+from app.rag import ingest_manuals
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Precomputes diagnosis answers, page images and videos for the top questions (top_queries.json "
+                    "plus frequent recent questions). Only missing or stale entries are rebuilt unless --full."
+    )
+    parser.add_argument("--full", action="store_true", help="rebuild every entry")
+    parser.add_argument("--no-video", action="store_true", help="skip narrated slide videos")
+    args = parser.parse_args()
+
+    # Configure API Key
+    if not llm_client.configure():
+        print("API Key not found.")
+        sys.exit(1)
+
+    print("Loading manuals...")
+    print(ingest_manuals())
+
+    print("Building answer bank...")
+    report = asyncio.run(refresh_answer_bank(full=args.full, video=not args.no_video))
+    print(f"Built {report['built']}, up to date {report['skipped']}, failed {report['failed']}, "
+          f"pruned {report['pruned']} (of {report['targets']} questions)")
+    print(get_answer_bank().stats())
+
+
+# Ingestion parses manuals in spawned worker processes, which re-import this script
+if __name__ == "__main__":
+    main()
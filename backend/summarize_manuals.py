@@ -1,47 +1,55 @@
 
 import os
 import sys
-import google.generativeai as genai
 from dotenv import load_dotenv
 
 # Add current dir to path
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-from app.rag import get_full_context
 
-# Load env variables
+# Load env variables (before importing the app, which reads its settings from the environment)
 load_dotenv(os.path.join(os.path.dirname(__file__), ".env"))
 
-# Configure API Key
-api_key = os.environ.get("GOOGLE_API_KEY")
-if not api_key:
-    print("API Key not found.")
-    sys.exit(1)
+from app.llm_client import llm_client
+from app.rag import get_full_context
+from app.token_budget import budget_for, estimate_tokens, token_usage
+
 
-genai.configure(api_key=api_key)
+def main():
+    # Configure API Key
+    if not llm_client.configure():
+        print("API Key not found.")
+        sys.exit(1)
 
-print("Loading manuals...")
-context = get_full_context()
-if not context:
-    print("No content found in manuals.")
-    sys.exit(0)
+    print("Loading manuals...")
+    context = get_full_context(max_tokens=budget_for("summary"))
+    if not context:
+        print("No content found in manuals.")
+        sys.exit(0)
 
-print(f"Loaded context length: {len(context)} chars")
+    print(f"Loaded context length: {len(context)} chars (~{estimate_tokens(context)} tokens)")
 
-print("Generating summary...")
-try:
-    model = genai.GenerativeModel('models/gemini-flash-latest')
-    prompt = f"""
-    以下のマニュアルの内容を日本語で要約してください。
-    どのような製品のマニュアルか、主なトピックは何か、そしてユーザーにとって重要な注意点は何かを含めてください。
+    print("Generating summary...")
+    try:
+        model = llm_client.model('models/gemini-flash-latest')
+        prompt = f"""
+        以下のマニュアルの内容を日本語で要約してください。
+        どのような製品のマニュアルか、主なトピックは何か、そしてユーザーにとって重要な注意点は何かを含めてください。
     
-    マニュアルテキスト:
-    {context[:100000]} (Truncated if extremely large)
-    """
+        マニュアルテキスト:
+        {context} (Truncated if extremely large)
+        """
     
-    response = model.generate_content(prompt)
-    print("\n--- Summary ---")
-    print(response.text)
-    print("--- End Summary ---")
+        # Offline job over a large context: allow long attempts, retries still apply
+        response = llm_client.generate(model, prompt, deadline=600, attempt_timeout=300)
+        token_usage.record("summary", None, estimate_tokens(prompt), response, response.text)
+        print("\n--- Summary ---")
+        print(response.text)
+        print("--- End Summary ---")
+
+    except Exception as e:
+        print(f"Error generating summary: {e}")
+
 
-except Exception as e:
-    print(f"Error generating summary: {e}")
+# Ingestion parses manuals in spawned worker processes, which re-import this script
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+import os
+import sys
+import time
+import threading
+
+# Add backend to path
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+
+from app.context_cache import GeminiContextCache
+
+
+class FakeCache:
+    def __init__(self, name, fail_update=False):
+        self.name = name
+        self.deleted = False
+        self.updates = 0
+        self.fail_update = fail_update
+
+    def update(self, ttl=None):
+        if self.fail_update:
+            raise RuntimeError("cache not found")
+        self.updates += 1
+
+    def delete(self):
+        self.deleted = True
+
+
+class FakeCachedContent:
+    def __init__(self):
+        self.created = []
+        self.fail = False
+        self.fail_update = False
+        self.delay = 0.0
+
+    def create(self, **kwargs):
+        time.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError("quota exceeded")
+        cache = FakeCache(f"cache-{len(self.created) + 1}", fail_update=self.fail_update)
+        self.created.append(cache)
+        return cache
+
+
+class FakeClient:
+    """The caching.CachedContent.create surface of google.generativeai."""
+
+    def __init__(self):
+        self.caching = self
+        self.CachedContent = FakeCachedContent()
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_concurrent_callers_share_one_creation():
+    client = FakeClient()
+    client.CachedContent.delay = 0.1
+    cache = GeminiContextCache(client, lambda: "manual text")
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get())) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(client.CachedContent.created) == 1
+    assert all(r is client.CachedContent.created[0] for r in results)
+    cache.invalidate()
+
+
+def test_failed_creation_is_not_retried_until_retry_after():
+    client = FakeClient()
+    client.CachedContent.fail = True
+    clock = FakeClock()
+    cache = GeminiContextCache(client, lambda: "manual text", retry_after=120, clock=clock)
+    assert cache.get() is None
+    assert cache.status()["last_error"] == "quota exceeded"
+
+    client.CachedContent.fail = False
+    assert cache.get() is None, "uncached path during the retry window"
+    clock.now += 121
+    assert cache.get() is client.CachedContent.created[0]
+    cache.invalidate()
+
+
+def test_expired_cache_is_recreated_and_invalidate_deletes():
+    client = FakeClient()
+    clock = FakeClock()
+    cache = GeminiContextCache(client, lambda: "manual text", ttl_seconds=600, clock=clock)
+    first = cache.get()
+    clock.now += 601
+    second = cache.get()
+    assert second is not first
+    assert first.deleted, "the replaced cache is deleted"
+
+    cache.invalidate()
+    assert second.deleted
+    assert not cache.is_valid()
+
+
+def test_creation_for_an_old_corpus_is_discarded():
+    client = FakeClient()
+    client.CachedContent.delay = 0.2
+    cache = GeminiContextCache(client, lambda: "manual text")
+    thread = threading.Thread(target=cache.get)
+    thread.start()
+    time.sleep(0.05)
+    cache.invalidate()
+    thread.join()
+    assert client.CachedContent.created[0].deleted
+    assert not cache.is_valid()
+
+
+def test_timer_refreshes_ttl_and_recreates_when_update_fails():
+    client = FakeClient()
+    # TTL 2 s: the refresh margin is capped at half the TTL, so the timer fires after 1 s
+    cache = GeminiContextCache(client, lambda: "manual text", ttl_seconds=2)
+    first = cache.get()
+    time.sleep(1.3)
+    assert first.updates == 1, "TTL refreshed before expiry"
+    assert cache.get() is first
+
+    first.fail_update = True
+    time.sleep(1.2)
+    assert len(client.CachedContent.created) == 2, "rejected update recreates the cache"
+    assert first.deleted
+    assert cache.get() is client.CachedContent.created[1]
+    cache.invalidate()
+
+
+def test_creation_past_the_deadline_is_abandoned_and_deleted():
+    client = FakeClient()
+    client.CachedContent.delay = 0.5
+    cache = GeminiContextCache(client, lambda: "manual text", deadline=0.1)
+    started = time.monotonic()
+    assert cache.get() is None
+    assert time.monotonic() - started < 0.4
+    assert "exceeded" in cache.status()["last_error"]
+
+    time.sleep(0.6)
+    assert client.CachedContent.created[0].deleted, "the late cache is not leaked"
+    assert not cache.is_valid()
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name}: ok")
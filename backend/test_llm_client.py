@@ -0,0 +1,205 @@
+import os
+import sys
+import time
+import asyncio
+
+# Add backend to path
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+
+from app.concurrency import upstream
+from app.llm_client import CircuitBreaker, CircuitOpenError, LLMClient, UpstreamUnavailable
+
+
+class FakeError(Exception):
+    """Stands in for google.api_core errors, which carry the HTTP status as .code."""
+
+    def __init__(self, code):
+        super().__init__(f"HTTP {code}")
+        self.code = code
+
+
+class FakeResponse:
+    def __init__(self, text, chunks=()):
+        self.text = text
+        self._chunks = list(chunks)
+
+    async def __aiter__(self):
+        for text, delay in self._chunks:
+            await asyncio.sleep(delay)
+            yield FakeResponse(text)
+
+
+class FakeModel:
+    """
+    Plays back a script of attempt outcomes: ("ok", delay), (status code, delay) or
+    ("stream", [(chunk text, delay), ...]). Attempts beyond the script succeed at once.
+    """
+
+    def __init__(self, *plan):
+        self.plan = list(plan)
+        self.calls = 0
+
+    async def generate_content_async(self, prompt, request_options=None, stream=False, **kwargs):
+        self.calls += 1
+        outcome, arg = self.plan.pop(0) if self.plan else ("ok", 0)
+        if outcome == "stream":
+            return FakeResponse("", arg)
+        await asyncio.sleep(arg)
+        if outcome != "ok":
+            raise FakeError(outcome)
+        return FakeResponse(f"answer {self.calls}")
+
+    def generate_content(self, prompt, request_options=None, **kwargs):
+        return asyncio.run(self.generate_content_async(prompt, request_options, **kwargs))
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_client(breaker=None, **kwargs):
+    options = {"client": None, "backoff": 0.001, "backoff_max": 0.002, "breaker": breaker}
+    options.update(kwargs)
+    return LLMClient(**options)
+
+
+def test_retries_429_and_5xx():
+    client = make_client()
+    model = FakeModel((429, 0), (503, 0))
+    response = asyncio.run(client.generate_async(model, "prompt"))
+    assert response.text == "answer 3"
+    assert client.retries == 2
+    assert client.generate(FakeModel((500, 0)), "prompt").text == "answer 2"
+
+
+def test_4xx_is_not_retried():
+    client = make_client()
+    model = FakeModel((400, 0))
+    try:
+        asyncio.run(client.generate_async(model, "prompt"))
+        assert False, "400 should be raised"
+    except FakeError as e:
+        assert e.code == 400
+    assert model.calls == 1
+
+
+def test_deadline_bounds_the_whole_call():
+    client = make_client(attempt_timeout=0.1, deadline=0.3)
+    model = FakeModel(*[("ok", 5)] * 10)
+    started = time.monotonic()
+    try:
+        asyncio.run(client.generate_async(model, "prompt"))
+        assert False, "deadline should be exceeded"
+    except UpstreamUnavailable:
+        pass
+    assert time.monotonic() - started < 1.0
+    assert model.calls >= 2
+
+
+def test_breaker_opens_half_opens_and_closes():
+    clock = FakeClock()
+    breaker = CircuitBreaker(threshold=2, cooldown=30, clock=clock)
+    client = make_client(breaker=breaker, max_attempts=1)
+    for _ in range(2):
+        try:
+            asyncio.run(client.generate_async(FakeModel((503, 0)), "prompt"))
+        except UpstreamUnavailable:
+            pass
+    assert breaker.state == "open"
+
+    model = FakeModel()
+    try:
+        asyncio.run(client.generate_async(model, "prompt"))
+        assert False, "open circuit should fail fast"
+    except CircuitOpenError:
+        assert model.calls == 0
+
+    clock.now += 31
+    try:
+        asyncio.run(client.generate_async(FakeModel((503, 0)), "prompt"))
+    except UpstreamUnavailable:
+        pass
+    assert breaker.state == "open", "a failed probe reopens the circuit"
+
+    clock.now += 31
+    asyncio.run(client.generate_async(FakeModel(), "prompt"))
+    assert breaker.state == "closed"
+    assert breaker.opened == 2
+
+
+def _half_open_client():
+    clock = FakeClock()
+    breaker = CircuitBreaker(threshold=1, cooldown=30, clock=clock)
+    client = make_client(breaker=breaker, max_attempts=1)
+    try:
+        client.generate(FakeModel((503, 0)), "prompt")
+    except UpstreamUnavailable:
+        pass
+    clock.now += 31
+    return client, breaker
+
+
+def test_probe_rejected_with_4xx_frees_the_probe_slot():
+    client, breaker = _half_open_client()
+    try:
+        asyncio.run(client.generate_async(FakeModel((400, 0)), "prompt"))
+    except FakeError:
+        pass
+    assert breaker.state == "half_open"
+    # The next call is let through as the probe instead of failing fast forever
+    asyncio.run(client.generate_async(FakeModel(), "prompt"))
+    assert breaker.state == "closed"
+
+
+def test_cancelled_probe_frees_the_probe_slot():
+    client, breaker = _half_open_client()
+
+    async def cancel_probe():
+        task = asyncio.ensure_future(client.generate_async(FakeModel(("ok", 5)), "prompt"))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(cancel_probe())
+    client.generate(FakeModel(), "prompt")
+    assert breaker.state == "closed"
+
+
+def test_stream_holds_the_slot_and_deadline_until_the_end():
+    async def run():
+        client = make_client(deadline=5)
+        model = FakeModel(("stream", [("a", 0), ("b", 0.05), ("c", 0)]))
+        slot = upstream("gemini")
+        free = slot._value
+        texts = []
+        async for chunk in client.stream_async(model, "prompt"):
+            texts.append(chunk.text)
+            assert slot._value == free - 1
+        assert texts == ["a", "b", "c"]
+        assert slot._value == free
+
+        client = make_client(deadline=0.2)
+        model = FakeModel(("stream", [("a", 0), ("b", 5)]))
+        try:
+            async for _ in client.stream_async(model, "prompt"):
+                pass
+            assert False, "deadline should cut the stream"
+        except UpstreamUnavailable:
+            pass
+        assert slot._value == free
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name}: ok")
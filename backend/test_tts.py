@@ -0,0 +1,122 @@
+import io
+import os
+import sys
+import time
+import wave
+import struct
+import tempfile
+import threading
+
+# Add backend to path
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+
+from app.tts import LocalTTSBackend, SentenceSynthesizer, TTSBackend
+
+
+class FakeBackend(TTSBackend):
+    """The UTF-8 text as "audio", lasting 0.1 s per character; records every synthesis."""
+
+    name = "fake"
+    format = "raw"
+    media_type = "application/octet-stream"
+
+    def __init__(self, delay=0.0, fail_on=()):
+        self.delay = delay
+        self.fail_on = set(fail_on)
+        self.calls = []
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    def synthesize(self, text, voice):
+        with self._lock:
+            self.calls.append(text)
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            time.sleep(self.delay)
+            if text in self.fail_on:
+                raise RuntimeError("engine crashed")
+            return text.encode("utf-8")
+        finally:
+            with self._lock:
+                self.active -= 1
+
+    def duration(self, audio):
+        return len(audio.decode("utf-8")) / 10.0
+
+    def join(self, parts):
+        return b"".join(parts)
+
+
+def test_repeated_sentences_are_synthesized_once():
+    backend = FakeBackend()
+    with tempfile.TemporaryDirectory() as cache_dir:
+        synth = SentenceSynthesizer(backend, cache_dir=cache_dir, workers=4)
+        result = synth.synthesize("こんにちは！元気です。こんにちは！", persona="Teacher")
+        assert sorted(backend.calls) == ["こんにちは！", "元気です。"]
+        assert result["audio"] == "こんにちは！元気です。こんにちは！".encode("utf-8")
+        assert [s["text"] for s in result["segments"]] == ["こんにちは！", "元気です。", "こんにちは！"]
+        assert [s["start"] for s in result["segments"]] == [0.0, 0.6, 1.1]
+
+
+def test_cached_sentences_skip_the_backend():
+    backend = FakeBackend()
+    with tempfile.TemporaryDirectory() as cache_dir:
+        SentenceSynthesizer(backend, cache_dir=cache_dir).synthesize("一。二。")
+        # A fresh synthesizer (e.g. after a restart) reads the disk cache
+        synth = SentenceSynthesizer(backend, cache_dir=cache_dir)
+        result = synth.synthesize("二。一。三。")
+        assert backend.calls.count("一。") == 1 and backend.calls.count("二。") == 1
+        assert synth.stats()["hits"] == 2 and synth.stats()["misses"] == 1
+        assert result["audio"] == "二。一。三。".encode("utf-8")
+
+        # The cache is keyed by persona too
+        synth.synthesize("一。", persona="YouTuber")
+        assert backend.calls.count("一。") == 2
+
+
+def test_concurrent_scripts_share_one_synthesis_and_the_worker_limit():
+    backend = FakeBackend(delay=0.05)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        synth = SentenceSynthesizer(backend, cache_dir=cache_dir, workers=2)
+        text = "共通の行。" + "".join(f"行{i}。" for i in range(4))
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(synth.synthesize(text))) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert backend.calls.count("共通の行。") == 1
+        assert backend.max_active <= 2
+        assert all(r["audio"] == results[0]["audio"] for r in results)
+
+
+def test_failed_sentence_is_skipped():
+    backend = FakeBackend(fail_on={"失敗。"})
+    with tempfile.TemporaryDirectory() as cache_dir:
+        result = SentenceSynthesizer(backend, cache_dir=cache_dir).synthesize("成功。失敗。完了。")
+        assert [s["text"] for s in result["segments"]] == ["成功。", "完了。"]
+        assert result["segments"][1]["start"] == 0.3
+
+
+def test_wav_duration_ignores_streamed_header():
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(22050)
+        w.writeframes(b"\x00\x00" * 11025)
+    audio = bytearray(buf.getvalue())
+    # What espeak-ng --stdout writes: placeholder RIFF and data sizes it never patches
+    audio[4:8] = struct.pack("<I", 0x7ffff024)
+    audio[40:44] = struct.pack("<I", 0x7ffff000)
+    backend = LocalTTSBackend.__new__(LocalTTSBackend)
+    assert backend.duration(bytes(audio)) == 0.5
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name}: ok")
@@ -16,17 +16,17 @@ def test_generation():
     print(f"Query: {query}")
     
     script = get_video_script(query)
-    print("\n[Generated Script]")
-    print(script[:500] + "..." if len(script) > 500 else script)
-    
     if not script:
-        print("FAILED: Script is empty.")
+        print("FAILED: Script generation failed.")
         return
 
+    print("\n[Generated Script]")
+    print(script[:500] + "..." if len(script) > 500 else script)
+
     print("\n--- Testing TTS ---")
-    audio_b64 = generate_audio(script[:100]) # Generate for first 100 chars to save time
-    if audio_b64:
-        print(f"SUCCESS: Audio generated ({len(audio_b64)} chars base64)")
+    audio = generate_audio(script[:100]) # Generate for first 100 chars to save time
+    if audio["audio_url"]:
+        print(f"SUCCESS: Audio generated ({audio['audio_url']}, {len(audio['segments'])} sentences)")
     else:
         print("FAILED: Audio generation failed.")
 
@@ -12,7 +12,7 @@ interface DiagnoseResponse {
     next_actions: any;
     disclaimer: string;
     referenced_pages: number[];
-    visual_page_base64?: string;
+    visual_page_url?: string;
     source_file?: string;
     request_id?: string;
 }
@@ -38,7 +38,7 @@ export default function DiagnosePage() {
             formData.append('persona', persona);
 
             const apiUrl = process.env.NEXT_PUBLIC_API_URL || '';
-            const res = await fetch(`${apiUrl}/api/diagnose`, {
+            const res = await fetch(`${apiUrl}/api/diagnose/stream`, {
                 method: 'POST',
                 body: formData,
             });
@@ -47,12 +47,12 @@ export default function DiagnosePage() {
                 throw new Error("サーバーが混み合っているか、マニュアルの解析に時間がかかっています。もう一度お試しいただくか、少しお待ちください。");
             }
 
-            if (!res.ok) {
+            if (!res.ok || !res.body) {
                 throw new Error("診断に失敗しました。インターネット接続やAPIの設定、マニュアルの有無を確認してください。");
             }
 
-            const data: DiagnoseResponse = await res.json();
-            setDiagnosisData(data);
+            // Show causes and steps as they arrive instead of waiting for the whole answer
+            await readDiagnosisStream(res.body);
             handleGenerateVideo(text, persona);
 
         } catch (error: any) {
@@ -63,6 +63,55 @@ export default function DiagnosePage() {
         }
     };
 
+    const readDiagnosisStream = async (body: ReadableStream<Uint8Array>) => {
+        const reader = body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = "";
+
+        const showPartial = (update: (d: DiagnoseResponse) => DiagnoseResponse) => {
+            setLoading(false);
+            setDiagnosisData((prev) => update(prev ?? {
+                probable_causes: [],
+                confidence: 0,
+                steps: [],
+                cautions: [],
+                next_actions: {},
+                disclaimer: "",
+                referenced_pages: [],
+            }));
+        };
+
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+
+            let boundary;
+            while ((boundary = buffer.indexOf("\n\n")) !== -1) {
+                const raw = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+                const event = raw.match(/^event: (.*)$/m)?.[1];
+                const dataLine = raw.match(/^data: (.*)$/m)?.[1];
+                if (!event || dataLine === undefined) continue;
+                const data = JSON.parse(dataLine);
+
+                if (event === "cause") {
+                    showPartial((d) => ({ ...d, probable_causes: [...d.probable_causes, data] }));
+                } else if (event === "step") {
+                    showPartial((d) => ({ ...d, steps: [...d.steps, data] }));
+                } else if (event === "pages") {
+                    showPartial((d) => ({ ...d, ...data }));
+                } else if (event === "visual") {
+                    showPartial((d) => ({ ...d, ...data }));
+                } else if (event === "done") {
+                    showPartial(() => data);
+                } else if (event === "error") {
+                    throw new Error(data.detail || "診断に失敗しました。");
+                }
+            }
+        }
+    };
+
     const handleGenerateVideo = async (currentQuery: string, currentPersona: string) => {
         if (!currentQuery) return;
         setVideoLoading(true);
@@ -164,13 +213,13 @@ export default function DiagnosePage() {
                                     </p>
                                 )}
 
-                                {diagnosisData.visual_page_base64 && (
+                                {diagnosisData.visual_page_url && (
                                     <div className="mt-6 border rounded-xl overflow-hidden shadow-sm">
                                         <p className="bg-gray-50 text-[10px] uppercase tracking-wider text-gray-400 px-3 py-1 border-b">
                                             Manual Reference: {diagnosisData.source_file} (Page {diagnosisData.referenced_pages[0]})
                                         </p>
                                         <img
-                                            src={`data:image/png;base64,${diagnosisData.visual_page_base64}`}
+                                            src={`${process.env.NEXT_PUBLIC_API_URL || ''}${diagnosisData.visual_page_url}`}
                                             alt="Manual Diagram"
                                             className="w-full h-auto cursor-zoom-in hover:scale-[1.02] transition-transform"
                                         />
@@ -188,7 +237,7 @@ export default function DiagnosePage() {
                                     <p className="mb-4 text-center text-gray-600">音声とスライドで解説します。</p>
                                     <VideoPlayer
                                         script={videoData.script}
-                                        audioBase64={videoData.audio_base64}
+                                        audioUrl={videoData.audio_url}
                                         slides={videoData.slides}
                                     />
                                 </div>
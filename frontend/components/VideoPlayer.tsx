@@ -6,27 +6,31 @@ import { Play, Pause, Rewind } from 'lucide-react';
 interface Slide {
     type: string;
     text: string;
-    image?: string;
+    image?: string | null;
+    page?: number | null;
+    start?: number;
+    duration?: number;
 }
 
 interface VideoPlayerProps {
     script: string;
-    audioBase64: string;
+    audioUrl: string | null;
     slides: Slide[];
 }
 
-const VideoPlayer: React.FC<VideoPlayerProps> = ({ script, audioBase64, slides }) => {
+const VideoPlayer: React.FC<VideoPlayerProps> = ({ script, audioUrl, slides }) => {
     const audioRef = useRef<HTMLAudioElement>(null);
     const [isPlaying, setIsPlaying] = useState(false);
     const [currentTime, setCurrentTime] = useState(0);
     const [duration, setDuration] = useState(0);
 
     useEffect(() => {
-        if (audioRef.current) {
-            audioRef.current.src = `data:audio/mp3;base64,${audioBase64}`;
+        if (audioRef.current && audioUrl) {
+            // Served with Range support, so playback starts before the whole file has downloaded
+            audioRef.current.src = `${process.env.NEXT_PUBLIC_API_URL || ''}${audioUrl}`;
             audioRef.current.load();
         }
-    }, [audioBase64]);
+    }, [audioUrl]);
 
     const togglePlay = () => {
         if (audioRef.current) {
@@ -61,9 +65,11 @@ const VideoPlayer: React.FC<VideoPlayerProps> = ({ script, audioBase64, slides }
         setIsPlaying(false);
     }
 
-    // Simple slide logic: just show the first slide for now, or rotate if multiple
-    // In a real app, we'd map timestamps to slides.
-    const currentSlide = slides[0];
+    // Show the last slide whose start time has been reached
+    const currentSlide = slides.reduce<Slide | undefined>(
+        (shown, slide) => (slide.start ?? 0) <= currentTime ? slide : shown,
+        slides[0]
+    );
 
     return (
         <div className="flex flex-col items-center w-full max-w-2xl mx-auto p-4 bg-white rounded-xl shadow-lg">
@@ -71,7 +77,11 @@ const VideoPlayer: React.FC<VideoPlayerProps> = ({ script, audioBase64, slides }
             {/* Visual Area (Slide) */}
             <div className="w-full aspect-video bg-gray-100 mb-6 rounded-lg flex items-center justify-center border-2 border-gray-200 overflow-hidden relative">
                 {currentSlide?.image ? (
-                    <img src={currentSlide.image} alt="Slide" className="object-cover w-full h-full" />
+                    <img
+                        src={`${process.env.NEXT_PUBLIC_API_URL || ''}${currentSlide.image}`}
+                        alt={currentSlide.text || "Slide"}
+                        className="object-contain w-full h-full"
+                    />
                 ) : (
                     <div className="p-8 text-center">
                         <h2 className="text-3xl font-bold text-gray-800 mb-4">{currentSlide?.text || "解説"}</h2>
@@ -82,6 +92,7 @@ const VideoPlayer: React.FC<VideoPlayerProps> = ({ script, audioBase64, slides }
                 {/* Audio Element (Hidden) */}
                 <audio
                     ref={audioRef}
+                    preload="auto"
                     onTimeUpdate={handleTimeUpdate}
                     onLoadedMetadata={handleLoadedMetadata}
                     onEnded={handleEnded}